@@ -0,0 +1,230 @@
+"""
+Офлайн-обработка каталога или tar-архива без HTTP.
+
+Файлы с тома хранения не нужно загружать в сервис: CLI прогоняет тот же пайплайн
+FaceProcessor на всех ядрах (пул процессов, в каждом свой FaceProcessor, как в
+ProcessingEngine с FACE_CROP_ENGINE=process), пишет результаты рядом в выходной
+каталог с той же структурой и ведёт манифест.
+
+Манифест — JSON Lines, по строке на обработанный файл: path, status (ok / no-face / error),
+output, score (confidence детектора), bytes, process_time (чтение и обработка, с),
+stages (время этапов пайплайна, с — как в Server-Timing сервиса), error.
+Имя результата сохраняет расширение исходника (a.jpg -> a.jpg.webp): a.jpg и a.png
+в одном каталоге не перезаписывают друг друга.
+Строка дописывается сразу после файла, поэтому после прерывания запуск с тем же
+манифестом продолжает с места остановки: файлы со статусом ok и no-face пропускаются,
+error — повторяются. В конце печатается скорость (изображений в секунду) для оценки заданий.
+
+Запуск:
+    python -m app.batch INPUT OUTPUT [--workers N] [--format webp] [--quality 85]
+    INPUT — каталог (рекурсивно) или .tar / .tar.gz / .tgz
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tarfile
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional, Set, Tuple, Union
+
+from app import config, log
+from app.encoding import available_formats, file_extension, normalize_format
+from app.executor import get_processor, init_worker
+
+# Расширения входных файлов (регистр не важен)
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff", ".heic", ".heif", ".avif", ".gif"}
+
+MANIFEST_NAME = "manifest.jsonl"
+
+# Статусы, при которых файл при повторном запуске не обрабатывается заново
+DONE_STATUSES = ("ok", "no-face")
+
+
+def iter_inputs(source: Path) -> Iterator[Tuple[str, Union[Path, bytes]]]:
+    """
+    (относительный путь, источник) для каждого изображения.
+
+    Для каталога источник — путь (файл читает воркер), для tar — байты: архив
+    читается последовательно в основном процессе (сжатый tar не читается вразнобой).
+    """
+    if source.is_dir():
+        for path in sorted(source.rglob("*")):
+            if path.is_file() and path.suffix.lower() in IMAGE_EXTENSIONS:
+                yield path.relative_to(source).as_posix(), path
+        return
+    with tarfile.open(source, "r:*") as tar:
+        for member in tar:
+            if not member.isfile() or Path(member.name).suffix.lower() not in IMAGE_EXTENSIONS:
+                continue
+            fileobj = tar.extractfile(member)
+            if fileobj is not None:
+                yield member.name.removeprefix("./"), fileobj.read()
+
+
+def load_manifest(path: Path) -> Dict[str, Dict[str, Any]]:
+    """Записи манифеста по относительному пути (последняя запись побеждает)."""
+    records = {}
+    if not path.exists():
+        return records
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # недописанная строка при аварийной остановке
+            records[record["path"]] = record
+    return records
+
+
+def output_name(rel_path: str, output_format: str) -> str:
+    """Относительный путь результата: к имени исходника дописывается расширение формата."""
+    path = Path(rel_path)
+    return path.with_name(f"{path.name}.{file_extension(output_format)}").as_posix()
+
+
+def process_file(rel_path: str, source: Union[Path, bytes], output_dir: str, output_format: str,
+                 quality: Optional[int], processor_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Обрабатывает один файл в воркере и сам пишет результат (байты не гоняются между процессами).
+
+    Returns:
+        Запись манифеста
+    """
+    started_at = time.time()
+    record = {"path": rel_path, "status": "error", "output": None, "score": None, "bytes": None, "error": None}
+    try:
+        image_bytes = source if isinstance(source, bytes) else Path(source).read_bytes()
+        record["bytes"] = len(image_bytes)
+        processor = get_processor(processor_kwargs)
+        result = processor.process_image(image_bytes, Path(rel_path).name, output_format, quality)
+        if result is None and processor.last_stats.get("outcome") == "too-large":
+            record["error"] = f"ImageTooLarge: больше {processor.max_megapixels:g} МП"
+        elif result is None:
+            record["status"] = "no-face"
+        else:
+            out_rel = output_name(rel_path, output_format)
+            out_path = Path(output_dir) / out_rel
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            out_path.write_bytes(result["data"])
+            record.update(status="ok", output=out_rel, score=round(result["geometry"]["score"], 4))
+        stages = processor.last_stats.get("stages") or {}
+        record["stages"] = {name: round(seconds, 4) for name, seconds in stages.items()}
+    except Exception as e:
+        record["error"] = f"{type(e).__name__}: {e}"[:200]
+    record["process_time"] = round(time.time() - started_at, 4)
+    return record
+
+
+def run(input_path: Path, output_dir: Path, manifest_path: Path, workers: int, output_format: str,
+        quality: Optional[int], processor_kwargs: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Обрабатывает все изображения, дописывая манифест. workers=0 — в текущем процессе (отладка).
+
+    Returns:
+        Сводка: processed, ok, no_face, error, skipped, elapsed, images_per_second
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    done = {path for path, record in load_manifest(manifest_path).items() if record["status"] in DONE_STATUSES}
+    summary = {"processed": 0, "ok": 0, "no_face": 0, "error": 0, "skipped": 0}
+    task_args = (str(output_dir), output_format, quality, processor_kwargs)
+
+    def record_result(manifest, record: Dict[str, Any]) -> None:
+        manifest.write(json.dumps(record, ensure_ascii=False) + "\n")
+        manifest.flush()
+        summary["processed"] += 1
+        summary[record["status"].replace("-", "_")] += 1
+        if summary["processed"] % 100 == 0:
+            rate = summary["processed"] / (time.time() - started_at)
+            print(f"... {summary['processed']} файлов, {rate:.1f} изобр./с")
+
+    started_at = time.time()
+    with open(manifest_path, "a", encoding="utf-8") as manifest:
+        inputs = ((rel, src) for rel, src in iter_inputs(input_path) if not _skip(rel, done, summary))
+        if workers == 0:
+            for rel, src in inputs:
+                record_result(manifest, process_file(rel, src, *task_args))
+        else:
+            pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(processor_kwargs,),
+            )
+            pending: Set[Future] = set()
+            try:
+                for rel, src in inputs:
+                    # Ограничиваем число задач в полёте: tar не читается в память целиком
+                    if len(pending) >= workers * 4:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            record_result(manifest, future.result())
+                    pending.add(pool.submit(process_file, rel, src, *task_args))
+                for future in wait(pending).done:
+                    record_result(manifest, future.result())
+            finally:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+    elapsed = time.time() - started_at
+    summary["elapsed"] = round(elapsed, 2)
+    summary["images_per_second"] = round(summary["processed"] / elapsed, 2) if elapsed > 0 else 0.0
+    return summary
+
+
+def _skip(rel_path: str, done: Set[str], summary: Dict[str, Any]) -> bool:
+    if rel_path in done:
+        summary["skipped"] += 1
+        return True
+    return False
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m app.batch", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("input", type=Path, help="Каталог с изображениями или .tar/.tar.gz")
+    parser.add_argument("output", type=Path, help="Каталог для результатов")
+    parser.add_argument("--manifest", type=Path, help=f"Манифест (по умолчанию OUTPUT/{MANIFEST_NAME})")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Процессов (по умолчанию — число ядер; 0 — в текущем процессе)")
+    parser.add_argument("--format", default="png", help="png, jpeg, webp или avif")
+    parser.add_argument("--quality", type=int, help="Качество 1-100 для jpeg/webp/avif")
+    parser.add_argument("--output-size", type=int, default=config.OUTPUT_SIZE)
+    parser.add_argument("--face-fill-ratio", type=float, default=config.FACE_FILL_RATIO)
+    args = parser.parse_args(argv)
+
+    output_format = normalize_format(args.format)
+    if output_format is None or output_format not in available_formats():
+        parser.error(f"формат {args.format!r} не поддерживается, доступны: {', '.join(available_formats())}")
+    if not args.input.exists():
+        parser.error(f"{args.input} не найден")
+
+    processor_kwargs = {
+        "output_size": args.output_size,
+        "face_fill_ratio": args.face_fill_ratio,
+        "cascade_threshold": config.CASCADE_THRESHOLD,
+        "detection_max_dimension": config.DETECTION_MAX_DIMENSION,
+        "png_compression": config.PNG_COMPRESSION,
+        "max_megapixels": config.MAX_MEGAPIXELS,
+    }
+    manifest_path = args.manifest or args.output / MANIFEST_NAME
+    log.configure(config.LOG_LEVEL, config.LOG_FORMAT)
+    try:
+        summary = run(args.input, args.output, manifest_path, max(0, args.workers), output_format,
+                      args.quality, processor_kwargs)
+    except KeyboardInterrupt:
+        print(f"\n⏹ Прервано. Повторный запуск с тем же манифестом ({manifest_path}) продолжит с места остановки.")
+        return 130
+
+    print(
+        f"✅ Обработано {summary['processed']} файлов за {summary['elapsed']:.1f}с "
+        f"({summary['images_per_second']:.2f} изобр./с): успешно {summary['ok']}, "
+        f"без лица {summary['no_face']}, ошибок {summary['error']}, пропущено (уже в манифесте) {summary['skipped']}"
+    )
+    return 1 if summary["error"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,345 @@
+"""
+Кэш результатов по содержимому.
+
+Клиенты часто повторно загружают те же фотографии (редакторы профиля сохраняют
+аватар заново, мобильные приложения повторяют запрос при плохой сети). Результат
+полностью определяется байтами входного файла и параметрами рендеринга, поэтому
+ключ кэша — хэш этих байтов и всех параметров (output_size, face_fill_ratio, формат,
+качество, ...). Из этих же ключей строится ETag ответа.
+
+Уровни:
+- память: LRU с бюджетом в байтах
+- диск (необязательно): файлы в каталоге, переживают перезапуск; тоже с бюджетом,
+  вытесняются самые давно использованные (индекс в памяти, при запуске — по mtime)
+
+Кэшируется и отрицательный результат (лицо не найдено) — повтор тоже бесплатен.
+
+GeometryStore хранит найденную геометрию лица вместе с исходными байтами под id
+изображения: повторный кроп с другими параметрами кадрирования не запускает модели.
+
+Методы вызываются только из event loop, блокировки не нужны; файловые операции
+дискового уровня выполняются в потоках (asyncio.to_thread) и loop не блокируют.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from app.encoding import OUTPUT_FORMATS
+
+logger = logging.getLogger(__name__)
+
+# Меняется при изменении пайплайна, чтобы дисковый кэш старой версии не использовался
+CACHE_VERSION = 1
+
+# Сколько байт бюджета занимает запись «лицо не найдено»
+NEGATIVE_ENTRY_SIZE = 64
+NEGATIVE_SUFFIX = "none"
+
+_MISSING = object()
+
+# Расширения файлов дискового уровня и их media type
+_SUFFIX_MEDIA = {ext: media for media, ext in OUTPUT_FORMATS.values()}
+_DISK_SUFFIXES = (*_SUFFIX_MEDIA, NEGATIVE_SUFFIX)
+
+
+def _crops_size(result: Dict[str, Any]) -> int:
+    """Байты закодированных кропов результата: 'data' — это первый из variants/faces, считается один раз."""
+    if "faces" in result:
+        return sum(_crops_size(face) for face in result["faces"])
+    if "variants" in result:
+        return sum(len(variant["data"]) for variant in result["variants"])
+    return len(result["data"])
+
+
+def _read_and_touch(path: Path) -> bytes:
+    data = path.read_bytes()
+    os.utime(path)  # отметка использования: порядок вытеснения после перезапуска
+    return data
+
+
+def _write_atomic(path: Path, data: bytes) -> None:
+    path.parent.mkdir(exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)  # атомарно: параллельный читатель не увидит половину файла
+
+
+def _unlink_all(paths) -> None:
+    for path in paths:
+        try:
+            path.unlink()
+        except OSError:
+            continue
+
+
+def content_hash(image_bytes: bytes) -> str:
+    """Хэш содержимого файла (blake2b, hex 32 символа) — считается один раз на входной файл."""
+    return hashlib.blake2b(image_bytes, digest_size=16).hexdigest()
+
+
+def cache_key(digest: str, params: Dict[str, Any]) -> str:
+    """Ключ результата: хэш содержимого (content_hash) и параметров рендеринга (hex, 32 символа)."""
+    payload = json.dumps({"v": CACHE_VERSION, "content": digest, **params}, sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode(), digest_size=16).hexdigest()
+
+
+class _ByteLRU:
+    """LRU-словарь с бюджетом в байтах (размер записи передаётся при put)."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[Any, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> Any:
+        """Значение (запись становится самой свежей) или _MISSING."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return _MISSING
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: str, value: Any, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self.bytes -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (_, evicted_size) = self._entries.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+
+
+class ResultCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, disk_dir: Optional[str] = None,
+                 disk_max_bytes: int = 1024 * 1024 * 1024):
+        """
+        Args:
+            max_bytes: Бюджет памяти (сумма размеров закодированных изображений). 0 — без памяти
+            disk_dir: Каталог дискового уровня, None — без диска
+            disk_max_bytes: Бюджет дискового уровня
+        """
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_dir = Path(disk_dir) if disk_dir else None
+        self._memory = _ByteLRU(max_bytes)
+        self._disk_bytes = 0
+        self._disk_evictions = 0
+        self._disk_index: "OrderedDict[str, Tuple[str, int]]" = OrderedDict()  # ключ -> (расширение, байты)
+        self._disk_writing = set()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+        if self.disk_dir:
+            self.disk_dir.mkdir(parents=True, exist_ok=True)
+            self._load_disk_index()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 or self.disk_dir is not None
+
+    @staticmethod
+    def _entry_size(result: Optional[Dict[str, Any]]) -> int:
+        if not result:
+            return NEGATIVE_ENTRY_SIZE
+        landmarks = (result.get("geometry") or {}).get("landmarks")
+        return _crops_size(result) + (landmarks.nbytes if landmarks is not None else 0)
+
+    async def _get(self, key: str) -> Any:
+        """Результат (dict или None для «лицо не найдено») либо _MISSING, если записи нет."""
+        found = self._memory.get(key)
+        if found is not _MISSING:
+            self.hits_memory += 1
+            return found
+        if self.disk_dir:
+            found = await self._disk_get(key)
+            if found is not _MISSING:
+                self.hits_disk += 1
+                self._remember(key, found)
+                return found
+        self.misses += 1
+        return _MISSING
+
+    async def lookup(self, key: str) -> Tuple[bool, Optional[Dict[str, Any]]]:
+        """(найдено, результат). Результат None при найденной записи — лицо не найдено."""
+        found = await self._get(key)
+        if found is _MISSING:
+            return False, None
+        return True, found
+
+    async def put(self, key: str, result: Optional[Dict[str, Any]]) -> None:
+        """
+        Сохраняет результат process_image: data, media_type, variants (несколько размеров),
+        faces (режим всех лиц) и геометрию (если есть). Имя файла зависит от запроса и не хранится;
+        на диск пишутся только байты изображения.
+        """
+        if result is not None:
+            result = {k: result[k] for k in ("data", "media_type", "variants", "faces", "geometry") if k in result}
+        self._remember(key, result)
+        if self.disk_dir:
+            await self._disk_put(key, result)
+
+    def _remember(self, key: str, result: Optional[Dict[str, Any]]) -> None:
+        self._memory.put(key, result, self._entry_size(result))
+
+    # --- дисковый уровень: <dir>/<ab>/<key>.<ext>, для «лицо не найдено» — пустой <key>.none ---
+    # Индекс файлов (_disk_index) — LRU в памяти: поиск и выбор вытесняемых без обхода каталога.
+    # Индекс меняется только из event loop; чтение, запись и удаление файлов — в потоках
+
+    def _load_disk_index(self) -> None:
+        """Один обход каталога при запуске: файлы от давно использованных к свежим (по mtime)."""
+        files = []
+        for p in self.disk_dir.glob("*/*.*"):
+            key, _, suffix = p.name.partition(".")
+            if suffix not in _DISK_SUFFIXES:
+                continue  # недописанный .tmp
+            try:
+                st = p.stat()
+            except OSError:
+                continue
+            files.append((st.st_mtime, key, suffix, st.st_size))
+        for _, key, suffix, size in sorted(files):
+            self._disk_index[key] = (suffix, size)
+            self._disk_bytes += size
+
+    def _disk_path(self, key: str, suffix: str) -> Path:
+        return self.disk_dir / key[:2] / f"{key}.{suffix}"
+
+    async def _disk_get(self, key: str) -> Any:
+        entry = self._disk_index.get(key)
+        if entry is None:
+            # Файл мог записать другой воркер с тем же каталогом
+            entry = await asyncio.to_thread(self._disk_find, key)
+            if entry is None or key in self._disk_index:
+                return _MISSING
+            self._disk_index[key] = entry
+            self._disk_bytes += entry[1]
+        suffix, _ = entry
+        if suffix != NEGATIVE_SUFFIX:
+            try:
+                data = await asyncio.to_thread(_read_and_touch, self._disk_path(key, suffix))
+            except OSError:
+                self._disk_forget(key)
+                return _MISSING
+        if key in self._disk_index:
+            self._disk_index.move_to_end(key)
+        return None if suffix == NEGATIVE_SUFFIX else {"data": data, "media_type": _SUFFIX_MEDIA[suffix]}
+
+    def _disk_find(self, key: str) -> Optional[Tuple[str, int]]:
+        for suffix in _DISK_SUFFIXES:
+            try:
+                return suffix, self._disk_path(key, suffix).stat().st_size
+            except OSError:
+                continue
+        return None
+
+    def _disk_forget(self, key: str) -> None:
+        entry = self._disk_index.pop(key, None)
+        if entry is not None:
+            self._disk_bytes -= entry[1]
+
+    async def _disk_put(self, key: str, result: Optional[Dict[str, Any]]) -> None:
+        if result is None:
+            suffix, data = NEGATIVE_SUFFIX, b""
+        elif "variants" in result or "faces" in result:
+            return  # на диске одно изображение на ключ — результаты с несколькими кропами только в памяти
+        else:
+            ext = next((ext for media, ext in OUTPUT_FORMATS.values() if media == result["media_type"]), None)
+            if ext is None:
+                return
+            suffix, data = ext, result["data"]
+        if key in self._disk_index or key in self._disk_writing or len(data) > self.disk_max_bytes:
+            return
+        path = self._disk_path(key, suffix)
+        self._disk_writing.add(key)
+        try:
+            await asyncio.to_thread(_write_atomic, path, data)
+        except OSError as e:
+            logger.warning("Не удалось записать в дисковый кэш %s: %s", path, e)
+            return
+        finally:
+            self._disk_writing.discard(key)
+        self._disk_index[key] = (suffix, len(data))
+        self._disk_bytes += len(data)
+        if self._disk_bytes > self.disk_max_bytes:
+            await self._disk_evict()
+
+    async def _disk_evict(self) -> None:
+        """Удаляет самые давно использованные файлы, пока размер не станет ≤ 90% бюджета."""
+        target = self.disk_max_bytes * 0.9
+        victims = []
+        while self._disk_bytes > target and self._disk_index:
+            key, (suffix, size) = self._disk_index.popitem(last=False)
+            self._disk_bytes -= size
+            self._disk_evictions += 1
+            victims.append(self._disk_path(key, suffix))
+        await asyncio.to_thread(_unlink_all, victims)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits_memory + self.hits_disk + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._memory),
+            "bytes": self._memory.bytes,
+            "max_bytes": self.max_bytes,
+            "disk_dir": str(self.disk_dir) if self.disk_dir else None,
+            "disk_bytes": self._disk_bytes,
+            "disk_max_bytes": self.disk_max_bytes if self.disk_dir else 0,
+            "hits_memory": self.hits_memory,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "evictions": self._memory.evictions + self._disk_evictions,
+            "hit_ratio": round((self.hits_memory + self.hits_disk) / lookups, 4) if lookups else 0.0,
+        }
+
+
+class GeometryStore:
+    def __init__(self, max_bytes: int = 128 * 1024 * 1024):
+        """
+        Геометрия лица (FaceProcessor.analyze_image) и исходные байты под id изображения.
+
+        Args:
+            max_bytes: Бюджет памяти (в основном — исходные файлы), LRU. 0 — хранилище выключено
+        """
+        self.max_bytes = max_bytes
+        self._entries = _ByteLRU(max_bytes)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self._entries
+
+    def put(self, image_id: str, image_bytes: bytes, geometry: Dict[str, Any]) -> None:
+        # image_bytes может быть mmap большой загрузки: отображение остаётся валидным
+        # и после удаления временного файла, страницы читаются с диска, а не из кучи
+        size = len(image_bytes) + geometry["landmarks"].nbytes
+        self._entries.put(image_id, (image_bytes, geometry), size)
+
+    def get(self, image_id: str) -> Optional[Tuple[bytes, Dict[str, Any]]]:
+        """(байты, геометрия) или None, если id неизвестен или вытеснен."""
+        found = self._entries.get(image_id)
+        return None if found is _MISSING else found
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._entries.bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self._entries.evictions,
+        }
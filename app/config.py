@@ -0,0 +1,100 @@
+"""
+Настройки сервиса из переменных окружения.
+
+Все значения читаются один раз при импорте; для изменения перезапустите воркер.
+"""
+import os
+import tempfile
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_str(name: str, default: str) -> str:
+    value = os.getenv(name)
+    return value.strip() if value and value.strip() else default
+
+
+# Параметры кропа
+OUTPUT_SIZE = _env_int("FACE_CROP_OUTPUT_SIZE", 512)
+FACE_FILL_RATIO = _env_float("FACE_CROP_FACE_FILL_RATIO", 0.5)
+
+# Уровень сжатия PNG результата (0-9): выше — меньше файл, но заметно дороже по CPU
+PNG_COMPRESSION = min(9, max(0, _env_int("FACE_CROP_PNG_COMPRESSION", 3)))
+
+# Каскад детекторов: точная (дальнобойная) модель запускается, только если
+# лучший confidence быстрой модели ниже порога
+CASCADE_THRESHOLD = _env_float("FACE_CROP_CASCADE_THRESHOLD", 0.75)
+
+# Длинная сторона изображения для детекции. JPEG декодируется сразу в уменьшенном
+# масштабе (1/2, 1/4, 1/8), пока длинная сторона не меньше этого значения
+DETECTION_MAX_DIMENSION = _env_int("FACE_CROP_DETECTION_MAX_DIM", 1920)
+
+# Режим всех лиц (all_faces=1 в /v1/face-crop): кропы всех лиц с confidence детектора не ниже
+# MIN_FACE_SCORE, но не больше MAX_FACES самых уверенных на изображение — лимит стоимости
+# (каждое лицо — Face Mesh, рендеринг и кодирование; учитывается при приёме задач в пул)
+MAX_FACES = max(1, _env_int("FACE_CROP_MAX_FACES", 10))
+MIN_FACE_SCORE = _env_float("FACE_CROP_MIN_FACE_SCORE", 0.5)
+
+# Бюджет декодирования в мегапикселях (защита от decompression bomb: маленький файл с заголовком
+# 30000×30000). Проверяется по заголовку до декодирования: JPEG декодируется сильнее уменьшенным,
+# остальные форматы сверх бюджета отклоняются (413). 0 — без лимита
+MAX_MEGAPIXELS = max(0.0, _env_float("FACE_CROP_MAX_MEGAPIXELS", 50.0))
+
+# Пул выполнения пайплайна (чтобы CPU-работа не блокировала event loop)
+# ENGINE_MODE — "thread" (пул потоков) или "process" (пул процессов, по FaceProcessor на процесс)
+# ENGINE_WORKERS — сколько изображений обрабатывается параллельно в одном воркере uvicorn
+# ENGINE_MAX_QUEUE — сколько задач может ждать свободного исполнителя, сверх этого — 503
+# ENGINE_MAX_QUEUE_MP — бюджет по стоимости: сумма мегапикселей декодирования задач в пуле,
+#   сверх этого — тоже 503 (0 — только ограничение по числу задач)
+ENGINE_MODE = _env_str("FACE_CROP_ENGINE", "thread")
+ENGINE_WORKERS = max(1, _env_int("FACE_CROP_WORKERS", 2))
+ENGINE_MAX_QUEUE = max(0, _env_int("FACE_CROP_MAX_QUEUE", 16))
+ENGINE_MAX_QUEUE_MP = max(0.0, _env_float("FACE_CROP_MAX_QUEUE_MP", 200.0))
+
+# Лимиты загрузок (проверяются на сервере во время приёма тела, сверх лимита — 413)
+# MAX_FILE_BYTES — один файл (веб-интерфейс тоже не отправляет файлы больше 10 МБ)
+# MAX_REQUEST_BYTES — тело POST /v1/face-crop целиком (по умолчанию 5 файлов + заголовки multipart)
+# JOB_MAX_REQUEST_BYTES — тело POST /v1/jobs целиком; 0 — без лимита
+# UPLOAD_MMAP_BYTES — файлы больше этого читаются из временного файла через mmap, а не копией в память
+MAX_FILE_BYTES = max(0, _env_int("FACE_CROP_MAX_FILE_BYTES", 10 * 1024 * 1024))
+MAX_REQUEST_BYTES = max(0, _env_int("FACE_CROP_MAX_REQUEST_BYTES", 5 * MAX_FILE_BYTES + 1024 * 1024))
+JOB_MAX_REQUEST_BYTES = max(0, _env_int("FACE_CROP_JOB_MAX_REQUEST_BYTES", 2 * 1024 * 1024 * 1024))
+UPLOAD_MMAP_BYTES = max(0, _env_int("FACE_CROP_UPLOAD_MMAP_BYTES", 2 * 1024 * 1024))
+
+# Кэш результатов по содержимому (ключ — хэш входных байтов и параметров рендеринга)
+# CACHE_MAX_BYTES — бюджет памяти, 0 — кэш в памяти выключен
+# CACHE_DIR — каталог дискового уровня (переживает перезапуск), пусто — без диска
+# CACHE_DISK_MAX_BYTES — бюджет дискового уровня
+CACHE_MAX_BYTES = max(0, _env_int("FACE_CROP_CACHE_BYTES", 64 * 1024 * 1024))
+CACHE_DIR = _env_str("FACE_CROP_CACHE_DIR", "")
+CACHE_DISK_MAX_BYTES = max(0, _env_int("FACE_CROP_CACHE_DISK_BYTES", 1024 * 1024 * 1024))
+
+# Хранилище геометрии лиц для повторного кропа без моделей (GET /v1/images/{id}/crop).
+# Держит исходные файлы, поэтому бюджет больше, чем у кэша результатов; 0 — выключено
+GEOMETRY_STORE_BYTES = max(0, _env_int("FACE_CROP_GEOMETRY_BYTES", 128 * 1024 * 1024))
+
+# Асинхронные задания для больших пакетов (POST /v1/jobs)
+# JOBS_DIR — каталог для входных файлов и результатов (по умолчанию во временном каталоге системы)
+# JOB_WORKERS — сколько файлов заданий обрабатывается одновременно (в общем пуле, с низким приоритетом)
+# JOB_MAX_FILES — максимум файлов в одном задании
+# JOB_TTL — через сколько секунд после завершения задание и его результаты удаляются
+JOBS_DIR = _env_str("FACE_CROP_JOBS_DIR", os.path.join(tempfile.gettempdir(), "face-crop-jobs"))
+JOB_WORKERS = max(1, _env_int("FACE_CROP_JOB_WORKERS", 2))
+JOB_MAX_FILES = max(1, _env_int("FACE_CROP_JOB_MAX_FILES", 10000))
+JOB_TTL = max(60, _env_int("FACE_CROP_JOB_TTL", 24 * 3600))
+
+# Логирование: уровень (DEBUG — подробности по каждому изображению) и формат строк (json или text)
+LOG_LEVEL = _env_str("FACE_CROP_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = _env_str("FACE_CROP_LOG_FORMAT", "json")
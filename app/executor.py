@@ -0,0 +1,527 @@
+"""
+Пул выполнения пайплайна FaceProcessor.
+
+FaceProcessor.process_image — синхронная CPU-нагрузка (декодирование, MediaPipe, OpenCV).
+Обработчики FastAPI асинхронные, поэтому прямой вызов блокирует event loop всего
+воркера uvicorn, включая /health. Движок выносит работу в ограниченный пул исполнителей:
+обработчик ждёт результат через await, а время ожидания в очереди и время обработки
+возвращаются раздельно.
+
+Режимы:
+- "thread": пул потоков внутри воркера uvicorn (OpenCV и MediaPipe отпускают GIL)
+- "process": пул процессов, в каждом свой предзагруженный FaceProcessor;
+  файлы одного запроса обрабатываются параллельно на разных ядрах
+"""
+import asyncio
+import math
+import mmap
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from app import config, log, metrics
+from app.cache import GeometryStore, ResultCache, cache_key, content_hash
+from app.face_processor import (
+    DEFAULT_MAX_MEGAPIXELS, MIN_COST_MEGAPIXELS, FaceProcessor, ImageTooLarge, estimate_cost, shutdown_render_pool,
+)
+
+
+class EngineBusy(Exception):
+    """Очередь пула заполнена — новую задачу принять нельзя."""
+
+    def __init__(self, message: str, retry_after: int = 1):
+        super().__init__(message)
+        self.retry_after = retry_after  # через сколько секунд имеет смысл повторить (Retry-After)
+
+
+class BatchTooLarge(Exception):
+    """Задачи запроса вместе больше ёмкости или бюджета стоимости пула — не поместятся никогда, повтор не поможет."""
+
+
+class DeadlineExceeded(Exception):
+    """Задача не успеет (или не успела) начаться до дедлайна запроса — обработка не выполнялась."""
+
+
+ENGINE_MODES = ("thread", "process")
+
+# Параметры процессора, от которых зависит найденная геометрия лица (а не только рендеринг)
+GEOMETRY_PARAMS = ("cascade_threshold", "detection_max_dimension")
+
+# Оценка секунд обработки на мегапиксель декодирования: начальная, дальше уточняется по факту (EWMA)
+INITIAL_SECONDS_PER_MEGAPIXEL = 0.05
+COST_EWMA_ALPHA = 0.1
+MAX_RETRY_AFTER = 60
+
+# У каждого исполнителя (потока или процесса) свой FaceProcessor:
+# графы MediaPipe не потокобезопасны и не передаются между процессами
+_local = threading.local()
+
+
+def init_worker(processor_kwargs: Dict[str, Any]) -> None:
+    """Создаёт и прогревает FaceProcessor исполнителя до первой задачи."""
+    log.configure(config.LOG_LEVEL, config.LOG_FORMAT)  # в процессах пула (spawn) логирование не настроено
+    _local.processor = FaceProcessor(**processor_kwargs)
+
+
+def get_processor(processor_kwargs: Dict[str, Any]) -> FaceProcessor:
+    processor = getattr(_local, "processor", None)
+    if processor is None:
+        init_worker(processor_kwargs)
+        processor = _local.processor
+    return processor
+
+
+def _run_task(method: str, args: tuple, kwargs: Dict[str, Any], submitted_at: float,
+              processor_kwargs: Dict[str, Any], request_id: Optional[str] = None,
+              deadline: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Выполняет метод FaceProcessor в исполнителе и замеряет ожидание, обработку и этапы пайплайна.
+    request_id выставляется для логов исполнителя (contextvar не переходит в пул сам).
+    Если дедлайн (time.time()) истёк, пока задача ждала в очереди, метод не вызывается: 'expired'.
+    """
+    started_at = time.time()
+    if deadline is not None and started_at > deadline:
+        return {"result": None, "queue_time": started_at - submitted_at, "process_time": 0.0,
+                "stats": None, "expired": True}
+    processor = get_processor(processor_kwargs)
+    token = log.REQUEST_ID.set(request_id)
+    try:
+        result = getattr(processor, method)(*args, **kwargs)
+    finally:
+        log.REQUEST_ID.reset(token)
+    return {
+        "result": result,
+        "queue_time": started_at - submitted_at,
+        "process_time": time.time() - started_at,
+        "stats": processor.last_stats,
+    }
+
+
+def _cacheable(outcome: Dict[str, Any]) -> bool:
+    """Кэшируются только исходы, которые зависят лишь от содержимого и параметров: ok и no-face.
+    Ошибка или отказ по бюджету пикселей (too-large) при повторе должны обрабатываться заново."""
+    return (outcome.get("stats") or {}).get("outcome") in ("ok", "no-face")
+
+
+def _call_soon(loop: asyncio.AbstractEventLoop, callback, *args) -> None:
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        pass  # event loop уже закрыт (остановка сервиса)
+
+
+class _SharedComputation:
+    """Вычисление, которого ждут несколько запросов; отменяется, когда ушли все ждущие."""
+
+    def __init__(self, task: "asyncio.Task", deadline: Optional[float]):
+        self.task = task
+        self.deadline = deadline
+        self.waiters = 0
+
+    def accepts(self, deadline: Optional[float]) -> bool:
+        """Можно ли присоединиться: вычисление не отменяется и не бросит дедлайн раньше, чем нужно ждущему."""
+        if self.task.done() or self.task.cancelling():
+            return False
+        return self.deadline is None or (deadline is not None and deadline <= self.deadline)
+
+
+class _Reservation:
+    """Место в пуле, занятое submit_many за задачу пакета; run() забирает его вместо повторного приёма."""
+
+    def __init__(self, cost: float):
+        self.cost = cost
+        self.held = True
+
+
+def _warmup_task(delay: float) -> None:
+    """Пустая задача: заставляет пул поднять исполнителя и выполнить его инициализацию."""
+    time.sleep(delay)
+
+
+class ProcessingEngine:
+    def __init__(self, workers: int = 2, max_queue: int = 16,
+                 processor_kwargs: Optional[Dict[str, Any]] = None, mode: str = "thread",
+                 cache: Optional[ResultCache] = None, geometry: Optional[GeometryStore] = None,
+                 max_queue_cost: float = 0.0):
+        """
+        Ограниченный пул исполнителей для FaceProcessor.
+
+        Args:
+            workers: Сколько изображений обрабатывается одновременно (потоков или процессов)
+            max_queue: Сколько задач может ждать свободного исполнителя.
+                       Если очередь заполнена, run() бросает EngineBusy
+            processor_kwargs: Параметры FaceProcessor (output_size, face_fill_ratio)
+            mode: "thread" или "process"
+            cache: Кэш результатов по содержимому; попадание не занимает исполнителя
+            geometry: Хранилище геометрии лиц для повторного кропа (render)
+            max_queue_cost: Бюджет суммарной стоимости задач в пуле (мегапиксели декодирования,
+                            см. estimate_cost). 0 — только ограничение по числу задач.
+                            В пустой пул задача принимается при любой стоимости
+        """
+        if mode not in ENGINE_MODES:
+            raise ValueError(f"Неизвестный режим пула: {mode!r}, допустимо: {', '.join(ENGINE_MODES)}")
+        self.mode = mode
+        self.workers = workers
+        self.max_queue = max_queue
+        self.processor_kwargs = dict(processor_kwargs or {})
+        self.cache = cache if cache is not None and cache.enabled else None
+        self.geometry = geometry if geometry is not None and geometry.enabled else None
+        self.max_queue_cost = max_queue_cost
+        self.pending = 0  # отправлено в пул и ещё не завершено (меняется только из event loop)
+        self.pending_cost = 0.0  # сумма стоимостей этих задач
+        self._seconds_per_mp = INITIAL_SECONDS_PER_MEGAPIXEL
+        self._idle: Optional[asyncio.Condition] = None  # фоновые задачи ждут свободного исполнителя
+        self._background_waiting = 0
+        # Одинаковые изображения (ключ cache_key), которые сейчас обрабатываются: повторный
+        # запрос ждёт уже идущее вычисление, а не ставит в пул второе
+        self._in_flight: Dict[Tuple[str, bool], _SharedComputation] = {}
+        self._executor = self._create_executor()
+
+    def _create_executor(self) -> Executor:
+        if self.mode == "process":
+            # spawn, а не fork: MediaPipe и OpenCV держат потоки, которые fork не переносит
+            return ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(self.processor_kwargs,),
+            )
+        return ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="face-crop",
+            initializer=init_worker,
+            initargs=(self.processor_kwargs,),
+        )
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.max_queue
+
+    @property
+    def queue_depth(self) -> int:
+        """Сколько задач ждут свободного исполнителя."""
+        return max(0, self.pending - self.workers)
+
+    def estimate_cost(self, image_bytes: bytes, max_faces: int = 0) -> float:
+        """
+        Стоимость изображения в мегапикселях декодирования (по заголовку, см. face_processor.estimate_cost).
+        Изображение сверх бюджета max_megapixels — ImageTooLarge ещё до постановки в пул.
+        max_faces — лимит лиц в режиме всех лиц (каждое лицо добавляет к стоимости).
+        """
+        try:
+            return estimate_cost(
+                image_bytes,
+                self.processor_kwargs.get("detection_max_dimension", 1920),
+                self.processor_kwargs.get("max_megapixels", DEFAULT_MAX_MEGAPIXELS),
+                max_faces,
+            )
+        except ImageTooLarge:
+            metrics.OVERSIZED.inc()
+            raise
+
+    def retry_after(self) -> int:
+        """Через сколько секунд пул примерно разгребёт текущие задачи (для заголовка Retry-After)."""
+        drain = self.pending_cost * self._seconds_per_mp / max(1, self.workers)
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(drain)))
+
+    def expected_time(self, costs: List[float]) -> float:
+        """Оценка, через сколько секунд будут готовы задачи стоимостью costs, если поставить их сейчас."""
+        spread = (self.pending_cost + sum(costs)) / max(1, self.workers)
+        return max(spread, max(costs, default=0.0)) * self._seconds_per_mp
+
+    def admit(self, costs: List[float], deadline: Optional[float] = None) -> None:
+        """
+        Проверка приёма задач до постановки в пул: число задач, суммарная стоимость и дедлайн.
+        Бросает EngineBusy (с retry_after) или DeadlineExceeded — отказ быстрый, без обработки.
+
+        Несколько задач (пакет), которые вместе больше ёмкости или бюджета стоимости пула даже
+        в пустом пуле, — BatchTooLarge: повтор не поможет. Одна задача в пустой пул принимается
+        при любой стоимости (её размер уже ограничен бюджетом пикселей, max_megapixels); на пакеты
+        это исключение не распространяется.
+        """
+        total = sum(costs)
+        if len(costs) > 1 and (len(costs) > self.capacity or (self.max_queue_cost and total > self.max_queue_cost)):
+            raise BatchTooLarge(
+                f"Пакет из {len(costs)} задач ({total:.1f} МП) больше ёмкости пула "
+                f"({self.capacity} задач, {self.max_queue_cost:.0f} МП)"
+            )
+        if self.pending + len(costs) > self.capacity:
+            metrics.ENGINE_BUSY.inc()
+            raise EngineBusy(
+                f"Очередь обработки заполнена ({self.pending}+{len(costs)}/{self.capacity})", self.retry_after()
+            )
+        idle_single = len(costs) == 1 and not self.pending
+        if self.max_queue_cost and not idle_single and self.pending_cost + total > self.max_queue_cost:
+            metrics.ENGINE_BUSY.inc()
+            raise EngineBusy(
+                f"Очередь обработки заполнена по стоимости "
+                f"({self.pending_cost:.1f}+{total:.1f}/{self.max_queue_cost:.0f} МП)", self.retry_after()
+            )
+        if deadline is not None and time.time() + self.expected_time(costs) > deadline:
+            metrics.DEADLINES_EXCEEDED.inc(stage="admission")
+            raise DeadlineExceeded("Обработка не успеет завершиться до дедлайна запроса")
+
+    async def run(self, method: str, *args, cost: float = MIN_COST_MEGAPIXELS,
+                  deadline: Optional[float] = None, reservation: Optional[_Reservation] = None,
+                  **kwargs) -> Dict[str, Any]:
+        """
+        Выполняет метод FaceProcessor в пуле.
+
+        cost — оценка стоимости задачи (estimate_cost), deadline — time.time(), после которого
+        результат уже не нужен: задача, не начатая к этому моменту, не выполняется (DeadlineExceeded).
+        reservation — место, уже занятое за задачу принятого пакета (submit_many): admit() не
+        повторяется, стоимость берётся из резерва.
+        Отмена ожидания (клиент отключился) снимает с очереди ещё не начатую задачу.
+
+        Returns:
+            Dict с ключами 'result' (то, что вернул метод), 'queue_time' и 'process_time' (секунды),
+            'stats' (FaceProcessor.last_stats: этапы пайплайна, декодер, каскад)
+        """
+        reserved = reservation is not None and reservation.held
+        if reserved:
+            cost = reservation.cost
+        else:
+            self.admit([cost], deadline)
+        if self.mode == "process":
+            # mmap большой загрузки (app.uploads) в другой процесс не передаётся — только копией байтов
+            args = tuple(bytes(arg) if isinstance(arg, mmap.mmap) else arg for arg in args)
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(
+            _run_task, method, args, kwargs, time.time(), self.processor_kwargs, log.REQUEST_ID.get(), deadline
+        )
+        if reserved:
+            reservation.held = False  # место освободит завершение задачи, как у обычной
+        else:
+            self.pending += 1
+            self.pending_cost += cost
+        # Место в пуле освобождается, когда задача завершилась в исполнителе или снята с очереди,
+        # а не когда перестали ждать результат: отменённое ожидание не освобождает занятого исполнителя
+        future.add_done_callback(lambda _: _call_soon(loop, self._release, cost))
+        outcome = await asyncio.wrap_future(future)
+        if outcome.get("expired"):
+            metrics.DEADLINES_EXCEEDED.inc(stage="queue")
+            raise DeadlineExceeded("Дедлайн запроса истёк, пока задача ждала в очереди")
+        metrics.observe_outcome(method, outcome)
+        if outcome["process_time"] > 0:
+            observed = outcome["process_time"] / cost
+            self._seconds_per_mp += COST_EWMA_ALPHA * (observed - self._seconds_per_mp)
+        return outcome
+
+    def _release(self, cost: float) -> None:
+        self.pending -= 1
+        self.pending_cost = self.pending_cost - cost if self.pending else 0.0
+        if self._background_waiting:
+            asyncio.ensure_future(self._notify_idle())
+
+    async def _notify_idle(self) -> None:
+        async with self._idle:
+            self._idle.notify_all()
+
+    async def run_background(self, method: str, *args, **kwargs) -> Dict[str, Any]:
+        """
+        Как run(), но с низким приоритетом: задача отправляется в пул, только когда есть
+        свободный исполнитель. Интерактивные запросы не встают в очередь за фоновыми —
+        они ждут максимум уже выполняющиеся фоновые задачи.
+        """
+        if self._idle is None:
+            self._idle = asyncio.Condition()
+        self._background_waiting += 1
+        try:
+            async with self._idle:
+                await self._idle.wait_for(lambda: self.pending < self.workers)
+        finally:
+            self._background_waiting -= 1
+        # Между проверкой и постановкой нет await — другой фоновой задаче исполнитель не достанется
+        return await self.run(method, *args, **kwargs)
+
+    def cache_key(self, digest: str, **options) -> str:
+        """Ключ результата (и основа ETag): хэш содержимого (content_hash) + параметры процессора + options."""
+        return cache_key(digest, {**self.processor_kwargs, **options})
+
+    def image_id(self, digest: str) -> str:
+        """Id изображения для повторного кропа: содержимое + параметры, влияющие на детекцию."""
+        return cache_key(digest, {name: self.processor_kwargs.get(name) for name in GEOMETRY_PARAMS})
+
+    def render_key(self, image_id: str, **options) -> str:
+        """Ключ кэша (и ETag) повторного кропа."""
+        return cache_key(image_id, {"render": True, **self.processor_kwargs, **options})
+
+    async def process_image(self, image_bytes: bytes, filename: str, digest: Optional[str] = None,
+                            background: bool = False, deadline: Optional[float] = None,
+                            cost: Optional[float] = None, reservation: Optional[_Reservation] = None,
+                            **options) -> Dict[str, Any]:
+        """
+        options передаются в FaceProcessor.process_image (output_format, quality, sizes, max_faces).
+
+        При включённом кэше результат дополнительно содержит 'cache' ("hit" или "miss").
+        При включённом хранилище геометрии в result добавляется 'image_id' для render().
+        digest — заранее посчитанный content_hash(image_bytes), чтобы не хэшировать байты дважды.
+        background — низкий приоритет (run_background); такие изображения не попадают
+        в хранилище геометрии, чтобы большие пакеты не вытесняли интерактивные.
+        deadline, cost, reservation — см. run(); cost по умолчанию оценивается по заголовку.
+        Одновременные вызовы с тем же содержимым и options обрабатываются один раз (_coalesced).
+        """
+        run = self.run_background if background else self.run
+        digest = digest or content_hash(image_bytes)
+        key = self.cache_key(digest, **options)
+
+        if self.cache is not None:
+            found, result = await self.cache.lookup(key)
+            if found:
+                metrics.IMAGES.inc(outcome="ok" if result else "no-face", source="cache")
+                return self._with_image_id(
+                    {"result": result, "queue_time": 0.0, "process_time": 0.0, "cache": "hit"},
+                    digest, image_bytes, background,
+                )
+
+        async def compute() -> Dict[str, Any]:
+            outcome = await run(
+                "process_image", image_bytes, filename, **options,
+                cost=cost if cost is not None else self.estimate_cost(image_bytes, options.get("max_faces", 0)),
+                deadline=deadline, reservation=reservation,
+            )
+            if self.cache is not None:
+                if _cacheable(outcome):
+                    await self.cache.put(key, outcome["result"])
+                outcome["cache"] = "miss"
+            return outcome
+
+        outcome = await self._coalesced(key, compute, background, deadline)
+        return self._with_image_id(outcome, digest, image_bytes, background)
+
+    async def _coalesced(self, key: str, compute, background: bool = False,
+                         deadline: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Выполняет compute() один раз на ключ среди одновременных вызовов (повторы загрузки
+        одного фото): остальные ждут то же вычисление и получают копию результата с 'coalesced'.
+
+        Объединяются только вызовы одного приоритета (background), чтобы интерактивный запрос
+        не ждал в очереди фоновых. Присоединиться можно, если дедлайн вычисления не раньше своего
+        (иначе ждущий получил бы DeadlineExceeded чужого запроса) и вычисление не отменяется;
+        в остальных случаях запускается новое. Отмена ожидания (клиент отключился) отменяет
+        вычисление, только если его больше никто не ждёт.
+        """
+        flight_key = (key, background)
+        shared = self._in_flight.get(flight_key)
+        coalesced = shared is not None and shared.accepts(deadline)
+        if not coalesced:
+            shared = self._in_flight[flight_key] = _SharedComputation(asyncio.ensure_future(compute()), deadline)
+            shared.task.add_done_callback(
+                lambda _: self._in_flight.pop(flight_key) if self._in_flight.get(flight_key) is shared else None
+            )
+        else:
+            metrics.COALESCED.inc()
+        shared.waiters += 1
+        try:
+            outcome = await asyncio.shield(shared.task)
+        except asyncio.CancelledError:
+            if not shared.task.done():
+                shared.waiters -= 1
+                if not shared.waiters:
+                    shared.task.cancel()
+            raise
+        if not coalesced:
+            return outcome
+        result = outcome["result"]
+        metrics.IMAGES.inc(outcome="ok" if result else "no-face", source="coalesced")
+        return {**outcome, "coalesced": True}
+
+    def _with_image_id(self, outcome: Dict[str, Any], digest: str, image_bytes: bytes,
+                       background: bool) -> Dict[str, Any]:
+        result = outcome["result"]
+        if self.geometry is not None and not background and result and result.get("geometry") is not None:
+            image_id = self.image_id(digest)
+            self.geometry.put(image_id, image_bytes, result["geometry"])
+            outcome = {**outcome, "result": {**result, "image_id": image_id}}
+        return outcome
+
+    async def render(self, image_id: str, deadline: Optional[float] = None, **options) -> Optional[Dict[str, Any]]:
+        """
+        Повторный кроп по сохранённой геометрии (FaceProcessor.render_geometry) — без моделей.
+
+        options: output_format, quality, output_size, face_fill_ratio, crop_shift_up; deadline — см. run().
+        Returns:
+            Как run(), или None если image_id неизвестен (не обрабатывался или вытеснен)
+        """
+        stored = self.geometry.get(image_id) if self.geometry is not None else None
+        if stored is None:
+            return None
+        image_bytes, geometry = stored
+        cost = self.estimate_cost(image_bytes)
+        if self.cache is None:
+            return await self.run("render_geometry", image_bytes, geometry, **options, cost=cost, deadline=deadline)
+        key = self.render_key(image_id, **options)
+        found, result = await self.cache.lookup(key)
+        if found:
+            return {"result": result, "queue_time": 0.0, "process_time": 0.0, "cache": "hit"}
+        outcome = await self.run("render_geometry", image_bytes, geometry, **options, cost=cost, deadline=deadline)
+        if _cacheable(outcome):
+            await self.cache.put(key, outcome["result"])
+        return {**outcome, "cache": "miss"}
+
+    def submit_many(self, items: List[Tuple[bytes, str]], digests: Optional[List[str]] = None,
+                    deadline: Optional[float] = None, **options) -> List["asyncio.Task"]:
+        """
+        Сразу ставит несколько изображений в пул и возвращает задачи.
+
+        Каждая задача возвращает (индекс в items, результат run()), так что задачи
+        можно ждать в порядке завершения (asyncio.as_completed). Если изображения
+        не помещаются в очередь (по числу или стоимости) или не успеют к дедлайну,
+        бросает EngineBusy / DeadlineExceeded / BatchTooLarge до постановки любой из них.
+        Пакет принимается целиком: место в пуле резервируется сразу за все задачи и
+        освобождается по одной — по завершении задачи или, если задача не дошла до пула
+        (кэш, объединение с идущей, отмена), по её окончании.
+        digests — заранее посчитанные content_hash в порядке items.
+        """
+        costs = [self.estimate_cost(image_bytes, options.get("max_faces", 0)) for image_bytes, _ in items]
+        self.admit(costs, deadline)
+        # Между приёмом и резервом нет await — параллельный пакет не пройдёт ту же проверку
+        self.pending += len(costs)
+        self.pending_cost += sum(costs)
+
+        async def indexed(idx: int, image_bytes: bytes, filename: str) -> Tuple[int, Dict[str, Any]]:
+            digest = digests[idx] if digests else None
+            return idx, await self.process_image(
+                image_bytes, filename, digest=digest, deadline=deadline, cost=costs[idx],
+                reservation=reservations[idx], **options
+            )
+
+        def release_unused(reservation: _Reservation) -> None:
+            if reservation.held:
+                reservation.held = False
+                self._release(reservation.cost)
+
+        reservations = [_Reservation(cost) for cost in costs]
+        tasks = []
+        for idx, (image_bytes, filename) in enumerate(items):
+            task = asyncio.ensure_future(indexed(idx, image_bytes, filename))
+            # Колбэк, а не finally: задача, отменённая до первого шага, свой код не выполняет
+            task.add_done_callback(lambda _, reservation=reservations[idx]: release_unused(reservation))
+            tasks.append(task)
+        return tasks
+
+    async def process_many(self, items: List[Tuple[bytes, str]], digests: Optional[List[str]] = None,
+                           deadline: Optional[float] = None, **options) -> List[Dict[str, Any]]:
+        """
+        Обрабатывает несколько изображений параллельно (по одному на исполнителя).
+
+        Порядок результатов совпадает с порядком items, так что запрос из 5 файлов
+        занимает примерно столько, сколько самый медленный файл.
+        """
+        results = await asyncio.gather(*self.submit_many(items, digests=digests, deadline=deadline, **options))
+        return [outcome for _, outcome in results]
+
+    async def warmup(self) -> None:
+        """Поднимает всех исполнителей заранее, чтобы загрузка моделей не попала в первый запрос."""
+        loop = asyncio.get_running_loop()
+        # Задачи держат исполнителя занятым, поэтому каждая попадает в новый поток/процесс
+        await asyncio.gather(*(
+            loop.run_in_executor(self._executor, _warmup_task, 0.05) for _ in range(self.workers)
+        ))
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        if self.mode == "thread":
+            shutdown_render_pool()  # в режиме процессов потоки рендеринга завершаются вместе с ними
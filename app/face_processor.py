@@ -2,29 +2,254 @@ import cv2
 import numpy as np
 from PIL import Image
 import io
-from pathlib import Path
-from typing import Optional, Dict, Tuple
+import itertools
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Optional, Dict, List, Sequence, Tuple
 import mediapipe as mp
 
+from app.encoding import encode_image, media_type
+
+logger = logging.getLogger(__name__)
+
 # Регистрируем поддержку AVIF через pillow-avif-plugin
 try:
     import pillow_avif
-    print("✅ pillow-avif-plugin загружен, AVIF поддерживается")
+    logger.debug("pillow-avif-plugin загружен, AVIF поддерживается")
 except ImportError:
-    print("⚠️ pillow-avif-plugin не найден, AVIF может не работать")
+    logger.warning("pillow-avif-plugin не найден, AVIF может не работать")
 
 # Регистрируем поддержку HEIC/HEIF (часто с iPhone) через pillow-heif
 try:
     from pillow_heif import register_heif_opener
 
     register_heif_opener()
-    print("✅ pillow-heif загружен, HEIC/HEIF поддерживается")
+    logger.debug("pillow-heif загружен, HEIC/HEIF поддерживается")
 except Exception:
     # Не падаем, если pillow-heif не установлен
-    print("⚠️ pillow-heif не найден, HEIC/HEIF может не работать")
+    logger.warning("pillow-heif не найден, HEIC/HEIF может не работать")
+
+# Размер входа проверяет сам FaceProcessor до декодирования (max_megapixels, см. plan_decode) —
+# с учётом уменьшенного декодирования JPEG, который встроенная проверка PIL отвергла бы по полному
+# размеру ещё при чтении заголовка. Поэтому DecompressionBombError в PIL отключён, а бюджет
+# FaceProcessor по умолчанию конечный (DEFAULT_MAX_MEGAPIXELS); без лимита — только явный 0
+Image.MAX_IMAGE_PIXELS = None
+
+# EXIF-тег Orientation (0x0112)
+EXIF_ORIENTATION_TAG = 0x0112
+
+# Декодирование JPEG в уменьшенном масштабе (DCT scaling) — флаги OpenCV по коэффициенту
+REDUCED_DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+# Форматы, для которых уменьшенное декодирование действительно дешевле полного
+REDUCIBLE_FORMATS = ("JPEG", "MPO")
+
+# Индексы точек глаз MediaPipe Face Mesh (468 точек)
+LEFT_EYE_IDX = np.array([33, 7, 163, 144, 145, 153, 154, 155, 133, 173, 157, 158, 159, 160, 161, 246])
+RIGHT_EYE_IDX = np.array([362, 382, 381, 380, 374, 373, 390, 249, 263, 466, 388, 387, 386, 385, 384, 398])
+FACE_MESH_POINTS = 468
+
+# Сдвиг центра кропа вверх относительно центра лица (доля output_size): больше волос, меньше шеи
+CROP_SHIFT_UP = 0.08
+
+# Минимальная оценка стоимости изображения (мегапиксели декодирования): детекция, Face Mesh
+# и кодирование результата стоят не меньше, чем декодирование ~0.5 МП, даже для крошечного входа
+MIN_COST_MEGAPIXELS = 0.5
+# Бюджет декодирования по умолчанию (мегапиксели, как FACE_CROP_MAX_MEGAPIXELS)
+DEFAULT_MAX_MEGAPIXELS = 50.0
+
+# Режим всех лиц: точная модель дополнительно запускается по квадратным окнам со стороной короткой
+# стороны кадра вдоль длинной. Весь кадр модель видит в 192×192, и лица в широком групповом фото
+# для неё слишком мелкие. Окна перекрываются не меньше чем на TILE_OVERLAP, окна нужны,
+# если кадр длиннее TILE_MIN_ASPECT × короткая сторона
+TILE_OVERLAP = 0.25
+TILE_MIN_ASPECT = 1.3
+# Детекция в окне, bbox которой ближе этого (доля окна) к внутренней границе окна, обрезана им:
+# целиком это лицо есть в соседнем окне
+TILE_EDGE_MARGIN = 0.01
+# Потоки рендеринга и кодирования нескольких кропов одного изображения (OpenCV и кодеры отпускают GIL)
+RENDER_THREADS = 4
+
+# Один пул рендеринга на процесс — общий для всех FaceProcessor (по одному на исполнитель пула)
+_render_executor: Optional[ThreadPoolExecutor] = None
+_render_lock = threading.Lock()
+
+
+def render_pool() -> ThreadPoolExecutor:
+    """Потоки рендеринга и кодирования (RENDER_THREADS); создаются при первом использовании."""
+    global _render_executor
+    with _render_lock:
+        if _render_executor is None:
+            _render_executor = ThreadPoolExecutor(max_workers=RENDER_THREADS, thread_name_prefix="face-render")
+        return _render_executor
+
+
+def shutdown_render_pool() -> None:
+    """Останавливает потоки рендеринга (остановка сервиса); следующий render_pool() создаст новые."""
+    global _render_executor
+    with _render_lock:
+        executor, _render_executor = _render_executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+class _BufferReader(io.RawIOBase):
+    """Файловый объект поверх буфера (mmap, memoryview) без копии — io.BytesIO копирует всё, кроме bytes."""
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast("B")
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        chunk = self._view[self._pos:self._pos + len(b)]
+        b[:len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self) -> None:
+        self._view.release()
+        super().close()
+
+
+def image_stream(image_bytes) -> io.BufferedIOBase:
+    """Поток для PIL без копии входа: bytes — через BytesIO, mmap загрузки и другие буферы — через _BufferReader."""
+    if isinstance(image_bytes, bytes):
+        return io.BytesIO(image_bytes)
+    return io.BufferedReader(_BufferReader(image_bytes))
+
+
+def choose_reduction(format_name: Optional[str], width: int, height: int, max_dimension: int) -> int:
+    """
+    Коэффициент уменьшения при декодировании (1, 2, 4 или 8).
+    
+    Только для JPEG (DCT scaling в декодере). Выбирается наибольший коэффициент,
+    при котором длинная сторона остаётся не меньше max_dimension.
+    """
+    if format_name not in REDUCIBLE_FORMATS or not width or not height:
+        return 1
+    longest = max(width, height)
+    for factor in (8, 4, 2):
+        if longest / factor >= max_dimension:
+            return factor
+    return 1
+
+
+class ImageTooLarge(ValueError):
+    """Декодированное изображение не помещается в бюджет пикселей — декодирование не выполняется."""
+
+
+def plan_decode(format_name: Optional[str], width: int, height: int, max_dimension: int,
+                max_megapixels: float = 0.0) -> int:
+    """
+    Коэффициент уменьшения при декодировании (choose_reduction) с учётом бюджета пикселей.
+    
+    Если декодирование не помещается в max_megapixels (0 — без лимита), JPEG декодируется
+    сильнее уменьшенным (до 1/8), остальные форматы уменьшать при декодировании нельзя —
+    ImageTooLarge. Пиксели при этом не выделяются: хватает размера из заголовка.
+    """
+    return fit_budget(format_name, width, height, choose_reduction(format_name, width, height, max_dimension),
+                      max_megapixels)
+
+
+def fit_budget(format_name: Optional[str], width: int, height: int, reduction: int,
+               max_megapixels: float = 0.0) -> int:
+    """
+    Наименьший коэффициент уменьшения не меньше reduction, при котором декодирование помещается
+    в max_megapixels (0 — без лимита). Уменьшать при декодировании можно только JPEG;
+    если не помещается и 1/8 (или формат не уменьшается) — ImageTooLarge.
+    """
+    if not max_megapixels or not width or not height:
+        return reduction
+    megapixels = width * height / 1e6
+    factors = (1, 2, 4, 8) if format_name in REDUCIBLE_FORMATS else (1,)
+    for factor in factors:
+        if factor >= reduction and megapixels / factor ** 2 <= max_megapixels:
+            return factor
+    raise ImageTooLarge(f"{width}×{height} ({megapixels:.0f} МП) больше допустимого ({max_megapixels:g} МП)")
+
+
+def probe_header(image_bytes: bytes) -> Tuple[Optional[str], Tuple[int, int], int]:
+    """
+    Формат, размер (до EXIF-поворота) и EXIF Orientation из заголовка файла.
+    
+    Image.open ленивый — пиксели не декодируются. Если PIL не узнал формат,
+    возвращает (None, (0, 0), 1): декодирование всё равно попробует OpenCV.
+    """
+    try:
+        with Image.open(image_stream(image_bytes)) as pil_img:
+            return pil_img.format, pil_img.size, _exif_orientation(pil_img)
+    except Exception:
+        return None, (0, 0), 1
+
+
+def _exif_orientation(pil_img: Image.Image) -> int:
+    """EXIF Orientation (1-8) открытого PIL-изображения, 1 если тега нет."""
+    try:
+        if pil_img.format == "PNG":
+            # PngImageFile.getexif() без чанка eXIf до IDAT декодирует всё изображение,
+            # чтобы поискать его после данных. Берём только EXIF из заголовка
+            raw = pil_img.info.get("exif")
+            if not raw:
+                return 1
+            exif = Image.Exif()
+            exif.load(raw)
+        else:
+            exif = pil_img.getexif()
+        orientation = exif.get(EXIF_ORIENTATION_TAG, 1)
+        return orientation if orientation in range(1, 9) else 1
+    except Exception:
+        return 1
+
+
+def estimate_cost(image_bytes: bytes, detection_max_dimension: int = 1920,
+                  max_megapixels: float = DEFAULT_MAX_MEGAPIXELS,
+                  max_faces: int = 0) -> float:
+    """
+    Оценка стоимости обработки в мегапикселях декодирования — по заголовку, без пикселей.
+    
+    JPEG декодируется с уменьшением, поэтому считается уменьшенный размер (plan_decode).
+    Если заголовок не распознан, возвращает MIN_COST_MEGAPIXELS (OpenCV всё равно попробует
+    декодировать). Сверх бюджета max_megapixels — ImageTooLarge.
+    В режиме всех лиц (max_faces) каждое лицо сверх первого (Face Mesh, рендеринг, кодирование)
+    добавляет MIN_COST_MEGAPIXELS: число лиц до обработки неизвестно, считается по лимиту.
+    """
+    extra_faces = max(0, max_faces - 1) * MIN_COST_MEGAPIXELS
+    try:
+        with Image.open(image_stream(image_bytes)) as pil_img:
+            format_name, (width, height) = pil_img.format, pil_img.size
+    except Exception:
+        return MIN_COST_MEGAPIXELS + extra_faces
+    reduction = plan_decode(format_name, width, height, detection_max_dimension, max_megapixels)
+    return max(MIN_COST_MEGAPIXELS, width * height / reduction ** 2 / 1e6) + extra_faces
+
 
 class FaceProcessor:
-    def __init__(self, output_size: int = 512, face_fill_ratio: float = 0.5):
+    def __init__(self, output_size: int = 512, face_fill_ratio: float = 0.5,
+                 cascade_threshold: float = 0.75, detection_max_dimension: int = 1920,
+                 png_compression: int = 3, max_megapixels: float = DEFAULT_MAX_MEGAPIXELS,
+                 min_face_score: float = 0.5):
         """
         Инициализация процессора лиц.
         
@@ -33,9 +258,26 @@ class FaceProcessor:
             face_fill_ratio: Доля высоты лица от общей высоты изображения (0.5 = 50%, больше места для волос)
                             Меньшее значение = больше пространства вокруг лица (волосы, плечи)
                             Большее значение = лицо крупнее, меньше пространства вокруг
+            cascade_threshold: Если быстрая модель нашла лицо с confidence не ниже порога,
+                            дальнобойная модель (model_selection=1) не запускается
+            detection_max_dimension: Длинная сторона изображения для детекции (большие уменьшаются).
+                            JPEG при этом декодируется сразу в уменьшенном масштабе, а полное
+                            разрешение декодируется, только если его не хватает для кропа
+            png_compression: Уровень сжатия PNG (0-9) для результата
+            max_megapixels: Бюджет декодирования (мегапиксели, 0 — без лимита, явно). Проверяется по
+                            заголовку до декодирования: JPEG уменьшается сильнее, остальное
+                            сверх бюджета не декодируется (защита от decompression bomb)
+            min_face_score: Порог confidence детектора для лиц в режиме всех лиц (process_image(max_faces=...))
         """
         self.output_size = output_size
         self.face_fill_ratio = face_fill_ratio
+        self.cascade_threshold = cascade_threshold
+        self.detection_max_dimension = detection_max_dimension
+        self.png_compression = png_compression
+        self.max_megapixels = max_megapixels
+        self.min_face_score = min_face_score
+        # Статистика последнего вызова (этапы, декодер, каскад) — для метрик, см. _begin_stats
+        self.last_stats: Dict = {}
         
         # Инициализация MediaPipe Face Detection (CPU-оптимизированный, быстрый)
         self.mp_face_detection = mp.solutions.face_detection
@@ -47,6 +289,13 @@ class FaceProcessor:
             min_detection_confidence=0.5
         )
         
+        # Точная модель (model_selection=1) - лучше для полупрофиля, дальних и сложных углов.
+        # Создаётся один раз, запускается только если быстрая модель не справилась (каскад)
+        self.face_detection_long = self.mp_face_detection.FaceDetection(
+            model_selection=1,
+            min_detection_confidence=0.3  # Сниженный порог для лучшей детекции полупрофиля
+        )
+        
         # Отключаем refine_landmarks для ускорения (можно включить если нужна большая точность)
         self.face_mesh = self.mp_face_mesh.FaceMesh(
             static_image_mode=True,
@@ -57,16 +306,18 @@ class FaceProcessor:
         )
         
         # Предзагрузка моделей - создаем тестовое изображение для "прогрева"
-        print("FaceProcessor: предзагрузка моделей MediaPipe...")
         try:
             dummy_img = np.zeros((100, 100, 3), dtype=np.uint8)
             self.face_detection.process(dummy_img)
+            self.face_detection_long.process(dummy_img)
             self.face_mesh.process(dummy_img)
-            print("FaceProcessor initialized successfully (MediaPipe) - модели предзагружены")
+            logger.info("FaceProcessor: модели MediaPipe предзагружены")
         except Exception as e:
-            print(f"FaceProcessor initialized (MediaPipe) - предзагрузка пропущена: {e}")
+            logger.warning("FaceProcessor: предзагрузка моделей пропущена: %s", e)
     
-    def process_image(self, image_bytes: bytes, filename: str) -> Optional[Dict]:
+    def process_image(self, image_bytes: bytes, filename: str, output_format: str = "png",
+                      quality: Optional[int] = None, sizes: Optional[Sequence[int]] = None,
+                      max_faces: int = 0) -> Optional[Dict]:
         """
         Обрабатывает одно изображение: детектирует лицо, центрирует и обрезает.
         
@@ -78,80 +329,213 @@ class FaceProcessor:
         Args:
             image_bytes: Байты изображения
             filename: Имя файла (для метаданных)
+            output_format: Формат результата: png, jpeg, webp, avif (см. app.encoding)
+            quality: Качество 1-100 для форматов с потерями (None — по умолчанию для формата)
+            sizes: Несколько размеров результата за один проход (None — только output_size).
+                   Декодирование, детекция, Face Mesh и выравнивание выполняются один раз
+            max_faces: 0 — одно лучшее лицо. Больше 0 — все лица с confidence не ниже
+                   min_face_score (не больше max_faces самых уверенных) за одно декодирование
+                   и одну детекцию; кропы рендерятся параллельно
             
         Returns:
-            Dict с ключами 'image' (PIL Image) и 'filename', или None если лицо не найдено
+            Dict с ключами 'data' (закодированные байты), 'media_type' и 'geometry'
+            (см. analyze_image); имя файла результата выбирает вызывающий (по output_size
+            и формату). С sizes — ещё 'variants': [{'size', 'data'}] в порядке sizes,
+            'data' — первый из них. С max_faces вместо 'geometry' —
+            'faces': [{'face' (номер слева направо), 'score', 'bbox', 'data', 'variants' (с sizes)}],
+            'data' — первого лица. None если лицо не найдено или изображение не обработано
+            (причина — last_stats['outcome']: no-face, too-large, error)
         """
+        self._begin_stats()
         try:
-            # Сначала пробуем через OpenCV (быстрее для JPEG/PNG/BMP/TIFF)
-            nparr = np.frombuffer(image_bytes, np.uint8)
-            img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-            
-            # Если OpenCV не смог декодировать (AVIF, WebP, HEIC/HEIF и др.), пробуем через PIL
-            if img is None:
-                try:
-                    print(f"OpenCV не смог декодировать {filename}, пробуем через PIL...")
-                    # Проверяем поддержку AVIF
-                    try:
-                        from PIL import features
-                        if features.check('avif'):
-                            print(f"✅ PIL поддерживает AVIF")
-                        else:
-                            print(f"⚠️ PIL не поддерживает AVIF (возможно нужен pillow-avif-plugin)")
-                    except:
-                        print(f"⚠️ Не удалось проверить поддержку AVIF в PIL")
-                    
-                    pil_img = Image.open(io.BytesIO(image_bytes))
-                    format_name = pil_img.format or "UNKNOWN"
-                    print(f"✅ PIL успешно открыл {filename}, формат: {format_name}, размер: {pil_img.size}, режим: {pil_img.mode}")
-                    
-                    # Поддерживаемые форматы через PIL:
-                    # - AVIF (если установлен pillow-avif-plugin)
-                    # - HEIC/HEIF (если установлен pillow-heif)
-                    # - WebP (встроенная поддержка в Pillow)
-                    # - GIF, ICO, BMP, TIFF и другие стандартные форматы
-                    
-                    # Конвертируем в RGB если нужно
-                    if pil_img.mode != 'RGB':
-                        pil_img = pil_img.convert('RGB')
-                    
-                    # Конвертируем PIL в numpy array (RGB)
-                    img_rgb = np.array(pil_img)
-                    print(f"PIL -> numpy: размер={img_rgb.shape}, тип={img_rgb.dtype}, min={img_rgb.min()}, max={img_rgb.max()}")
-                    
-                    # Конвертируем RGB в BGR для OpenCV
-                    img = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR)
-                    print(f"✅ Изображение {filename} успешно декодировано через PIL -> OpenCV")
-                except Exception as e:
-                    print(f"❌ Ошибка декодирования изображения {filename} через PIL: {type(e).__name__}: {e}")
-                    import traceback
-                    print(traceback.format_exc())
-                    return None
-            
-            # Проверка: пустое или нулевой размер
-            if img is None or img.size == 0:
-                print(f"❌ Изображение {filename}: пустое или не декодировалось")
-                return None
-            h, w = img.shape[:2]
-            if h < 1 or w < 1:
-                print(f"❌ Изображение {filename}: некорректный размер {w}x{h}")
+            analysis = self._analyze(image_bytes, filename, max_faces, max(sizes or [self.output_size]))
+            if analysis is None:
+                self.last_stats['outcome'] = 'no-face'
                 return None
-            # Всегда 3 канала BGR для дальнейшей обработки (grayscale -> BGR)
-            if len(img.shape) == 2:
-                img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+            img, geometries = analysis
+            
+            # Поворот, масштаб, кроп и белые поля — одним warpAffine на лицо; кодирование в память
+            rendered = self._render_faces(img, geometries, sizes or [self.output_size], output_format, quality)
             
-            # Исправление ориентации по EXIF
-            img = self._fix_orientation(img, image_bytes)
+            def crop_fields(variants: List[Dict]) -> Dict:
+                return {'data': variants[0]['data'], 'variants': variants} if sizes else {'data': variants[0]['data']}
             
-            # Сохраняем оригинальное изображение для финального кропа
-            original_img = img.copy()
-            original_h, original_w = img.shape[:2]
+            result = {'media_type': media_type(output_format)}
+            if max_faces:
+                faces = [
+                    {'face': idx, 'score': geometry['score'], 'bbox': geometry['bbox'], **crop_fields(variants)}
+                    for idx, (geometry, variants) in enumerate(zip(geometries, rendered))
+                ]
+                result.update(data=faces[0]['data'], faces=faces)
+            else:
+                result.update(crop_fields(rendered[0]), geometry=geometries[0])
+            self.last_stats['outcome'] = 'ok'
+            return result
+        
+        except ImageTooLarge as e:
+            logger.info("Изображение %r не обрабатывается: %s", filename, e)
+            self.last_stats['outcome'] = 'too-large'
+            return None
+        except Exception as e:
+            logger.exception("Ошибка обработки изображения %r", filename)
+            self.last_stats['outcome'] = 'error'
+            return None
+    
+    def analyze_image(self, image_bytes: bytes, filename: str) -> Optional[Dict]:
+        """
+        Находит лицо без рендеринга: декодирование, детекция и Face Mesh.
+        
+        Returns:
+            Геометрия лица в координатах полноразмерного изображения после EXIF-поворота
+            (None если лицо не найдено):
+            'image_size' (w, h), 'orientation', 'bbox' (x, y, w, h), 'score' (confidence детектора),
+            'landmarks' (N×2 float32), 'face_center' (x, y), 'face_size', 'rotation_angle' (градусы).
+            По ней render_geometry строит кроп с любыми параметрами без запуска моделей
+        """
+        self._begin_stats()
+        try:
+            analysis = self._analyze(image_bytes, filename)
+        except ImageTooLarge as e:
+            logger.info("Изображение %r не обрабатывается: %s", filename, e)
+            self.last_stats['outcome'] = 'too-large'
+            return None
+        except Exception as e:
+            logger.exception("Ошибка анализа изображения %r", filename)
+            self.last_stats['outcome'] = 'error'
+            return None
+        self.last_stats['outcome'] = 'ok' if analysis else 'no-face'
+        return analysis[1][0] if analysis else None
+    
+    def render_geometry(self, image_bytes: bytes, geometry: Dict, output_format: str = "png",
+                        quality: Optional[int] = None, output_size: Optional[int] = None,
+                        face_fill_ratio: Optional[float] = None,
+                        crop_shift_up: Optional[float] = None) -> Optional[Dict]:
+        """
+        Строит кроп по сохранённой геометрии (из analyze_image/process_image) — без детекции и Face Mesh.
+        
+        Остаются только декодирование (для JPEG — в наименьшем масштабе, которого хватает
+        для кропа), один warpAffine и кодирование. Бюджет пикселей (max_megapixels) проверяется
+        по заголовку так же, как при первой обработке.
+        
+        Args:
+            output_size, face_fill_ratio: None — значения процессора
+            crop_shift_up: Сдвиг центра кропа вверх в долях output_size (None — CROP_SHIFT_UP)
             
-            # Оптимизация: уменьшаем размер больших изображений для ускорения обработки MediaPipe
-            # MediaPipe хорошо работает с изображениями до 1920px, большие можно уменьшить
-            resize_scale = 1.0
-            max_dimension = 1920
-            h, w = img.shape[:2]
+        Returns:
+            Dict с ключами 'data' и 'media_type', или None если изображение не декодировалось
+            или больше бюджета пикселей (last_stats['outcome']: error, too-large)
+        """
+        output_size = output_size or self.output_size
+        face_fill_ratio = face_fill_ratio or self.face_fill_ratio
+        self._begin_stats()
+        try:
+            with self._stage('probe'):
+                format_name, (src_w, src_h), _ = probe_header(image_bytes)
+            self.last_stats['format'] = format_name
+            reduction = 1
+            if format_name in REDUCIBLE_FORMATS:
+                # Наибольшее уменьшение, при котором лицо не придётся увеличивать
+                for factor in (8, 4, 2):
+                    if geometry['face_size'] / factor >= output_size * face_fill_ratio:
+                        reduction = factor
+                        break
+            # Не больше бюджета пикселей: JPEG — сильнее уменьшенным (лицо тогда увеличивается), иначе 413
+            reduction = fit_budget(format_name, src_w, src_h, reduction, self.max_megapixels)
+            if src_w and src_h:
+                self.last_stats['megapixels'] = src_w * src_h / 1e6
+                self.last_stats['decoded_megapixels'] = src_w * src_h / reduction ** 2 / 1e6
+            with self._stage('decode'):
+                img = self._decode_image(image_bytes, "render", geometry['orientation'], reduction)
+            if img is None:
+                self.last_stats['outcome'] = 'error'
+                return None
+            with self._stage('render'):
+                crop = self._render_geometry(img, geometry, output_size, face_fill_ratio, crop_shift_up)
+            with self._stage('encode'):
+                data = encode_image(crop, output_format, quality, self.png_compression)
+            self.last_stats['outcome'] = 'ok'
+            return {'data': data, 'media_type': media_type(output_format)}
+        except ImageTooLarge as e:
+            logger.info("Повторный кроп не выполняется: %s", e)
+            self.last_stats['outcome'] = 'too-large'
+            return None
+        except Exception as e:
+            logger.exception("Ошибка кропа по сохранённой геометрии")
+            self.last_stats['outcome'] = 'error'
+            return None
+    
+    def _begin_stats(self) -> None:
+        """
+        Сбрасывает статистику вызова. После process_image/analyze_image/render_geometry в last_stats:
+        'stages' (этап -> секунды), 'format' и 'megapixels' (по заголовку), 'decoded_megapixels'
+        (с учётом уменьшенного декодирования), 'decoders' (opencv/pil), 'cascade_escalated',
+        'full_decode', 'faces' (в режиме всех лиц — сколько лиц не ниже min_face_score, до лимита),
+        'outcome' (ok / no-face / too-large / error).
+        У каждого исполнителя свой FaceProcessor, так что статистика не смешивается между задачами.
+        """
+        self.last_stats = {
+            'stages': {}, 'format': None, 'megapixels': None, 'decoded_megapixels': None, 'decoders': [],
+            'cascade_escalated': False, 'full_decode': False, 'faces': None, 'outcome': None,
+        }
+    
+    @contextmanager
+    def _stage(self, name: str):
+        """Замеряет этап пайплайна (повторные вызовы этапа суммируются)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            stages = self.last_stats.setdefault('stages', {})
+            stages[name] = stages.get(name, 0.0) + time.perf_counter() - started
+    
+    def _analyze(self, image_bytes: bytes, filename: str, max_faces: int = 0,
+                 render_size: int = 0) -> Optional[Tuple[np.ndarray, List[Dict]]]:
+        """
+        Декодирование, детекция и Face Mesh.
+        
+        max_faces: 0 — одно лучшее лицо, иначе все лица (см. _select_faces)
+        render_size: наибольший размер кропа, который будет рендериться (0 — output_size);
+            по нему выбирается масштаб декодирования и решается, нужно ли полное разрешение
+        
+        Returns:
+            (изображение для рендеринга, геометрии лиц) или None. Изображение может быть
+            уменьшенным (DCT scaling), если его разрешения хватает для кропа; геометрия
+            всегда в координатах полного разрешения
+        """
+        # Дешёвая проба заголовка: формат, размер и EXIF-ориентация без декодирования пикселей
+        with self._stage('probe'):
+            format_name, (src_w, src_h), orientation = probe_header(image_bytes)
+        self.last_stats['format'] = format_name
+        if src_w and src_h:
+            self.last_stats['megapixels'] = src_w * src_h / 1e6
+        
+        # JPEG декодируем сразу в уменьшенном масштабе (DCT scaling 1/2, 1/4, 1/8) —
+        # это в разы быстрее полного декодирования с последующим resize.
+        # Сверх бюджета пикселей — ImageTooLarge до выделения памяти под пиксели
+        render_size = render_size or self.output_size
+        reduction = plan_decode(format_name, src_w, src_h, max(self.detection_max_dimension, render_size),
+                                self.max_megapixels)
+        if src_w and src_h:
+            self.last_stats['decoded_megapixels'] = src_w * src_h / reduction ** 2 / 1e6
+        with self._stage('decode'):
+            img = self._decode_image(image_bytes, filename, orientation, reduction)
+        if img is None:
+            return None
+        if reduction > 1:
+            logger.debug("Изображение %r: %dx%d декодировано в масштабе 1/%d -> %dx%d",
+                         filename, src_w, src_h, reduction, img.shape[1], img.shape[0])
+        
+        # Сохраняем изображение для финального кропа (дальше оно не изменяется).
+        # При reduction > 1 это уменьшенная версия; полное разрешение декодируется ниже, только если нужно
+        original_img = img
+        original_h, original_w = img.shape[:2]
+        
+        # Оптимизация: уменьшаем размер больших изображений для ускорения обработки MediaPipe
+        # MediaPipe хорошо работает с изображениями до 1920px, большие можно уменьшить
+        resize_scale = 1.0
+        max_dimension = self.detection_max_dimension
+        h, w = img.shape[:2]
+        with self._stage('resize'):
             if max(h, w) > max_dimension:
                 resize_scale = max_dimension / max(h, w)
                 new_w = int(w * resize_scale)
@@ -162,234 +546,300 @@ class FaceProcessor:
             
             # Конвертация BGR в RGB для MediaPipe
             img_rgb = cv2.cvtColor(resized_img, cv2.COLOR_BGR2RGB)
-            print(f"Изображение {filename} подготовлено для детекции: размер={img_rgb.shape}, тип={img_rgb.dtype}")
-            
-            # Улучшенная детекция: пробуем обе модели MediaPipe для лучшего результата
-            # Особенно важно для полупрофиля и сложных углов
-            all_detections = []
-            
-            # 1. Быстрая модель (model_selection=0) - хорошо для фронтальных лиц
-            fast_results = self.face_detection.process(img_rgb)
-            if fast_results.detections:
-                print(f"Быстрая модель для {filename}: найдено лиц = {len(fast_results.detections)}")
-                all_detections.extend(fast_results.detections)
-            
-            # 2. Точная модель (model_selection=1) - лучше для полупрофиля, дальних и сложных углов
-            accurate_detector = self.mp_face_detection.FaceDetection(
-                model_selection=1,  # Более точная модель для дальних/сложных лиц и полупрофиля
-                min_detection_confidence=0.3  # Сниженный порог для лучшей детекции полупрофиля
-            )
-            accurate_results = accurate_detector.process(img_rgb)
-            if accurate_results.detections:
-                print(f"Точная модель для {filename}: найдено лиц = {len(accurate_results.detections)}")
-                all_detections.extend(accurate_results.detections)
-            accurate_detector.close()
-            
-            if not all_detections:
-                print(f"❌ Лицо не найдено на изображении {filename} (размер: {img_rgb.shape})")
-                return None
-            
-            # Убираем дубликаты (если обе модели нашли одно и то же лицо)
-            # Выбираем лучшее лицо из всех найденных
-            print(f"Всего найдено уникальных лиц: {len(all_detections)}")
+        
+        # Каскадная детекция: быстрая модель, а точная — только если быстрая не справилась
+        # (в режиме всех лиц точная запускается всегда, в том числе по окнам кадра)
+        all_detections = self._detect_faces(img_rgb, filename, all_faces=max_faces > 0)
+        
+        if not all_detections:
+            logger.debug("Лицо не найдено на изображении %r (размер для детекции: %s)", filename, img_rgb.shape)
+            return None
+        
+        if max_faces:
+            detections = self._select_faces(all_detections, max_faces)
+        else:
+            # Выбираем лучшее лицо из всех найденных (дубликаты уже объединены)
             best_detection = self._select_best_face_mediapipe(all_detections, resized_img.shape)
-            
-            if best_detection is None:
-                print(f"Не удалось выбрать лучшее лицо из {len(all_detections)} найденных для {filename}")
-                return None
-            
-            # Получение landmarks через Face Mesh для более точного выравнивания
+            detections = [best_detection] if best_detection is not None else []
+        
+        if not detections:
+            logger.debug("Не удалось выбрать лицо из %d найденных для %r", len(all_detections), filename)
+            return None
+        
+        resized_h, resized_w = resized_img.shape[:2]
+        faces = []
+        for detection in detections:
+            bbox = detection.location_data.relative_bounding_box
+            # Получение landmarks через Face Mesh для более точного выравнивания.
+            # Mesh запускается только на области вокруг выбранного лица: лицо во входе модели крупнее,
+            # а выбирать среди нескольких лиц в кадре больше не нужно
             # Важно для полупрофиля - Face Mesh может найти landmarks даже когда детекция менее уверена
-            mesh_results = self.face_mesh.process(img_rgb)
-            landmarks = None
-            
-            # Пробуем найти landmarks для лучшего найденного лица
-            if mesh_results.multi_face_landmarks:
-                # Если найдено несколько лиц, выбираем то, которое ближе к best_detection
-                best_landmarks_idx = 0
-                if len(mesh_results.multi_face_landmarks) > 1:
-                    # Находим ближайшее лицо по bbox
-                    best_bbox = best_detection.location_data.relative_bounding_box
-                    min_distance = float('inf')
-                    for idx, face_landmarks in enumerate(mesh_results.multi_face_landmarks):
-                        landmarks_array = self._convert_landmarks_to_array(face_landmarks, resized_img.shape)
-                        if len(landmarks_array) > 0:
-                            # Центр landmarks
-                            lm_center = np.mean(landmarks_array, axis=0)
-                            # Центр bbox
-                            bbox_center = np.array([
-                                (best_bbox.xmin + best_bbox.width / 2) * resized_img.shape[1],
-                                (best_bbox.ymin + best_bbox.height / 2) * resized_img.shape[0]
-                            ])
-                            distance = np.linalg.norm(lm_center - bbox_center)
-                            if distance < min_distance:
-                                min_distance = distance
-                                best_landmarks_idx = idx
-                
-                landmarks = self._convert_landmarks_to_array(
-                    mesh_results.multi_face_landmarks[best_landmarks_idx], 
-                    resized_img.shape
-                )
-                # Масштабируем landmarks обратно к оригинальному размеру
-                if resize_scale < 1.0:
-                    landmarks = (landmarks / resize_scale).astype(np.int32)
-                print(f"✅ Найдены landmarks для {filename}: {len(landmarks)} точек")
+            with self._stage('mesh'):
+                landmarks = self._mesh_landmarks(img_rgb, detection)
+            if (landmarks is not None and max_faces
+                    and not self._bbox_contains(bbox, resized_w, resized_h, landmarks.mean(axis=0))):
+                # В групповом фото в область вокруг лица попадают соседи, и Face Mesh мог найти чужое лицо
+                logger.debug("Face Mesh для %r нашёл лицо вне bbox детекции, используем bbox", filename)
+                landmarks = None
             
             # Если landmarks не получены, используем bbox из detection
             if landmarks is None:
-                bbox = best_detection.location_data.relative_bounding_box
-                resized_h, resized_w = resized_img.shape[:2]
                 landmarks = self._bbox_to_landmarks(bbox, resized_w, resized_h)
-                # Масштабируем landmarks обратно к оригинальному размеру
-                if resize_scale < 1.0:
-                    landmarks = (landmarks / resize_scale).astype(np.int32)
+            # Масштабируем landmarks обратно к оригинальному размеру
+            if resize_scale < 1.0:
+                landmarks /= resize_scale
             
             # Получение bbox из detection и масштабирование к оригинальному размеру
-            bbox = best_detection.location_data.relative_bounding_box
-            resized_h, resized_w = resized_img.shape[:2]
             face_x = int(bbox.xmin * original_w)
             face_y = int(bbox.ymin * original_h)
             face_width = int(bbox.width * original_w)
             face_height = int(bbox.height * original_h)
             
-            # Используем оригинальное изображение для дальнейшей обработки
-            img = original_img
-            img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-            h, w = img.shape[:2]
-            
             # Вычисление центра лица и размера
             # Используем landmarks для более точного центрирования, если доступны
-            if landmarks is not None and len(landmarks) > 10:
-                # Используем центр всех landmarks для более точного позиционирования
-                face_center = np.mean(landmarks, axis=0)
-                face_center_x = int(face_center[0])
-                face_center_y = int(face_center[1])
-                
-                # Размер лица вычисляем из landmarks (расстояние между крайними точками)
-                x_min, y_min = landmarks.min(axis=0)
-                x_max, y_max = landmarks.max(axis=0)
-                face_width_landmarks = x_max - x_min
-                face_height_landmarks = y_max - y_min
-                face_size = max(face_width_landmarks, face_height_landmarks) * 1.3  # Margin для лучшего кропа
+            if len(landmarks) > 10:
+                # Центр всех landmarks для более точного позиционирования,
+                # размер — по крайним точкам (+ margin для лучшего кропа)
+                face_center, face_size = self._calculate_face_metrics(landmarks, margin=1.3)
+                center = (int(face_center[0]), int(face_center[1]))
             else:
                 # Fallback на bbox
-                face_center_x = face_x + face_width // 2
-                face_center_y = face_y + face_height // 2
+                center = (face_x + face_width // 2, face_y + face_height // 2)
                 face_size = max(face_width, face_height) * 1.2
+            faces.append({
+                'score': float(detection.score[0]), 'landmarks': landmarks, 'center': center,
+                'size': face_size, 'bbox': (face_x, face_y, face_width, face_height),
+            })
+        
+        # Используем оригинальное изображение для дальнейшей обработки
+        img = original_img
+        
+        # Масштаб от декодированного изображения к полному разрешению (после EXIF-поворота)
+        to_full = 1.0
+        if reduction > 1:
+            full_w = src_h if orientation in (5, 6, 7, 8) else src_w
+            to_full = full_w / img.shape[1]
+        
+        # Уменьшенного декодирования не хватит для кропа без увеличения — декодируем полное разрешение
+        # (если оно помещается в бюджет пикселей); одно на все лица
+        full_fits = not self.max_megapixels or src_w * src_h / 1e6 <= self.max_megapixels
+        if reduction > 1 and full_fits and any(render_size * self.face_fill_ratio > face['size'] for face in faces):
+            with self._stage('decode'):
+                full_img = self._decode_image(image_bytes, filename, orientation)
+            self.last_stats['full_decode'] = True
+            if full_img is not None:
+                ratio = full_img.shape[1] / img.shape[1]
+                logger.debug("Изображение %r: лицо мелкое для масштаба 1/%d, декодируем полное разрешение",
+                             filename, reduction)
+                img = full_img
+                to_full = 1.0
+                for face in faces:
+                    face['center'] = tuple(int(v * ratio) for v in face['center'])
+                    face['size'] = face['size'] * ratio
+                    face['landmarks'] *= ratio
+                    face['bbox'] = tuple(int(v * ratio) for v in face['bbox'])
+        
+        # Проверка минимального размера лица: увеличивать больше чем в 3 раза нет смысла (плохое качество).
+        # Само увеличение отдельно не делается — оно входит в общий масштаб при рендеринге
+        min_face_size = 40
+        h, w = img.shape[:2]
+        geometries = []
+        for face in faces:
+            if face['size'] < min_face_size and min_face_size / face['size'] > 3.0:
+                continue
             
-            # Проверка минимального размера лица
-            min_face_size = 40
-            if face_size < min_face_size:
-                # Попытка увеличить масштаб
-                upscale_factor = min_face_size / face_size
-                if upscale_factor > 3.0:  # Слишком большое увеличение = плохое качество
-                    return None
-                img_rgb = cv2.resize(img_rgb, None, fx=upscale_factor, fy=upscale_factor)
-                img = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR)
-                h, w = img.shape[:2]
-                face_center_x = int(face_center_x * upscale_factor)
-                face_center_y = int(face_center_y * upscale_factor)
-                face_size = face_size * upscale_factor
-                # Пересчитываем landmarks если они есть
-                if landmarks is not None:
-                    landmarks = (landmarks * upscale_factor).astype(np.int32)
-            
-            # Выравнивание по глазам (если есть landmarks)
-            aligned_img, rotation_angle = self._align_face(img, landmarks)
-            
-            # Пересчет позиции после выравнивания (если было выравнивание)
-            if rotation_angle != 0 and landmarks is not None and len(landmarks) > 10:
-                # Пересчитываем центр лица из landmarks после выравнивания
-                face_center = np.mean(landmarks, axis=0)
-                # Применяем поворот к центру
-                center = (img.shape[1] // 2, img.shape[0] // 2)
-                angle_rad = np.radians(rotation_angle)
-                cos_a = np.cos(angle_rad)
-                sin_a = np.sin(angle_rad)
-                dx = face_center[0] - center[0]
-                dy = face_center[1] - center[1]
-                face_center_x = int(center[0] + dx * cos_a - dy * sin_a)
-                face_center_y = int(center[1] + dx * sin_a + dy * cos_a)
-            
-            # Масштаб по face_fill_ratio (какой долей кадра занимает лицо)
-            target_face_height = self.output_size * self.face_fill_ratio
-            scale = target_face_height / face_size
-            
-            # Минимальный масштаб, при котором квадрат output_size×output_size помещается
-            # в кадр без белых полей. Учитываем сдвиг кропа вверх (больше причёски).
-            h_img, w_img = img.shape[0], img.shape[1]
-            half = self.output_size // 2
-            crop_shift_up = int(0.08 * self.output_size)  # центр кропа выше лица — больше волос в кадре
-            scale_min = 0.0
-            if face_center_x > 1:
-                scale_min = max(scale_min, (half + 1) / face_center_x)
-            if face_center_y > 1:
-                scale_min = max(scale_min, (half + 1 + crop_shift_up) / face_center_y)  # сверху нужен запас под волосы
-            if w_img - face_center_x > 1:
-                scale_min = max(scale_min, (half + 1) / (w_img - face_center_x))
-            if h_img - face_center_y > 1:
-                scale_min = max(scale_min, (half + 1 - crop_shift_up) / (h_img - face_center_y))  # снизу режем больше
-            if w_img > 0:
-                scale_min = max(scale_min, self.output_size / w_img)
-            if h_img > 0:
-                scale_min = max(scale_min, self.output_size / h_img)
-            scale = max(scale, scale_min)
-            
-            # Новый размер изображения после масштабирования
-            new_width = int(img.shape[1] * scale)
-            new_height = int(img.shape[0] * scale)
-            scaled_img = cv2.resize(aligned_img, (new_width, new_height))
-            
-            # Новые координаты центра лица после масштабирования
-            scaled_center_x = int(face_center_x * scale)
-            scaled_center_y = int(face_center_y * scale)
-            
-            # Центр кропа выше центра лица — в кадре больше причёски, меньше шеи
-            crop_center_y = scaled_center_y - crop_shift_up
-            
-            # Кроп квадрата вокруг смещённого центра (больше волос, меньше шеи)
-            half_size = self.output_size // 2
-            x1 = scaled_center_x - half_size
-            y1 = crop_center_y - half_size
-            x2 = scaled_center_x + half_size
-            y2 = crop_center_y + half_size
-            
-            # Кроп без белых полей (если вылезает за край — уже учтено через scale_min)
-            padded_img = self._crop_with_padding(scaled_img, x1, y1, x2, y2)
-            
-            # Конвертация в PIL Image
-            rgb_img = cv2.cvtColor(padded_img, cv2.COLOR_BGR2RGB)
-            pil_image = Image.fromarray(rgb_img)
+            # Выравнивание по глазам (если есть landmarks): угол поворота вокруг центра кадра
+            with self._stage('align'):
+                rotation_angle = self._align_face(face['landmarks'], img.shape)
             
-            return {
-                'image': pil_image,
-                'filename': self._get_output_filename(filename)
-            }
+            geometries.append({
+                'image_size': (round(w * to_full), round(h * to_full)),
+                'orientation': orientation,
+                'bbox': tuple(v * to_full for v in face['bbox']),
+                'score': face['score'],
+                'landmarks': face['landmarks'] * np.float32(to_full),
+                'face_center': (face['center'][0] * to_full, face['center'][1] * to_full),
+                'face_size': face['size'] * to_full,
+                'rotation_angle': float(rotation_angle),
+            })
+        return (img, geometries) if geometries else None
+    
+    def _detect_faces(self, img_rgb: np.ndarray, filename: str, all_faces: bool = False) -> list:
+        """
+        Каскадная детекция лиц.
         
-        except Exception as e:
-            print(f"Error processing image {filename}: {str(e)}")
-            return None
+        1. Быстрая модель (model_selection=0) - хорошо для фронтальных лиц
+        2. Точная модель (model_selection=1) - только если быстрая ничего не нашла
+           или её лучший confidence ниже cascade_threshold (полупрофиль, дальние лица)
+        
+        all_faces — нужны все лица, а не одно уверенное: точная модель запускается всегда,
+        на широком кадре ещё и по окнам (_detect_tiles) — дальние лица группового фото
+        находит только она.
+        Дубликаты (одно и то же лицо от обеих моделей) объединяются.
+        """
+        detections = []
+        with self._stage('detect_fast'):
+            fast_results = self.face_detection.process(img_rgb)
+        if fast_results.detections:
+            detections.extend(fast_results.detections)
+        
+        best_fast_score = max((d.score[0] for d in detections), default=0.0)
+        if not all_faces:
+            if best_fast_score >= self.cascade_threshold:
+                return detections
+            logger.debug("Быстрая модель для %r: confidence=%.2f < %s, запускаем точную модель",
+                         filename, best_fast_score, self.cascade_threshold)
+            self.last_stats['cascade_escalated'] = True
+        with self._stage('detect_long'):
+            accurate_results = self.face_detection_long.process(img_rgb)
+            if accurate_results.detections:
+                detections.extend(accurate_results.detections)
+            if all_faces:
+                detections.extend(self._detect_tiles(img_rgb))
+        
+        return self._merge_detections(detections)
     
-    def _fix_orientation(self, img: np.ndarray, image_bytes: bytes) -> np.ndarray:
-        """Исправляет ориентацию изображения по EXIF данным."""
-        try:
-            pil_img = Image.open(io.BytesIO(image_bytes))
+    def _detect_tiles(self, img_rgb: np.ndarray) -> list:
+        """
+        Точная модель по квадратным окнам со стороной короткой стороны кадра, вдоль длинной
+        (перекрытие не меньше TILE_OVERLAP): в окне лица в 1.5–3 раза крупнее, чем во всём кадре.
+        Детекции, обрезанные внутренней границей окна, отбрасываются — лицо целиком есть в соседнем.
+        
+        Returns:
+            Детекции с bbox относительно всего img_rgb (пустой список для кадра, близкого к квадрату)
+        """
+        h, w = img_rgb.shape[:2]
+        side, length = min(h, w), max(h, w)
+        if length < side * TILE_MIN_ASPECT:
+            return []
+        count = math.ceil((length - side) / (side * (1 - TILE_OVERLAP))) + 1
+        detections = []
+        for i in range(count):
+            start = round(i * (length - side) / (count - 1))
+            x0, y0 = (start, 0) if w >= h else (0, start)
+            tile = np.ascontiguousarray(img_rgb[y0:y0 + side, x0:x0 + side])
+            results = self.face_detection_long.process(tile)
+            for detection in results.detections or []:
+                bbox = detection.location_data.relative_bounding_box
+                if ((x0 > 0 and bbox.xmin < TILE_EDGE_MARGIN)
+                        or (y0 > 0 and bbox.ymin < TILE_EDGE_MARGIN)
+                        or (x0 + side < w and bbox.xmin + bbox.width > 1 - TILE_EDGE_MARGIN)
+                        or (y0 + side < h and bbox.ymin + bbox.height > 1 - TILE_EDGE_MARGIN)):
+                    continue
+                # Копия детекции в координатах всего кадра (результаты графа MediaPipe не изменяем)
+                shifted = type(detection)()
+                shifted.CopyFrom(detection)
+                location = shifted.location_data
+                box = location.relative_bounding_box
+                box.xmin, box.ymin = (x0 + bbox.xmin * side) / w, (y0 + bbox.ymin * side) / h
+                box.width, box.height = bbox.width * side / w, bbox.height * side / h
+                for keypoint in location.relative_keypoints:
+                    keypoint.x, keypoint.y = (x0 + keypoint.x * side) / w, (y0 + keypoint.y * side) / h
+                detections.append(shifted)
+        return detections
+    
+    def _merge_detections(self, detections, iou_threshold: float = 0.5) -> list:
+        """Убирает дубликаты: из пересекающихся (IoU > порога) bbox оставляет самый уверенный."""
+        merged = []
+        for detection in sorted(detections, key=lambda d: d.score[0], reverse=True):
+            bbox = detection.location_data.relative_bounding_box
+            if all(self._bbox_iou(bbox, kept.location_data.relative_bounding_box) <= iou_threshold
+                   for kept in merged):
+                merged.append(detection)
+        return merged
+    
+    @staticmethod
+    def _bbox_iou(a, b) -> float:
+        """IoU двух относительных bbox MediaPipe."""
+        x1 = max(a.xmin, b.xmin)
+        y1 = max(a.ymin, b.ymin)
+        x2 = min(a.xmin + a.width, b.xmin + b.width)
+        y2 = min(a.ymin + a.height, b.ymin + b.height)
+        inter = max(0.0, x2 - x1) * max(0.0, y2 - y1)
+        union = a.width * a.height + b.width * b.height - inter
+        return inter / union if union > 0 else 0.0
+    
+    def _decode_image(self, image_bytes: bytes, filename: str, orientation: int = 1,
+                      reduction: int = 1) -> Optional[np.ndarray]:
+        """
+        Декодирует изображение в BGR (3 канала) и применяет EXIF-ориентацию.
+        
+        reduction (1, 2, 4, 8) — масштаб 1/reduction. Для JPEG OpenCV декодирует
+        сразу в уменьшенном размере, остальные форматы декодируются полностью.
+        
+        Returns:
+            BGR numpy array или None, если декодировать не удалось
+        """
+        # Сначала пробуем через OpenCV (быстрее для JPEG/PNG/BMP/TIFF).
+        # EXIF-поворот OpenCV не применяет — делаем это сами одним flip/rotate ниже
+        nparr = np.frombuffer(image_bytes, np.uint8)
+        flags = REDUCED_DECODE_FLAGS.get(reduction, cv2.IMREAD_COLOR) | cv2.IMREAD_IGNORE_ORIENTATION
+        img = cv2.imdecode(nparr, flags)
+        decoder = 'opencv'
+        
+        # Если OpenCV не смог декодировать (AVIF, WebP, HEIC/HEIF и др.), пробуем через PIL
+        if img is None:
             try:
-                from PIL import ImageOps
-                pil_img = ImageOps.exif_transpose(pil_img)
-            except Exception:
-                pass
-            # Конвертируем в numpy (RGB/RGBA/grayscale) и в BGR для OpenCV
-            arr = np.array(pil_img)
-            if len(arr.shape) == 3 and arr.shape[2] == 3:
-                img = cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
-            elif len(arr.shape) == 3 and arr.shape[2] == 4:
-                img = cv2.cvtColor(arr, cv2.COLOR_RGBA2BGR)
-            elif len(arr.shape) == 2:
-                img = cv2.cvtColor(arr, cv2.COLOR_GRAY2BGR)
-            # иначе оставляем переданный img
-        except Exception:
-            pass
+                decoder = 'pil'
+                pil_img = Image.open(image_stream(image_bytes))
+                format_name = pil_img.format or "UNKNOWN"
+                logger.debug("OpenCV не декодировал %r, открыто через PIL: формат %s, размер %s, режим %s",
+                             filename, format_name, pil_img.size, pil_img.mode)
+                
+                # Поддерживаемые форматы через PIL:
+                # - AVIF (если установлен pillow-avif-plugin)
+                # - HEIC/HEIF (если установлен pillow-heif)
+                # - WebP (встроенная поддержка в Pillow)
+                # - GIF, ICO, BMP, TIFF и другие стандартные форматы
+                
+                # Конвертируем в RGB если нужно
+                if pil_img.mode != 'RGB':
+                    pil_img = pil_img.convert('RGB')
+                
+                # Конвертируем PIL в numpy array (RGB)
+                img_rgb = np.array(pil_img)
+                
+                # Конвертируем RGB в BGR для OpenCV
+                img = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2BGR)
+            except Exception as e:
+                logger.info("Не удалось декодировать %r: %s: %s", filename, type(e).__name__, e)
+                return None
+        
+        # Проверка: пустое или нулевой размер
+        if img is None or img.size == 0:
+            logger.info("Изображение %r пустое или не декодировалось", filename)
+            return None
+        h, w = img.shape[:2]
+        if h < 1 or w < 1:
+            logger.info("Изображение %r: некорректный размер %dx%d", filename, w, h)
+            return None
+        # Всегда 3 канала BGR для дальнейшей обработки (grayscale -> BGR)
+        if len(img.shape) == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        
+        self.last_stats.setdefault('decoders', []).append(decoder)
+        
+        # Исправление ориентации по EXIF на уже декодированном массиве (без повторного декодирования)
+        with self._stage('orientation'):
+            return self._apply_orientation(img, orientation)
+    
+    @staticmethod
+    def _apply_orientation(img: np.ndarray, orientation: int) -> np.ndarray:
+        """Применяет EXIF Orientation к массиву (то же, что ImageOps.exif_transpose)."""
+        if orientation == 2:
+            return cv2.flip(img, 1)
+        if orientation == 3:
+            return cv2.rotate(img, cv2.ROTATE_180)
+        if orientation == 4:
+            return cv2.flip(img, 0)
+        if orientation == 5:
+            return cv2.transpose(img)
+        if orientation == 6:
+            return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+        if orientation == 7:
+            return cv2.rotate(cv2.transpose(img), cv2.ROTATE_180)
+        if orientation == 8:
+            return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
         return img
     
     def _select_best_face_mediapipe(self, detections, img_shape: Tuple[int, int, int]):
@@ -436,13 +886,71 @@ class FaceProcessor:
         
         return best_detection
     
-    def _convert_landmarks_to_array(self, face_landmarks, img_shape: Tuple[int, int, int]) -> np.ndarray:
-        """Конвертирует MediaPipe landmarks в numpy array."""
+    def _select_faces(self, detections, max_faces: int) -> list:
+        """
+        Лица для режима всех лиц: confidence не ниже min_face_score, не больше max_faces
+        самых уверенных, по порядку слева направо (сверху вниз при равном x).
+        """
+        confident = [d for d in detections if d.score[0] >= self.min_face_score]
+        self.last_stats['faces'] = len(confident)
+        kept = sorted(confident, key=lambda d: d.score[0], reverse=True)[:max_faces]
+        return sorted(kept, key=lambda d: (d.location_data.relative_bounding_box.xmin,
+                                           d.location_data.relative_bounding_box.ymin))
+    
+    @staticmethod
+    def _bbox_contains(bbox, w: int, h: int, point) -> bool:
+        """Точка (в пикселях кадра w×h) внутри относительного bbox MediaPipe."""
+        x, y = point
+        return (bbox.xmin * w <= x <= (bbox.xmin + bbox.width) * w
+                and bbox.ymin * h <= y <= (bbox.ymin + bbox.height) * h)
+    
+    def _mesh_landmarks(self, img_rgb: np.ndarray, detection, expand: float = 2.0) -> Optional[np.ndarray]:
+        """
+        Запускает Face Mesh на расширенной области вокруг bbox детекции.
+        
+        Returns:
+            Landmarks в координатах img_rgb или None, если Face Mesh лицо не нашёл
+        """
+        h, w = img_rgb.shape[:2]
+        x0, y0, x1, y1 = self._face_roi(detection.location_data.relative_bounding_box, w, h, expand)
+        roi = np.ascontiguousarray(img_rgb[y0:y1, x0:x1])
+        mesh_results = self.face_mesh.process(roi)
+        if not mesh_results.multi_face_landmarks:
+            return None
+        return self._convert_landmarks_to_array(mesh_results.multi_face_landmarks[0], roi.shape, offset=(x0, y0))
+    
+    @staticmethod
+    def _face_roi(bbox, w: int, h: int, expand: float = 2.0) -> Tuple[int, int, int, int]:
+        """Квадрат со стороной expand × max(ширина, высота) bbox вокруг его центра, обрезанный по кадру."""
+        center_x = (bbox.xmin + bbox.width / 2) * w
+        center_y = (bbox.ymin + bbox.height / 2) * h
+        half = max(bbox.width * w, bbox.height * h) * expand / 2
+        x0 = int(max(0, center_x - half))
+        y0 = int(max(0, center_y - half))
+        x1 = int(min(w, center_x + half))
+        y1 = int(min(h, center_y + half))
+        # Вырожденный bbox — берём весь кадр
+        if x1 - x0 < 2 or y1 - y0 < 2:
+            return 0, 0, w, h
+        return x0, y0, x1, y1
+    
+    def _convert_landmarks_to_array(self, face_landmarks, img_shape: Tuple[int, int, int],
+                                    offset: Tuple[int, int] = (0, 0)) -> np.ndarray:
+        """
+        Конвертирует MediaPipe landmarks в float32 массив (N, 2) в пикселях.
+        
+        Координаты заполняют заранее выделенный массив одним np.fromiter, перевод
+        в пиксели (масштаб и offset — положение img_shape в кадре) — одной операцией.
+        """
         h, w = img_shape[:2]
-        landmarks = []
-        for landmark in face_landmarks.landmark:
-            landmarks.append([landmark.x * w, landmark.y * h])
-        return np.array(landmarks, dtype=np.int32)
+        points = face_landmarks.landmark
+        landmarks = np.fromiter(
+            itertools.chain.from_iterable((lm.x, lm.y) for lm in points),
+            dtype=np.float32, count=2 * len(points)
+        ).reshape(-1, 2)
+        landmarks *= np.array([w, h], dtype=np.float32)
+        landmarks += np.array(offset, dtype=np.float32)
+        return landmarks
     
     def _bbox_to_landmarks(self, bbox, w: int, h: int) -> np.ndarray:
         """Создает приблизительные landmarks из bbox."""
@@ -458,66 +966,40 @@ class FaceProcessor:
             [x_max, y_max],  # нижний правый
             [x_min, y_max],  # нижний левый
             [(x_min + x_max) / 2, (y_min + y_max) / 2],  # центр
-        ], dtype=np.int32)
+        ], dtype=np.float32)
         
         return landmarks
     
-    def _calculate_face_metrics(self, landmarks: np.ndarray, img_shape: Tuple[int, int, int]) -> Tuple[np.ndarray, float]:
-        """Вычисляет центр лица и размер."""
-        # Используем ключевые точки для более точного определения
-        # Точки глаз (примерные индексы для 106 landmarks)
-        # Для antelopev2: левый глаз ~36-41, правый глаз ~42-47
-        
-        # Упрощенный подход: используем центр всех landmarks
-        face_center = np.mean(landmarks, axis=0)
-        
-        # Размер лица: расстояние между крайними точками
-        x_min, y_min = landmarks.min(axis=0)
-        x_max, y_max = landmarks.max(axis=0)
-        face_width = x_max - x_min
-        face_height = y_max - y_min
-        face_size = max(face_width, face_height) * 1.2  # Добавляем margin
-        
-        return face_center.astype(np.int32), face_size
+    def _calculate_face_metrics(self, landmarks: np.ndarray, margin: float = 1.2) -> Tuple[np.ndarray, float]:
+        """Вычисляет центр лица (среднее landmarks) и размер (наибольший размах × margin)."""
+        face_center = landmarks.mean(axis=0)
+        face_size = float(np.ptp(landmarks, axis=0).max()) * margin
+        return face_center, face_size
     
-    def _align_face(self, img: np.ndarray, landmarks: np.ndarray) -> Tuple[np.ndarray, float]:
-        """Выравнивает лицо по глазам (горизонтальное выравнивание)."""
+    def _align_face(self, landmarks: np.ndarray, img_shape: Tuple[int, int, int]) -> float:
+        """
+        Вычисляет угол выравнивания лица по глазам (горизонтальное выравнивание).
+        
+        Returns:
+            Угол в градусах для cv2.getRotationMatrix2D вокруг центра кадра, 0 если поворот не нужен
+        """
         rotation_angle = 0.0
         try:
             if landmarks is None or len(landmarks) < 10:
-                return img, rotation_angle
+                return rotation_angle
             
-            # MediaPipe Face Mesh индексы для глаз
-            # Левый глаз центр: 33, 7, 163, 144, 145, 153, 154, 155, 133, 173, 157, 158, 159, 160, 161, 246
-            # Правый глаз центр: 362, 382, 381, 380, 374, 373, 390, 249, 263, 466, 388, 387, 386, 385, 384, 398
-            
-            # Если у нас полный набор landmarks (468 точек MediaPipe)
-            if len(landmarks) >= 468:
-                # Используем несколько точек для более точного определения центра глаза
-                left_eye_points = [33, 7, 163, 144, 145, 153, 154, 155, 133, 173, 157, 158, 159, 160, 161, 246]
-                right_eye_points = [362, 382, 381, 380, 374, 373, 390, 249, 263, 466, 388, 387, 386, 385, 384, 398]
-                
-                # Фильтруем доступные индексы
-                left_eye_available = [i for i in left_eye_points if i < len(landmarks)]
-                right_eye_available = [i for i in right_eye_points if i < len(landmarks)]
-                
-                if left_eye_available and right_eye_available:
-                    left_eye_center = np.mean(landmarks[left_eye_available], axis=0)
-                    right_eye_center = np.mean(landmarks[right_eye_available], axis=0)
-                else:
-                    # Fallback на простые индексы
-                    if 33 < len(landmarks) and 263 < len(landmarks):
-                        left_eye_center = landmarks[33]
-                        right_eye_center = landmarks[263]
-                    else:
-                        return img, rotation_angle
+            # Если у нас полный набор landmarks (468 точек MediaPipe) —
+            # центр глаза как среднее нескольких точек (LEFT_EYE_IDX / RIGHT_EYE_IDX)
+            if len(landmarks) >= FACE_MESH_POINTS:
+                left_eye_center = landmarks[LEFT_EYE_IDX].mean(axis=0)
+                right_eye_center = landmarks[RIGHT_EYE_IDX].mean(axis=0)
             else:
                 # Fallback: используем первые две точки как глаза
                 if len(landmarks) >= 2:
                     left_eye_center = landmarks[0]
                     right_eye_center = landmarks[1]
                 else:
-                    return img, rotation_angle
+                    return rotation_angle
             
             # Вычисление угла поворота
             dy = right_eye_center[1] - left_eye_center[1]
@@ -525,11 +1007,12 @@ class FaceProcessor:
             
             # Проверка валидности: для полупрофиля расстояние между глазами может быть меньше
             eye_distance = np.sqrt(dx**2 + dy**2)
-            img_diagonal = np.sqrt(img.shape[0]**2 + img.shape[1]**2)
+            img_diagonal = np.sqrt(img_shape[0]**2 + img_shape[1]**2)
             
             # Если глаза слишком близко (возможно полупрофиль или ошибка детекции), будем консервативнее
             if eye_distance < img_diagonal * 0.05:  # Меньше 5% диагонали - подозрительно
-                print(f"⚠️ Подозрительно маленькое расстояние между глазами ({eye_distance:.1f}px), возможно полупрофиль")
+                logger.debug("Подозрительно маленькое расстояние между глазами (%.1fpx), возможно полупрофиль",
+                             eye_distance)
                 # Для полупрофиля делаем более мягкое выравнивание
                 angle = np.degrees(np.arctan2(dy, dx))
                 rotation_angle = angle * 0.7  # Уменьшаем угол поворота на 30%
@@ -541,53 +1024,123 @@ class FaceProcessor:
             # Для полупрофиля ограничиваем максимальный угол поворота до 15 градусов
             max_rotation = 15.0 if eye_distance < img_diagonal * 0.08 else 45.0
             if abs(rotation_angle) > 2 and abs(rotation_angle) < max_rotation:
-                center = (img.shape[1] // 2, img.shape[0] // 2)
-                M = cv2.getRotationMatrix2D(center, angle, 1.0)
-                img = cv2.warpAffine(img, M, (img.shape[1], img.shape[0]), 
-                                    flags=cv2.INTER_LINEAR, 
-                                    borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255))
+                return angle
         
         except Exception as e:
-            print(f"Alignment error: {e}")
+            logger.warning("Ошибка выравнивания: %s", e)
         
-        return img, rotation_angle
+        return 0.0
     
-    def _crop_with_padding(self, img: np.ndarray, x1: int, y1: int, x2: int, y2: int) -> np.ndarray:
-        """Обрезает изображение с добавлением padding если выходит за границы."""
-        h, w = img.shape[:2]
+    def _render_faces(self, img: np.ndarray, geometries: List[Dict], sizes: Sequence[int], output_format: str,
+                      quality: Optional[int]) -> List[List[Dict]]:
+        """
+        Кропы лиц во всех размерах: на каждую геометрию [{'size', 'data'}] в порядке sizes.
         
-        # Вычисляем реальные координаты кропа
-        crop_x1 = max(0, x1)
-        crop_y1 = max(0, y1)
-        crop_x2 = min(w, x2)
-        crop_y2 = min(h, y2)
-        
-        # Обрезаем что можем
-        cropped = img[crop_y1:crop_y2, crop_x1:crop_x2]
-        
-        # Если нужно добавить padding
-        if x1 < 0 or y1 < 0 or x2 > w or y2 > h:
-            # Вычисляем размеры padding
-            pad_left = max(0, -x1)
-            pad_top = max(0, -y1)
-            pad_right = max(0, x2 - w)
-            pad_bottom = max(0, y2 - h)
-            
-            # Добавляем белый padding (вместо отражения краёв)
-            white = (255, 255, 255) if len(cropped.shape) == 3 else 255
-            cropped = cv2.copyMakeBorder(
-                cropped, pad_top, pad_bottom, pad_left, pad_right,
-                cv2.BORDER_CONSTANT, value=white
-            )
-        
-        # Убеждаемся что размер правильный
-        if cropped.shape[0] != self.output_size or cropped.shape[1] != self.output_size:
-            cropped = cv2.resize(cropped, (self.output_size, self.output_size))
-        
-        return cropped
+        warpAffine один раз на лицо в наибольший размер, меньшие — уменьшением его (INTER_AREA).
+        Кадрирование то же (масштаб и сдвиг пропорциональны output_size), а уменьшение с площадным
+        усреднением не даёт алиасинга, как прямой warpAffine в 64×64 из кадра в десятки мегапикселей.
+        Несколько лиц рендерятся и несколько кропов кодируются параллельно (render_pool).
+        """
+        largest = max(sizes)
+        
+        def render(geometry: Dict) -> List[np.ndarray]:
+            base = self._render_geometry(img, geometry, largest)
+            return [
+                base if size == largest else cv2.resize(base, (size, size), interpolation=cv2.INTER_AREA)
+                for size in sizes
+            ]
+        
+        def encode(crop: np.ndarray) -> bytes:
+            return encode_image(crop, output_format, quality, self.png_compression)
+        
+        with self._stage('render'):
+            rendered = list(render_pool().map(render, geometries) if len(geometries) > 1
+                            else map(render, geometries))
+        crops = [crop for face in rendered for crop in face]
+        with self._stage('encode'):
+            encoded = list(render_pool().map(encode, crops) if len(crops) > 1 else map(encode, crops))
+        return [
+            [{'size': size, 'data': data} for size, data in zip(sizes, encoded[i * len(sizes):(i + 1) * len(sizes)])]
+            for i in range(len(geometries))
+        ]
     
-    def _get_output_filename(self, filename: str) -> str:
-        """Генерирует имя выходного файла."""
-        base = Path(filename).stem
-        ext = Path(filename).suffix or '.jpg'
-        return f"{base}_cropped_512x512{ext}"
+    def _render_geometry(self, img: np.ndarray, geometry: Dict, output_size: Optional[int] = None,
+                         face_fill_ratio: Optional[float] = None,
+                         crop_shift_up: Optional[float] = None) -> np.ndarray:
+        """Рендерит кроп по геометрии полного разрешения на изображении любого масштаба (в т.ч. уменьшенном)."""
+        ratio = img.shape[1] / geometry['image_size'][0]
+        # round убирает ошибку округления при пересчёте туда-обратно (x * k / k), чтобы int() в _render_crop
+        # давал тот же пиксель, что и без пересчёта
+        face_center_x, face_center_y = (round(v * ratio, 6) for v in geometry['face_center'])
+        return self._render_crop(
+            img, face_center_x, face_center_y, geometry['face_size'] * ratio,
+            geometry['rotation_angle'], output_size, face_fill_ratio, crop_shift_up
+        )
+    
+    def _render_crop(self, img: np.ndarray, face_center_x: float, face_center_y: float,
+                     face_size: float, rotation_angle: float, output_size: Optional[int] = None,
+                     face_fill_ratio: Optional[float] = None,
+                     crop_shift_up: Optional[float] = None) -> np.ndarray:
+        """
+        Строит итоговый квадрат output_size×output_size одним warpAffine.
+        
+        Поворот вокруг центра кадра, масштаб по face_fill_ratio, кроп со сдвигом вверх
+        и белые поля собраны в одну аффинную матрицу: считаются только пиксели результата,
+        без полноразмерных промежуточных копий (стоимость не зависит от мегапикселей входа).
+        
+        output_size, face_fill_ratio, crop_shift_up (доля output_size) — None означает
+        значения процессора и CROP_SHIFT_UP.
+        """
+        output_size = output_size or self.output_size
+        face_fill_ratio = face_fill_ratio or self.face_fill_ratio
+        crop_shift_up = CROP_SHIFT_UP if crop_shift_up is None else crop_shift_up
+        h_img, w_img = img.shape[:2]
+        
+        # Поворот вокруг центра кадра (единичная матрица, если угол 0)
+        center = (w_img // 2, h_img // 2)
+        M = cv2.getRotationMatrix2D(center, rotation_angle, 1.0)
+        
+        # Центр лица после поворота (той же матрицей, что и пиксели)
+        face_center_x, face_center_y = M @ np.array([face_center_x, face_center_y, 1.0])
+        face_center_x = int(face_center_x)
+        face_center_y = int(face_center_y)
+        
+        # Масштаб по face_fill_ratio (какой долей кадра занимает лицо)
+        target_face_height = output_size * face_fill_ratio
+        scale = target_face_height / face_size
+        
+        # Минимальный масштаб, при котором квадрат output_size×output_size помещается
+        # в кадр без белых полей. Учитываем сдвиг кропа вверх (больше причёски).
+        half = output_size // 2
+        crop_shift_up = int(crop_shift_up * output_size)  # центр кропа выше лица — больше волос в кадре
+        scale_min = 0.0
+        if face_center_x > 1:
+            scale_min = max(scale_min, (half + 1) / face_center_x)
+        if face_center_y > 1:
+            scale_min = max(scale_min, (half + 1 + crop_shift_up) / face_center_y)  # сверху нужен запас под волосы
+        if w_img - face_center_x > 1:
+            scale_min = max(scale_min, (half + 1) / (w_img - face_center_x))
+        if h_img - face_center_y > 1:
+            scale_min = max(scale_min, (half + 1 - crop_shift_up) / (h_img - face_center_y))  # снизу режем больше
+        if w_img > 0:
+            scale_min = max(scale_min, output_size / w_img)
+        if h_img > 0:
+            scale_min = max(scale_min, output_size / h_img)
+        scale = max(scale, scale_min)
+        
+        # Левый верхний угол кропа в масштабированных координатах.
+        # Центр кропа выше центра лица — в кадре больше причёски, меньше шеи
+        x1 = int(face_center_x * scale) - half
+        y1 = int(face_center_y * scale) - crop_shift_up - half
+        
+        # Итоговая матрица: сдвиг(-x1, -y1) · масштаб(scale) · поворот(M).
+        # 0.5 * (scale - 1) — выравнивание центров пикселей, как в cv2.resize.
+        # Всё, что за краем кадра (и углы после поворота), заливается белым
+        A = M * scale
+        A[0, 2] += 0.5 * (scale - 1) - x1
+        A[1, 2] += 0.5 * (scale - 1) - y1
+        return cv2.warpAffine(
+            img, A, (output_size, output_size),
+            flags=cv2.INTER_LINEAR,
+            borderMode=cv2.BORDER_CONSTANT, borderValue=(255, 255, 255)
+        )
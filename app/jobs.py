@@ -0,0 +1,277 @@
+"""
+Асинхронные задания для больших пакетов (POST /v1/jobs).
+
+/v1/face-crop ограничен 5 файлами и держит соединение на всё время обработки.
+Задание принимает пакет любого размера (до JOB_MAX_FILES), сразу возвращает id
+и обрабатывается фоновыми воркерами внутри процесса:
+
+- входные файлы спулятся на диск (<jobs_dir>/<id>/input), в памяти держится только очередь
+- воркеры берут файлы из общей очереди и отправляют их в тот же ProcessingEngine,
+  что и интерактивные запросы, но с низким приоритетом (run_background):
+  задача уходит в пул, только когда есть свободный исполнитель
+- результаты пишутся в <jobs_dir>/<id>/output, их можно скачать по одному или ZIP-архивом
+- завершённые задания удаляются через ttl секунд
+
+Задания живут в памяти процесса: после перезапуска незавершённые задания теряются.
+"""
+import asyncio
+import logging
+import shutil
+import time
+import uuid
+import zipfile
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from app.encoding import file_extension
+from app.executor import EngineBusy, ProcessingEngine
+
+logger = logging.getLogger(__name__)
+
+# Статусы задания
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_CANCELLED = "cancelled"
+
+# Статусы файла внутри задания
+ITEM_QUEUED = "queued"
+ITEM_OK = "ok"
+ITEM_NO_FACE = "no-face"
+ITEM_ERROR = "error"
+
+# Пауза перед повтором, если пул всё же переполнен интерактивными запросами
+BUSY_RETRY_DELAY = 0.5
+
+
+class JobNotFound(Exception):
+    """Задание не найдено (неизвестный id или уже удалено)."""
+
+
+class Job:
+    def __init__(self, job_id: str, root: Path, options: Dict[str, Any]):
+        self.id = job_id
+        self.root = root
+        self.options = options
+        self.status = JOB_QUEUED
+        self.items: List[Dict[str, Any]] = []
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def input_dir(self) -> Path:
+        return self.root / "input"
+
+    @property
+    def output_dir(self) -> Path:
+        return self.root / "output"
+
+    @property
+    def completed(self) -> int:
+        return sum(1 for item in self.items if item["status"] != ITEM_QUEUED)
+
+    def counts(self) -> Dict[str, int]:
+        counts = {ITEM_OK: 0, ITEM_NO_FACE: 0, ITEM_ERROR: 0}
+        for item in self.items:
+            if item["status"] in counts:
+                counts[item["status"]] += 1
+        return counts
+
+    def to_dict(self, with_items: bool = False) -> Dict[str, Any]:
+        total = len(self.items)
+        counts = self.counts()
+        data = {
+            "job_id": self.id,
+            "status": self.status,
+            "total": total,
+            "completed": self.completed,
+            "succeeded": counts[ITEM_OK],
+            "no_face": counts[ITEM_NO_FACE],
+            "failed": counts[ITEM_ERROR],
+            "progress": round(self.completed / total, 4) if total else 1.0,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if with_items:
+            data["items"] = [
+                {k: item[k] for k in ("index", "filename", "status", "output", "error")}
+                for item in self.items
+            ]
+        return data
+
+
+class JobManager:
+    def __init__(self, engine: ProcessingEngine, jobs_dir: str, workers: int = 2,
+                 max_files: int = 10000, ttl: float = 24 * 3600,
+                 output_filename: Optional[Callable[[str, int, str], str]] = None):
+        """
+        Args:
+            engine: Общий пул обработки (задания используют его с низким приоритетом)
+            jobs_dir: Каталог для входных файлов и результатов заданий
+            workers: Сколько файлов заданий обрабатывается одновременно
+            max_files: Максимум файлов в одном задании
+            ttl: Через сколько секунд после завершения задание и его файлы удаляются
+            output_filename: (исходное имя, индекс, расширение) -> имя результата
+        """
+        self.engine = engine
+        self.jobs_dir = Path(jobs_dir)
+        self.workers = workers
+        self.max_files = max_files
+        self.ttl = ttl
+        self.output_filename = output_filename or (lambda name, idx, ext: f"{Path(name).stem}.{ext}")
+        self.jobs: Dict[str, Job] = {}
+        self._queue: "asyncio.Queue[tuple]" = None
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        """Запускает фоновых воркеров (вызывается из event loop при старте приложения)."""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        self.jobs_dir.mkdir(parents=True, exist_ok=True)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def create(self, options: Dict[str, Any]) -> Job:
+        """Создаёт пустое задание; файлы добавляются add_input(), затем submit()."""
+        self._cleanup()
+        job_id = uuid.uuid4().hex
+        job = Job(job_id, self.jobs_dir / job_id, options)
+        job.input_dir.mkdir(parents=True)
+        job.output_dir.mkdir()
+        self.jobs[job_id] = job
+        return job
+
+    def add_input(self, job: Job, filename: str) -> Path:
+        """Регистрирует входной файл задания и возвращает путь, куда записать его байты."""
+        index = len(job.items)
+        path = job.input_dir / f"{index:06d}"
+        job.items.append({
+            "index": index, "filename": filename, "status": ITEM_QUEUED,
+            "output": None, "error": None, "input": path,
+        })
+        return path
+
+    def submit(self, job: Job) -> None:
+        """Ставит все файлы задания в очередь воркеров."""
+        if self._queue is None:
+            raise RuntimeError("JobManager не запущен (start())")
+        if not job.items:
+            self._finish(job)
+            return
+        for item in job.items:
+            self._queue.put_nowait((job.id, item["index"]))
+
+    def get(self, job_id: str) -> Job:
+        job = self.jobs.get(job_id)
+        if job is None:
+            raise JobNotFound(job_id)
+        return job
+
+    def cancel(self, job_id: str) -> Job:
+        """Отменяет задание: необработанные файлы пропускаются, файлы задания удаляются."""
+        job = self.get(job_id)
+        if job.status in (JOB_QUEUED, JOB_RUNNING):
+            job.status = JOB_CANCELLED
+            job.finished_at = time.time()
+        self.jobs.pop(job_id, None)
+        shutil.rmtree(job.root, ignore_errors=True)
+        return job
+
+    def result_path(self, job_id: str, index: int) -> Path:
+        job = self.get(job_id)
+        if not 0 <= index < len(job.items) or job.items[index]["output"] is None:
+            raise JobNotFound(f"{job_id}/{index}")
+        return job.output_dir / job.items[index]["output"]
+
+    async def archive(self, job_id: str) -> Path:
+        """ZIP со всеми результатами завершённого задания (создаётся один раз, без сжатия — картинки уже сжаты)."""
+        job = self.get(job_id)
+        path = job.root / "results.zip"
+        if not path.exists():
+            names = [item["output"] for item in job.items if item["output"]]
+            await asyncio.to_thread(self._write_archive, job.output_dir, names, path)
+        return path
+
+    @staticmethod
+    def _write_archive(output_dir: Path, names: List[str], path: Path) -> None:
+        tmp = path.with_suffix(".tmp")
+        with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_STORED) as zf:
+            for name in names:
+                zf.write(output_dir / name, arcname=name)
+        tmp.replace(path)
+
+    async def _worker(self) -> None:
+        while True:
+            job_id, index = await self._queue.get()
+            try:
+                job = self.jobs.get(job_id)
+                if job is None or job.status == JOB_CANCELLED:
+                    continue
+                if job.status == JOB_QUEUED:
+                    job.status = JOB_RUNNING
+                    job.started_at = time.time()
+                await self._process_item(job, job.items[index])
+                if job.status == JOB_RUNNING and job.completed == len(job.items):
+                    self._finish(job)
+            finally:
+                self._queue.task_done()
+
+    async def _process_item(self, job: Job, item: Dict[str, Any]) -> None:
+        try:
+            image_bytes = await asyncio.to_thread(item["input"].read_bytes)
+            while True:
+                try:
+                    outcome = await self.engine.process_image(
+                        image_bytes, item["filename"], background=True, **job.options
+                    )
+                    break
+                except EngineBusy:
+                    await asyncio.sleep(BUSY_RETRY_DELAY)
+            if job.status == JOB_CANCELLED:
+                return
+            result = outcome["result"]
+            if result is None:
+                item["status"] = ITEM_NO_FACE
+            else:
+                ext = file_extension(job.options.get("output_format", "png"))
+                name = f"{item['index']:06d}_" + self.output_filename(item["filename"], item["index"], ext)
+                await asyncio.to_thread((job.output_dir / name).write_bytes, result["data"])
+                item["output"] = name
+                item["status"] = ITEM_OK
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Задание %s, файл %d (%r): %s: %s", job.id, item["index"], item["filename"],
+                         type(e).__name__, e, extra={"job_id": job.id})
+            item["status"] = ITEM_ERROR
+            item["error"] = f"{type(e).__name__}: {e}"[:200]
+        finally:
+            item["input"].unlink(missing_ok=True)
+
+    def _finish(self, job: Job) -> None:
+        job.status = JOB_DONE
+        job.finished_at = time.time()
+        counts = job.counts()
+        logger.info(
+            "Задание %s завершено: %d файлов за %.1fс", job.id, len(job.items), job.finished_at - job.created_at,
+            extra={"job_id": job.id, "ok": counts[ITEM_OK], "no_face": counts[ITEM_NO_FACE], "error": counts[ITEM_ERROR]},
+        )
+
+    def _cleanup(self) -> None:
+        """Удаляет завершённые задания старше ttl."""
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished_at is not None and now - job.finished_at > self.ttl
+        ]
+        for job_id in expired:
+            job = self.jobs.pop(job_id)
+            shutil.rmtree(job.root, ignore_errors=True)
@@ -0,0 +1,94 @@
+"""
+Структурированное логирование вместо print.
+
+Логгеры "app.*" пишут в stderr по строке на запись: JSON (по умолчанию, для сборщиков
+логов) или текст для локальной отладки (FACE_CROP_LOG_FORMAT=text). Поля, переданные
+через extra=..., попадают в запись как есть.
+
+Каждая запись содержит request_id текущего HTTP-запроса (заголовок X-Request-ID или
+сгенерированный). Id хранится в contextvar; в исполнителях пула его выставляет
+ProcessingEngine, так что строки FaceProcessor тоже привязаны к запросу.
+
+Подробности по каждому изображению пишутся на уровне DEBUG: при уровне INFO по умолчанию
+они не форматируются и не стоят ничего в горячем пути.
+"""
+import contextvars
+import json
+import logging
+import re
+import sys
+import uuid
+from typing import Optional
+
+REQUEST_ID: "contextvars.ContextVar[Optional[str]]" = contextvars.ContextVar("request_id", default=None)
+
+LOG_FORMATS = ("json", "text")
+
+# Атрибуты LogRecord, которые не являются полями extra
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "request_id"}
+
+# Допустимый X-Request-ID от клиента: он попадает в логи и заголовок ответа
+_REQUEST_ID_RE = re.compile(r"^[A-Za-z0-9._:-]{1,64}$")
+
+
+def new_request_id(header_value: Optional[str] = None) -> str:
+    """Id запроса: корректный X-Request-ID клиента или новый."""
+    if header_value and _REQUEST_ID_RE.match(header_value):
+        return header_value
+    return uuid.uuid4().hex[:16]
+
+
+def _extra_fields(record: logging.LogRecord) -> dict:
+    return {key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS}
+
+
+class _RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = REQUEST_ID.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.request_id:
+            entry["request_id"] = record.request_id
+        entry.update(_extra_fields(record))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = _extra_fields(record)
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return line
+
+
+def configure(level: str = "INFO", log_format: str = "json") -> None:
+    """
+    Настраивает логгер "app" (повторный вызов только меняет уровень).
+    Вызывается при импорте app.main, в процессах пула и в CLI.
+    """
+    logger = logging.getLogger("app")
+    resolved = logging.getLevelName(str(level).upper())
+    logger.setLevel(resolved if isinstance(resolved, int) else logging.INFO)
+    if any(getattr(handler, "_face_crop", False) for handler in logger.handlers):
+        return
+    handler = logging.StreamHandler(sys.stderr)
+    handler._face_crop = True
+    handler.addFilter(_RequestIdFilter())
+    handler.setFormatter(TextFormatter() if log_format == "text" else JsonFormatter())
+    logger.addHandler(handler)
+    logger.propagate = False
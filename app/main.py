@@ -1,20 +1,39 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse, Response, HTMLResponse, JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Header, Query, Request
+from fastapi.responses import Response, HTMLResponse, JSONResponse, StreamingResponse, FileResponse
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+import asyncio
 import base64
-import io
-import os
+import hashlib
+import json
+import logging
 import re
-import tempfile
 import shutil
 import time
+import uuid
 from pathlib import Path
 
-from app.face_processor import FaceProcessor
+from app import config, log, metrics
+from app.cache import GeometryStore, ResultCache, content_hash
+from app.encoding import EncodingError, file_extension, media_type, negotiate_format
+from app.executor import BatchTooLarge, DeadlineExceeded, EngineBusy, ProcessingEngine
+from app.face_processor import ImageTooLarge
+from app.jobs import JOB_DONE, JobManager, JobNotFound
+from app.uploads import BodyLimitMiddleware, file_too_large, read_upload, upload_size
+
+log.configure(config.LOG_LEVEL, config.LOG_FORMAT)
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="Face Crop Microservice", version="1.0.0")
 
+# Лимиты тела запроса и каждого файла во время приёма (до спулинга multipart); добавлен до CORS,
+# чтобы ответ 413 тоже получал CORS-заголовки и браузер мог его прочитать
+app.add_middleware(
+    BodyLimitMiddleware,
+    limits={"/v1/face-crop": config.MAX_REQUEST_BYTES, "/v1/jobs": config.JOB_MAX_REQUEST_BYTES},
+    part_limits={"/v1/face-crop": config.MAX_FILE_BYTES, "/v1/jobs": config.MAX_FILE_BYTES},
+)
+
 # Настройка CORS для работы с разных устройств
 app.add_middleware(
     CORSMiddleware,
@@ -22,13 +41,96 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Без этого браузерный клиент с другого origin не прочитает тайминги и id
+    expose_headers=["Server-Timing", "X-Request-ID", "X-Image-Id", "ETag", "Retry-After"],
     max_age=3600,
 )
 
-# Инициализация процессора лиц (CPU)
-# Каждый воркер uvicorn создаст свой экземпляр
+# Кэш результатов по содержимому: повторная загрузка того же файла не доходит до пула
+cache = ResultCache(
+    max_bytes=config.CACHE_MAX_BYTES,
+    disk_dir=config.CACHE_DIR or None,
+    disk_max_bytes=config.CACHE_DISK_MAX_BYTES,
+)
+
+# Геометрия найденных лиц: повторный кроп с другим кадрированием без детекции
+geometry_store = GeometryStore(max_bytes=config.GEOMETRY_STORE_BYTES)
+
+# Пул обработки лиц (CPU)
+# Каждый воркер uvicorn создаст свой пул, у каждого исполнителя (поток/процесс) свой FaceProcessor
 # face_fill_ratio=0.5 означает, что лицо займет 50% высоты (было 65%), больше места для волос
-face_processor = FaceProcessor(output_size=512, face_fill_ratio=0.5)
+engine = ProcessingEngine(
+    mode=config.ENGINE_MODE,
+    workers=config.ENGINE_WORKERS,
+    max_queue=config.ENGINE_MAX_QUEUE,
+    max_queue_cost=config.ENGINE_MAX_QUEUE_MP,
+    processor_kwargs={
+        "output_size": config.OUTPUT_SIZE,
+        "face_fill_ratio": config.FACE_FILL_RATIO,
+        "cascade_threshold": config.CASCADE_THRESHOLD,
+        "detection_max_dimension": config.DETECTION_MAX_DIMENSION,
+        "png_compression": config.PNG_COMPRESSION,
+        "max_megapixels": config.MAX_MEGAPIXELS,
+        "min_face_score": config.MIN_FACE_SCORE,
+    },
+    cache=cache,
+    geometry=geometry_store,
+)
+
+# Состояние пула и кэша читается в момент опроса /metrics
+metrics.register_gauge("face_crop_engine_queue_depth", "Задачи, ждущие свободного исполнителя пула",
+                       lambda: engine.queue_depth)
+metrics.register_gauge("face_crop_engine_pending", "Задачи в пуле (выполняются и ждут)", lambda: engine.pending)
+metrics.register_gauge("face_crop_engine_workers", "Исполнителей в пуле", lambda: engine.workers)
+metrics.register_gauge("face_crop_engine_pending_megapixels",
+                       "Оценка стоимости задач в пуле (мегапиксели декодирования)", lambda: engine.pending_cost)
+metrics.register_gauge("face_crop_cache_bytes", "Заполнение кэша результатов в памяти (байт)",
+                       lambda: cache.stats()["bytes"])
+metrics.register_gauge("face_crop_cache_hit_ratio", "Доля попаданий в кэш результатов",
+                       lambda: cache.stats()["hit_ratio"])
+
+
+@app.middleware("http")
+async def request_context(request, call_next):
+    """Id запроса для логов (X-Request-ID клиента или новый), возвращается в заголовке ответа."""
+    request_id = log.new_request_id(request.headers.get("x-request-id"))
+    token = log.REQUEST_ID.set(request_id)
+    try:
+        response = await call_next(request)
+    finally:
+        log.REQUEST_ID.reset(token)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
+@app.middleware("http")
+async def count_in_flight(request, call_next):
+    # Считаем только API; /metrics и /health не должны влиять на собственные показания
+    if not request.url.path.startswith("/v1/"):
+        return await call_next(request)
+    metrics.IN_FLIGHT.inc()
+    try:
+        return await call_next(request)
+    finally:
+        metrics.IN_FLIGHT.dec()
+
+
+@app.on_event("startup")
+async def warmup_engine():
+    # Поднимаем исполнителей и загружаем модели до первого запроса
+    await engine.warmup()
+
+
+@app.on_event("startup")
+async def start_jobs():
+    jobs.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_engine():
+    await jobs.stop()
+    engine.shutdown()
+
 
 @app.get("/")
 async def root():
@@ -322,12 +424,12 @@ async def root():
       });
     }
 
-    function renderResultPreviews(images) {
+    function renderResultPreviews(images, withSaveAll = images.length > 1) {
       const container = document.createElement('div');
       container.className = 'result-previews';
       container.innerHTML = '<div class="result-previews-title">Обработанные изображения:</div><div class="grid"></div>';
       const grid = container.querySelector('.grid');
-      if (images.length > 1) {
+      if (withSaveAll) {
         const saveAllWrap = document.createElement('div');
         saveAllWrap.style.marginBottom = '12px';
         const saveAllBtn = document.createElement('button');
@@ -339,28 +441,73 @@ async def root():
         container.insertBefore(saveAllWrap, grid);
       }
       
-      images.forEach((imgData, idx) => {
-        const url = URL.createObjectURL(imgData.blob);
-        const div = document.createElement('div');
-        div.className = 'thumb result-item';
-        const fileName = imgData.filename || ('image_' + (idx + 1) + '.png');
-        const safeName = fileName.replace(/</g, '&lt;');
-        const downloadAttr = fileName.replace(/"/g, '&quot;');
-        div.innerHTML = `
-          <div class="thumb-img-wrapper">
-            <img loading="lazy" src="${url}" alt="result ${idx + 1}" decoding="async"/>
-          </div>
-          <div class="thumb-name">${safeName}</div>
-          <a class="btn-save" href="${url}" download="${downloadAttr}">Сохранить</a>
-        `;
-        div.querySelector('.thumb-img-wrapper').addEventListener('click', (e) => handleInteraction(e, () => openModal(url)));
-        div.querySelector('.thumb-img-wrapper').addEventListener('touchend', (e) => handleInteraction(e, () => openModal(url)));
-        grid.appendChild(div);
-      });
+      images.forEach((imgData, idx) => appendResultItem(grid, imgData, idx));
       
       return container;
     }
 
+    function appendResultItem(grid, imgData, idx) {
+      const url = URL.createObjectURL(imgData.blob);
+      const div = document.createElement('div');
+      div.className = 'thumb result-item';
+      const fileName = imgData.filename || ('image_' + (idx + 1) + '.png');
+      const safeName = fileName.replace(/</g, '&lt;');
+      const downloadAttr = fileName.replace(/"/g, '&quot;');
+      div.innerHTML = `
+        <div class="thumb-img-wrapper">
+          <img loading="lazy" src="${url}" alt="result ${idx + 1}" decoding="async"/>
+        </div>
+        <div class="thumb-name">${safeName}</div>
+        <a class="btn-save" href="${url}" download="${downloadAttr}">Сохранить</a>
+      `;
+      div.querySelector('.thumb-img-wrapper').addEventListener('click', (e) => handleInteraction(e, () => openModal(url)));
+      div.querySelector('.thumb-img-wrapper').addEventListener('touchend', (e) => handleInteraction(e, () => openModal(url)));
+      grid.appendChild(div);
+    }
+
+    function indexOfBytes(hay, needle, from) {
+      outer: for (let i = from; i <= hay.length - needle.length; i++) {
+        for (let j = 0; j < needle.length; j++) if (hay[i + j] !== needle[j]) continue outer;
+        return i;
+      }
+      return -1;
+    }
+
+    // Читает ответ multipart/mixed и вызывает onPart(headers, bytes) для каждой части сразу по приходу
+    async function readMultipart(resp, onPart) {
+      const boundary = ((resp.headers.get('content-type') || '').match(/boundary=([^;]+)/i) || [])[1];
+      if (!boundary) throw new Error('В ответе multipart/mixed нет boundary');
+      const delim = new TextEncoder().encode('--' + boundary);
+      const headEndMark = new Uint8Array([13, 10, 13, 10]);
+      const reader = resp.body.getReader();
+      let buf = new Uint8Array(0);
+      while (true) {
+        const start = indexOfBytes(buf, delim, 0);
+        if (start >= 0 && buf.length > start + delim.length && buf[start + delim.length] === 45) return;  // "--boundary--"
+        const headEnd = start >= 0 ? indexOfBytes(buf, headEndMark, start) : -1;
+        if (headEnd >= 0) {
+          const headers = {};
+          new TextDecoder().decode(buf.subarray(start + delim.length, headEnd)).split('\\r\\n').forEach((line) => {
+            const sep = line.indexOf(':');
+            if (sep > 0) headers[line.slice(0, sep).trim().toLowerCase()] = line.slice(sep + 1).trim();
+          });
+          const bodyStart = headEnd + headEndMark.length;
+          const bodyEnd = bodyStart + parseInt(headers['content-length'] || '0', 10);
+          if (buf.length >= bodyEnd) {
+            onPart(headers, buf.slice(bodyStart, bodyEnd));
+            buf = buf.slice(bodyEnd);
+            continue;
+          }
+        }
+        const { done, value } = await reader.read();
+        if (done) return;
+        const next = new Uint8Array(buf.length + value.length);
+        next.set(buf);
+        next.set(value, buf.length);
+        buf = next;
+      }
+    }
+
     function base64ToBlob(b64, mime) {
       const bin = atob(b64);
       const arr = new Uint8Array(bin.length);
@@ -416,7 +563,9 @@ async def root():
 
       try {
         const startTime = Date.now();
-        const resp = await fetch('/v1/face-crop', { method: 'POST', body: fd });
+        // Несколько файлов — потоковый ответ: каждый результат показывается сразу, как готов
+        const url = selectedFiles.length > 1 ? '/v1/face-crop?stream=1' : '/v1/face-crop';
+        const resp = await fetch(url, { method: 'POST', body: fd });
         const ct = (resp.headers.get('content-type') || '').toLowerCase();
 
         if (!resp.ok) {
@@ -424,11 +573,31 @@ async def root():
           throw new Error(txt || ('HTTP ' + resp.status));
         }
 
-        if (ct.includes('application/json')) {
+        if (ct.includes('multipart/mixed')) {
+          const images = [];
+          let skipped = 0;
+          elResult.innerHTML = '<div class="ok">Обработка… результаты появляются по мере готовности.</div>';
+          const previews = renderResultPreviews(images, true);
+          elResult.appendChild(previews);
+          const grid = previews.querySelector('.grid');
+          await readMultipart(resp, (headers, bytes) => {
+            if (headers['x-status'] !== 'ok') { skipped++; return; }
+            const m = (headers['content-disposition'] || '').match(/filename="([^"]+)"/i);
+            const img = { filename: m ? m[1] : 'face.png', blob: new Blob([bytes], { type: headers['content-type'] || 'image/png' }) };
+            images.push(img);
+            appendResultItem(grid, img, images.length - 1);
+          });
+          if (images.length > 0) {
+            elResult.querySelector('.ok').textContent = 'Готово. Сохраните нужные файлы кнопками ниже.'
+              + (skipped ? ` Лицо не найдено на ${skipped} из ${images.length + skipped} фото.` : '');
+          } else {
+            elResult.innerHTML = '<div class="muted">Не удалось найти лица ни на одном изображении.</div>';
+          }
+        } else if (ct.includes('application/json')) {
           const json = await resp.json();
           const images = (json.images || []).map((img) => ({
             filename: img.filename || 'face.png',
-            blob: base64ToBlob(img.data, 'image/png')
+            blob: base64ToBlob(img.data, img.media_type || 'image/png')
           }));
           if (images.length > 0) {
             elResult.innerHTML = '<div class="ok">Готово. Сохраните нужные файлы кнопками ниже.</div>';
@@ -445,7 +614,7 @@ async def root():
             const m = cd.match(/filename\\*?=(?:UTF-8'')?["']?([^"';]+)["']?/i) || cd.match(/filename=["']?([^"';]+)["']?/i);
             if (m && m[1]) downloadName = m[1].trim();
           }
-          if (ct.includes('image/png')) {
+          if (ct.startsWith('image/')) {
             elResult.innerHTML = `
               <div class="ok">Готово.</div>
               <div style="margin:12px 0;"><a class="btn-save" href="${url}" download="${downloadName.replace(/"/g, '&quot;')}">Сохранить</a></div>
@@ -477,27 +646,282 @@ async def health():
     return {"status": "ok"}
 
 
-def _output_filename(original: str, idx: int) -> str:
-    """Имя для сохранения: оригинальное имя + _512x512.png (только ASCII для HTTP-заголовков)."""
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Метрики в текстовом формате Prometheus: этапы пайплайна, форматы, каскад, очередь."""
+    return Response(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/v1/cache/stats")
+async def cache_stats():
+    """Попадания/промахи и заполнение кэша результатов и хранилища геометрии."""
+    return {**cache.stats(), "geometry": geometry_store.stats()}
+
+
+def _output_filename(original: str, idx: int, ext: str = "png", size: Optional[int] = None,
+                     face: Optional[int] = None) -> str:
+    """
+    Имя для сохранения: оригинальное имя + _512x512.<ext> (только ASCII для HTTP-заголовков);
+    в режиме всех лиц — с номером лица: _face0_512x512.<ext>.
+    """
     stem = Path(original).stem if original else f"image_{idx}"
     stem = re.sub(r"[^a-zA-Z0-9_\-]", "_", stem)[:200]  # только ASCII, иначе latin-1 падает
     stem = stem.strip("_") or f"image_{idx}"
-    return f"{stem}_512x512.png"
+    if face is not None:
+        stem = f"{stem}_face{face}"
+    size = size or 512
+    return f"{stem}_{size}x{size}.{ext}"
+
+
+# Сколько размеров можно запросить за раз (параметр sizes) и их границы — как у size в /crop
+MAX_OUTPUT_SIZES = 8
+MIN_OUTPUT_SIZE = 64
+MAX_OUTPUT_SIZE = 2048
 
 
-def _cleanup_dir(path: str) -> None:
+def _parse_sizes(value: Optional[str]) -> Optional[List[int]]:
+    """Параметр sizes ("512,256,128,64") -> список без повторов в порядке запроса; None — не задан."""
+    if value is None:
+        return None
     try:
-        shutil.rmtree(path, ignore_errors=True)
-    except Exception:
+        sizes = list(dict.fromkeys(int(part) for part in value.split(",") if part.strip()))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="sizes — размеры в пикселях через запятую, например 512,256,128")
+    if not sizes or len(sizes) > MAX_OUTPUT_SIZES:
+        raise HTTPException(status_code=400, detail=f"sizes: от 1 до {MAX_OUTPUT_SIZES} размеров")
+    if any(not MIN_OUTPUT_SIZE <= size <= MAX_OUTPUT_SIZE for size in sizes):
+        raise HTTPException(status_code=400, detail=f"sizes: каждый размер от {MIN_OUTPUT_SIZE} до {MAX_OUTPUT_SIZE}")
+    return sizes
+
+
+def _variants(result: Dict, sizes: Optional[List[int]]) -> List[Tuple[Optional[Dict], Optional[int], bytes]]:
+    """
+    (лицо, размер, байты) каждого результата файла: по одному на размер из sizes (или один по умолчанию)
+    для каждого лица. Лицо — элемент result['faces'] в режиме всех лиц, иначе None.
+    """
+    faces = result["faces"] if "faces" in result else [None]
+    return [
+        (face, size, data)
+        for face in faces
+        for size, data in (
+            [(variant["size"], variant["data"]) for variant in (face or result)["variants"]] if sizes
+            else [(None, (face or result)["data"])]
+        )
+    ]
+
+
+def _variant_filenames(original: str, idx: int, ext: str, sizes: Optional[List[int]]) -> List[str]:
+    return [_output_filename(original, idx, ext, size) for size in (sizes or [None])]
+
+
+def _response_etag(keys: List[str], filenames: List[str]) -> str:
+    """
+    ETag ответа: ключи кэша всех файлов и имена результатов (они попадают в ответ).
+    Ключ определяется байтами и параметрами, так что ETag можно проверить до обработки.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    h.update(json.dumps([keys, filenames]).encode())
+    return f'"{h.hexdigest()}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """If-None-Match: список ETag через запятую, слабое сравнение (W/ игнорируется)."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def _file_timings(outcome: Dict) -> Dict[str, float]:
+    """Тайминги одного файла (мс): ожидание в пуле, обработка и этапы пайплайна FaceProcessor."""
+    timings = {"queue": outcome["queue_time"], "process": outcome["process_time"]}
+    timings.update((outcome.get("stats") or {}).get("stages", {}))
+    return {name: round(seconds * 1000, 2) for name, seconds in timings.items()}
+
+
+def _server_timing(file_timings: List[Dict[str, float]], total: float, read: Optional[float] = None) -> str:
+    """
+    Заголовок Server-Timing: чтение загрузки, этапы (сумма по файлам запроса, мс) и общее время.
+    total и read — в секундах.
+    """
+    summed: Dict[str, float] = {}
+    if read is not None:
+        summed["read"] = read * 1000
+    for timings in file_timings:
+        for name, ms in timings.items():
+            summed[name] = summed.get(name, 0.0) + ms
+    summed["total"] = total * 1000
+    return ", ".join(f"{name};dur={ms:.2f}" for name, ms in summed.items())
+
+
+BUSY_DETAIL = "Сервис перегружен, повторите запрос позже."
+DEADLINE_DETAIL = "Обработка не успевает к дедлайну запроса (X-Deadline-Ms)."
+BATCH_TOO_LARGE_DETAIL = "Файлы запроса вместе больше, чем сервис обрабатывает за раз. Отправьте их несколькими запросами."
+
+# Статус ответа клиенту, который уже отключился (как в nginx; сам ответ никто не получит)
+CLIENT_CLOSED_REQUEST = 499
+
+
+def _busy_error(e: EngineBusy) -> HTTPException:
+    """503 с Retry-After: отказ до обработки, клиент повторит, когда пул разгрузится."""
+    logger.warning("%s", e, extra={"retry_after": e.retry_after})
+    return HTTPException(status_code=503, detail=BUSY_DETAIL, headers={"Retry-After": str(e.retry_after)})
+
+
+def _request_deadline(deadline_ms: Optional[int], start_time: float) -> Optional[float]:
+    """Дедлайн (time.time()) из заголовка X-Deadline-Ms — сколько миллисекунд клиент готов ждать."""
+    if deadline_ms is None:
+        return None
+    if deadline_ms <= 0:
+        raise HTTPException(status_code=400, detail="X-Deadline-Ms должен быть положительным числом миллисекунд")
+    return start_time + deadline_ms / 1000
+
+
+async def _wait_disconnect(request: Request) -> None:
+    # Тело запроса уже прочитано, следующее сообщение ASGI — http.disconnect.
+    # (request.is_disconnected() за BaseHTTPMiddleware в этой версии Starlette отключения не видит)
+    while (await request.receive())["type"] != "http.disconnect":
         pass
 
 
+async def _unless_disconnected(request: Request, awaitable):
+    """
+    Ждёт awaitable, пока клиент подключён. Если клиент отключился раньше — отменяет ожидание:
+    файлы, ещё не начатые в пуле, снимаются с очереди и не занимают исполнителей.
+
+    Returns:
+        (True, результат) или (False, None), если клиент отключился
+    """
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(_wait_disconnect(request))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+        if task.done():
+            return True, task.result()
+        metrics.CLIENT_DISCONNECTS.inc()
+        logger.info("Клиент отключился до завершения обработки, задачи отменены")
+        return False, None
+    finally:
+        task.cancel()
+        watcher.cancel()
+
+
+NO_FACE_DETAIL = "Не удалось найти лицо на изображении. Убедитесь, что на фотографии четко видно лицо человека."
+
+
+def _multipart_part(boundary: str, headers: Dict[str, str], body: bytes) -> bytes:
+    """Одна часть multipart/mixed: заголовки (ASCII), Content-Length и тело."""
+    head = "".join(f"{name}: {value}\r\n" for name, value in headers.items())
+    return f"--{boundary}\r\n{head}Content-Length: {len(body)}\r\n\r\n".encode("latin-1") + body + b"\r\n"
+
+
+async def _stream_parts(tasks: List["asyncio.Task"], inputs: List[Tuple[bytes, str]], keys: List[str],
+                        ext: str, boundary: str, start_time: float,
+                        sizes: Optional[List[int]] = None) -> AsyncIterator[bytes]:
+    """
+    Отдаёт результаты частями multipart/mixed по мере готовности (в порядке завершения).
+
+    Заголовки части: Content-Type, Content-Disposition (имя результата), X-Index (номер файла
+    в запросе), X-Face (с all_faces: номер лица слева направо), X-Size (с sizes: по части на размер,
+    подряд), X-Status (ok / no-face / error),
+    X-Queue-Time и X-Process-Time (секунды),
+    Server-Timing (этапы файла, total — с начала запроса), ETag, X-Cache (hit / miss)
+    при включённом кэше, X-Image-Id для повторного кропа.
+    Если клиент отключился, ещё не начатые задачи отменяются.
+    """
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            try:
+                idx, outcome = await next_done
+            except DeadlineExceeded as e:
+                body = json.dumps({"detail": str(e)}, ensure_ascii=False).encode()
+                yield _multipart_part(boundary, {"Content-Type": "application/json", "X-Status": "deadline-exceeded"}, body)
+                continue
+            except Exception as e:
+                logger.error("Ошибка обработки в потоковом ответе: %s: %s", type(e).__name__, e)
+                body = json.dumps({"detail": f"{type(e).__name__}: {e}"[:200]}).encode()
+                yield _multipart_part(boundary, {"Content-Type": "application/json", "X-Status": "error"}, body)
+                continue
+            result = outcome["result"]
+            headers = {
+                "Content-Type": result["media_type"] if result else "application/json",
+                "X-Index": str(idx),
+                "X-Status": "ok" if result else "no-face",
+                "X-Queue-Time": f"{outcome['queue_time']:.3f}",
+                "X-Process-Time": f"{outcome['process_time']:.3f}",
+                "Server-Timing": _server_timing([_file_timings(outcome)], time.time() - start_time),
+            }
+            if "cache" in outcome:
+                headers["X-Cache"] = outcome["cache"]
+            if result and result.get("image_id"):
+                headers["X-Image-Id"] = result["image_id"]
+            if not result:
+                out_name = _output_filename(inputs[idx][1], idx, ext)
+                body = json.dumps({"filename": out_name, "detail": NO_FACE_DETAIL}, ensure_ascii=False).encode()
+                headers["Content-Disposition"] = f'attachment; filename="{out_name}"'
+                headers["ETag"] = _response_etag([keys[idx]], [out_name])
+                yield _multipart_part(boundary, headers, body)
+                continue
+            for face, size, data in _variants(result, sizes):
+                out_name = _output_filename(inputs[idx][1], idx, ext, size, face and face["face"])
+                part_headers = {
+                    **headers,
+                    "Content-Disposition": f'attachment; filename="{out_name}"',
+                    "ETag": _response_etag([keys[idx]], [out_name]),
+                }
+                if face:
+                    part_headers["X-Face"] = str(face["face"])
+                if size:
+                    part_headers["X-Size"] = str(size)
+                yield _multipart_part(boundary, part_headers, data)
+        yield f"--{boundary}--\r\n".encode("latin-1")
+        logger.info("Потоковый ответ: %d файлов за %.2fс", len(tasks), time.time() - start_time,
+                    extra={"files": len(tasks), "duration_ms": round((time.time() - start_time) * 1000, 1)})
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
 @app.post("/v1/face-crop")
-async def face_crop(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...)):
+async def face_crop(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    output_format: Optional[str] = Query(None, alias="format", description="png, jpeg, webp или avif"),
+    quality: Optional[int] = Query(None, ge=1, le=100, description="Качество для jpeg/webp/avif"),
+    stream: bool = Query(False, description="Отдавать результаты по мере готовности (multipart/mixed)"),
+    timings: bool = Query(False, description="Добавить тайминги этапов каждого файла в JSON-ответ"),
+    sizes: Optional[str] = Query(None, description="Несколько размеров результата через запятую, например 512,256,128,64"),
+    all_faces: bool = Query(False, description="Кропы всех лиц на фото (до FACE_CROP_MAX_FACES на изображение)"),
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    x_deadline_ms: Optional[int] = Header(None),
+):
     """
     Обрабатывает до 5 фотографий с лицами.
-    Один файл — возвращает PNG 512×512.
+    Один файл — возвращает изображение 512×512.
+    sizes — несколько размеров за один проход (детекция и выравнивание один раз на файл):
+    в JSON по элементу на размер (поле size), в потоковом ответе — по части (X-Size).
+    all_faces — кропы всех лиц (групповое фото) за одно декодирование и одну детекцию: в JSON
+    по элементу на лицо (face, score, bbox) — JSON и при одном найденном лице,
+    в потоковом ответе — по части (X-Face).
     Несколько файлов — возвращает JSON с массивом изображений (base64), без архива.
+    С stream=true (или Accept: multipart/mixed) — multipart/mixed, каждая картинка отдельной
+    бинарной частью сразу после готовности, в порядке завершения.
+    
+    Формат результата: параметр format, иначе по заголовку Accept, иначе PNG.
+    Ответ с ETag; при совпадении If-None-Match — 304 без обработки.
+    Server-Timing — чтение, этапы пайплайна (сумма по файлам) и общее время, мс;
+    с timings=true у каждого изображения в JSON есть свои тайминги.
+
+    Приём ограничен по числу и стоимости (мегапиксели) задач в пуле: при перегрузке — сразу 503
+    с Retry-After. Файлы запроса принимаются вместе; если они вместе больше ёмкости или бюджета
+    пула даже в пустом пуле — 413 (повтор не поможет). X-Deadline-Ms — сколько миллисекунд клиент готов ждать: если обработка
+    не успевает (по оценке или файлы не начались вовремя) — 504 без обработки.
+    Если клиент отключился, ещё не начатые файлы снимаются с очереди.
+    Изображения больше FACE_CROP_MAX_MEGAPIXELS (по заголовку) — 413 без декодирования.
     """
     if len(files) > 5:
         raise HTTPException(status_code=400, detail="Maximum 5 files allowed")
@@ -505,78 +929,354 @@ async def face_crop(background_tasks: BackgroundTasks, files: List[UploadFile] =
     if len(files) == 0:
         raise HTTPException(status_code=400, detail="At least one file required")
     
-    temp_dir = tempfile.mkdtemp()
-    background_tasks.add_task(_cleanup_dir, temp_dir)
+    try:
+        fmt = negotiate_format(output_format, accept)
+    except EncodingError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    size_list = _parse_sizes(sizes)
+    # Параметры рендеринга: от них зависят ключ кэша и ETag (без sizes и all_faces — как раньше)
+    render_options = {"output_format": fmt, "quality": quality}
+    if size_list:
+        render_options["sizes"] = tuple(size_list)
+    if all_faces:
+        render_options["max_faces"] = config.MAX_FACES
     
     try:
         start_time = time.time()
-        processed = []
+        deadline = _request_deadline(x_deadline_ms, start_time)
+        # Читаем все файлы, затем обрабатываем их параллельно в пуле (event loop не блокируется)
+        inputs = []
         for idx, file in enumerate(files):
-            # Чтение файла
-            file_start = time.time()
-            contents = await file.read()
-            read_time = time.time() - file_start
-            
-            # Обработка лица
-            process_start = time.time()
             filename = file.filename or f"image_{idx}"
+            # Большие файлы — mmap спуленного временного файла, а не bytes (см. app.uploads)
+            contents = await asyncio.to_thread(
+                read_upload, file, filename, config.MAX_FILE_BYTES, config.UPLOAD_MMAP_BYTES
+            )
             # На мобилках (особенно iOS/Safari) content-type может быть пустым или application/octet-stream.
             # Поэтому НЕ фильтруем по content_type — пробуем декодировать по фактическим байтам.
-            print(f"Входной файл {idx+1}: name={filename!r}, content_type={file.content_type!r}, bytes={len(contents)}")
-            result = face_processor.process_image(contents, filename)
-            process_time = time.time() - process_start
-            
-            print(f"Файл {idx+1}: чтение={read_time:.2f}с, обработка={process_time:.2f}с")
+            logger.debug("Входной файл %d: name=%r, content_type=%r, bytes=%d",
+                         idx + 1, filename, file.content_type, len(contents))
+            inputs.append((contents, filename))
+        read_time = time.time() - start_time
+
+        # Ответ зависит от Accept, если формат не задан явно
+        vary = {"Vary": "Accept"}
+        ext = file_extension(fmt)
+        digests = [content_hash(contents) for contents, _ in inputs]
+        keys = [engine.cache_key(digest, **render_options) for digest in digests]
+
+        if stream or "multipart/mixed" in (accept or ""):
+            tasks = engine.submit_many(inputs, digests=digests, deadline=deadline, **render_options)
+            boundary = uuid.uuid4().hex
+            return StreamingResponse(
+                _stream_parts(tasks, inputs, keys, ext, boundary, start_time, size_list),
+                media_type=f"multipart/mixed; boundary={boundary}",
+                headers=vary,
+            )
+
+        # Результат детерминирован по байтам и параметрам — ETag известен до обработки
+        etag = _response_etag(keys, [
+            out_name for idx, (_, name) in enumerate(inputs) for out_name in _variant_filenames(name, idx, ext, size_list)
+        ])
+        if _etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers={"ETag": etag, **vary})
+
+        connected, outcomes = await _unless_disconnected(
+            request,
+            engine.process_many(inputs, digests=digests, deadline=deadline, **render_options),
+        )
+        if not connected:
+            return Response(status_code=CLIENT_CLOSED_REQUEST)
+
+        processed = []
+        file_timings = [_file_timings(outcome) for outcome in outcomes]
+        for idx, ((_, filename), outcome) in enumerate(zip(inputs, outcomes)):
+            result = outcome["result"]
+            logger.debug("Файл %d: %s, кэш=%s", idx + 1, "ok" if result else "no-face", outcome.get("cache", "off"),
+                         extra={"timings": file_timings[idx]})
             
             if result:
-                out_name = _output_filename(filename, idx)
-                output_path = os.path.join(temp_dir, out_name)
-                result['image'].save(output_path)
-                processed.append(
-                    {
-                        "path": output_path,
-                        "filename": out_name,
-                    }
-                )
+                # Результат уже закодирован в пуле — ответ собирается без файловой системы
+                for face, size, data in _variants(result, size_list):
+                    processed.append(
+                        {
+                            "data": data,
+                            "media_type": result["media_type"],
+                            "filename": _output_filename(filename, idx, ext, size, face and face["face"]),
+                            "face": face,
+                            "size": size,
+                            "image_id": result.get("image_id"),
+                            "timings": file_timings[idx],
+                        }
+                    )
         
+        total_time = time.time() - start_time
+        faces = sum(1 for outcome in outcomes if outcome["result"])
+        logger.info(
+            "Обработано %d файлов за %.2fс, лицо найдено в %d", len(inputs), total_time, faces,
+            extra={"files": len(inputs), "faces": faces, "format": fmt,
+                   "duration_ms": round(total_time * 1000, 1)},
+        )
         if not processed:
             raise HTTPException(
                 status_code=400, 
                 detail="Не удалось найти лица ни на одном изображении. Убедитесь, что на фотографиях четко видно лицо человека."
             )
 
-        total_time = time.time() - start_time
-        print(f"✅ Обработано {len(processed)} файлов за {total_time:.2f}с (среднее: {total_time/len(processed):.2f}с на файл)")
+        server_timing = _server_timing(file_timings, total_time, read=read_time)
 
-        # Если один файл — возвращаем PNG с именем оригинал_512x512.png
-        if len(processed) == 1:
-            with open(processed[0]["path"], "rb") as f:
-                data = f.read()
+        # Если один файл — возвращаем изображение с именем оригинал_512x512.<ext>.
+        # С all_faces ответ всегда списком, даже если на фото нашлось одно лицо
+        if len(processed) == 1 and not all_faces:
             fname = processed[0]["filename"]
-            return Response(
-                content=data,
-                media_type="image/png",
-                headers={"Content-Disposition": f'attachment; filename="{fname}"'},
-            )
+            headers = {
+                "Content-Disposition": f'attachment; filename="{fname}"',
+                "ETag": etag,
+                "Server-Timing": server_timing,
+                **vary,
+            }
+            if processed[0]["image_id"]:
+                headers["X-Image-Id"] = processed[0]["image_id"]
+            return Response(content=processed[0]["data"], media_type=processed[0]["media_type"], headers=headers)
 
         # Несколько файлов — JSON с base64 (без архива)
         images_payload = []
         for item in processed:
-            with open(item["path"], "rb") as f:
-                data_b64 = base64.b64encode(f.read()).decode("ascii")
-            images_payload.append({"filename": item["filename"], "data": data_b64})
-        return JSONResponse(content={"images": images_payload})
+            data_b64 = base64.b64encode(item["data"]).decode("ascii")
+            entry = {
+                "filename": item["filename"],
+                "media_type": item["media_type"],
+                "image_id": item["image_id"],
+                "data": data_b64,
+            }
+            if item["face"]:
+                entry["face"] = item["face"]["face"]
+                entry["score"] = round(item["face"]["score"], 3)
+                entry["bbox"] = [round(float(v), 1) for v in item["face"]["bbox"]]
+            if item["size"]:
+                entry["size"] = item["size"]
+            if timings:
+                entry["timings"] = item["timings"]
+            images_payload.append(entry)
+        return JSONResponse(
+            content={"images": images_payload},
+            headers={"ETag": etag, "Server-Timing": server_timing, **vary},
+        )
     
     except HTTPException:
         raise
+    except EngineBusy as e:
+        raise _busy_error(e)
+    except BatchTooLarge as e:
+        # Не поместится и в пустой пул — 413 без Retry-After: повтор того же запроса не поможет
+        logger.info("%s", e)
+        raise HTTPException(status_code=413, detail=BATCH_TOO_LARGE_DETAIL)
+    except DeadlineExceeded as e:
+        logger.info("%s", e)
+        raise HTTPException(status_code=504, detail=DEADLINE_DETAIL)
+    except ImageTooLarge as e:
+        logger.info("Изображение отклонено до декодирования: %s", e)
+        raise HTTPException(status_code=413, detail=f"Изображение слишком большое: {e}")
     except Exception as e:
-        import traceback
         err_msg = f"{type(e).__name__}: {e}"
-        print(f"❌ Критическая ошибка обработки: {err_msg}")
-        print(traceback.format_exc())
+        logger.exception("Критическая ошибка обработки: %s", err_msg)
         # Показываем пользователю реальную причину (без путей и стека)
         safe_detail = err_msg[:200].replace("\n", " ")
         raise HTTPException(
             status_code=500,
             detail=f"Ошибка обработки изображений: {safe_detail}. Попробуйте другой формат (JPEG, PNG, HEIC, AVIF) или другой файл."
         )
+
+
+@app.get("/v1/images/{image_id}")
+async def image_geometry(image_id: str):
+    """Сохранённая геометрия лица (id из X-Image-Id / image_id ответа /v1/face-crop)."""
+    stored = geometry_store.get(image_id)
+    if stored is None:
+        raise HTTPException(status_code=404, detail="Изображение не найдено или устарело, загрузите его заново.")
+    _, geometry = stored
+    return {
+        "image_id": image_id,
+        "image_size": list(geometry["image_size"]),
+        "orientation": geometry["orientation"],
+        "bbox": [round(float(v), 1) for v in geometry["bbox"]],
+        "face_center": [round(float(v), 1) for v in geometry["face_center"]],
+        "face_size": round(float(geometry["face_size"]), 1),
+        "rotation_angle": round(geometry["rotation_angle"], 2),
+    }
+
+
+@app.get("/v1/images/{image_id}/crop")
+async def image_crop(
+    request: Request,
+    image_id: str,
+    size: Optional[int] = Query(None, ge=64, le=2048, description="Размер выходного квадрата"),
+    face_fill_ratio: Optional[float] = Query(None, gt=0.05, le=0.95, description="Доля высоты кадра под лицо"),
+    crop_shift_up: Optional[float] = Query(None, ge=0.0, le=0.5, description="Сдвиг кадра вверх (доля размера)"),
+    output_format: Optional[str] = Query(None, alias="format", description="png, jpeg, webp или avif"),
+    quality: Optional[int] = Query(None, ge=1, le=100, description="Качество для jpeg/webp/avif"),
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None),
+    x_deadline_ms: Optional[int] = Header(None),
+):
+    """
+    Повторный кроп уже обработанного изображения с другим кадрированием.
+
+    Детекция и Face Mesh не запускаются: используется геометрия, сохранённая при
+    первой обработке, остаются декодирование, один warpAffine и кодирование.
+    Декодирование сверх FACE_CROP_MAX_MEGAPIXELS (по заголовку) — 413.
+    """
+    if image_id not in geometry_store:
+        raise HTTPException(status_code=404, detail="Изображение не найдено или устарело, загрузите его заново.")
+    try:
+        fmt = negotiate_format(output_format, accept)
+    except EncodingError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    options = {
+        "output_format": fmt,
+        "quality": quality,
+        "output_size": size,
+        "face_fill_ratio": face_fill_ratio,
+        "crop_shift_up": crop_shift_up,
+    }
+    etag = f'"{engine.render_key(image_id, **options)}"'
+    headers = {"ETag": etag, "Vary": "Accept"}
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+
+    deadline = _request_deadline(x_deadline_ms, time.time())
+    try:
+        connected, outcome = await _unless_disconnected(request, engine.render(image_id, deadline=deadline, **options))
+    except EngineBusy as e:
+        raise _busy_error(e)
+    except DeadlineExceeded as e:
+        logger.info("%s", e)
+        raise HTTPException(status_code=504, detail=DEADLINE_DETAIL)
+    except ImageTooLarge as e:
+        logger.info("Повторный кроп отклонён до декодирования: %s", e)
+        raise HTTPException(status_code=413, detail=f"Изображение слишком большое: {e}")
+    if not connected:
+        return Response(status_code=CLIENT_CLOSED_REQUEST)
+    if outcome is None:
+        raise HTTPException(status_code=404, detail="Изображение не найдено или устарело, загрузите его заново.")
+    result = outcome["result"]
+    if result is None and (outcome.get("stats") or {}).get("outcome") == "too-large":
+        raise HTTPException(status_code=413, detail=f"Изображение слишком большое: кроп больше "
+                                                    f"{config.MAX_MEGAPIXELS:g} МП при декодировании")
+    if result is None:
+        raise HTTPException(status_code=500, detail="Не удалось построить кроп по сохранённой геометрии.")
+
+    out_size = size or config.OUTPUT_SIZE
+    fname = f"{image_id[:12]}_{out_size}x{out_size}.{file_extension(fmt)}"
+    headers["Content-Disposition"] = f'attachment; filename="{fname}"'
+    file_timings = _file_timings(outcome)
+    headers["Server-Timing"] = _server_timing([file_timings], outcome["queue_time"] + outcome["process_time"])
+    logger.info("Повторный кроп %s, кэш=%s", image_id[:12], outcome.get("cache", "off"),
+                extra={"image_id": image_id, "timings": file_timings})
+    return Response(content=result["data"], media_type=result["media_type"], headers=headers)
+
+
+# Асинхронные задания для больших пакетов: тот же пул, низкий приоритет
+jobs = JobManager(
+    engine,
+    jobs_dir=config.JOBS_DIR,
+    workers=config.JOB_WORKERS,
+    max_files=config.JOB_MAX_FILES,
+    ttl=config.JOB_TTL,
+    output_filename=_output_filename,
+)
+
+JOB_NOT_FOUND_DETAIL = "Задание не найдено или уже удалено."
+
+
+@app.post("/v1/jobs", status_code=202)
+async def create_job(
+    files: List[UploadFile] = File(...),
+    output_format: Optional[str] = Query(None, alias="format", description="png, jpeg, webp или avif"),
+    quality: Optional[int] = Query(None, ge=1, le=100, description="Качество для jpeg/webp/avif"),
+    accept: Optional[str] = Header(None),
+):
+    """
+    Принимает пакет до JOB_MAX_FILES файлов и сразу возвращает id задания (202).
+
+    Файлы обрабатываются в фоне; прогресс — GET /v1/jobs/{id}, результаты —
+    GET /v1/jobs/{id}/results/{index} или GET /v1/jobs/{id}/results.zip.
+    Формат выбирается так же, как в /v1/face-crop (Accept учитывается, если format не задан).
+    """
+    if len(files) > jobs.max_files:
+        raise HTTPException(status_code=400, detail=f"Maximum {jobs.max_files} files per job allowed")
+    try:
+        fmt = negotiate_format(output_format, accept)
+    except EncodingError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    for idx, file in enumerate(files):
+        if config.MAX_FILE_BYTES and upload_size(file) > config.MAX_FILE_BYTES:
+            raise file_too_large(file.filename or f"image_{idx}", config.MAX_FILE_BYTES)
+
+    job = jobs.create({"output_format": fmt, "quality": quality})
+    try:
+        # Загруженные файлы переносятся на диск задания, в памяти их не держим
+        for idx, file in enumerate(files):
+            path = jobs.add_input(job, file.filename or f"image_{idx}")
+            await asyncio.to_thread(_spool_upload, file, path)
+    except Exception:
+        jobs.cancel(job.id)
+        raise
+    jobs.submit(job)
+    logger.info("Задание %s: %d файлов поставлено в очередь", job.id, len(files),
+                extra={"job_id": job.id, "files": len(files), "format": fmt})
+    return JSONResponse(
+        status_code=202,
+        content=job.to_dict(),
+        headers={"Location": f"/v1/jobs/{job.id}"},
+    )
+
+
+def _spool_upload(file: UploadFile, path: Path) -> None:
+    file.file.seek(0)
+    with open(path, "wb") as out:
+        shutil.copyfileobj(file.file, out, length=1024 * 1024)
+
+
+@app.get("/v1/jobs/{job_id}")
+async def job_status(job_id: str, items: bool = Query(False, description="Включить статус каждого файла")):
+    """Статус и прогресс задания; с items=true — статус каждого файла и имя результата."""
+    try:
+        return jobs.get(job_id).to_dict(with_items=items)
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail=JOB_NOT_FOUND_DETAIL)
+
+
+@app.get("/v1/jobs/{job_id}/results.zip")
+async def job_archive(job_id: str):
+    """Все результаты завершённого задания одним ZIP-архивом."""
+    try:
+        job = jobs.get(job_id)
+        if job.status != JOB_DONE:
+            raise HTTPException(status_code=409, detail=f"Задание ещё не завершено ({job.completed}/{len(job.items)}).")
+        path = await jobs.archive(job_id)
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail=JOB_NOT_FOUND_DETAIL)
+    return FileResponse(path, media_type="application/zip", filename=f"job_{job_id}.zip")
+
+
+@app.get("/v1/jobs/{job_id}/results/{index}")
+async def job_result(job_id: str, index: int):
+    """Результат одного файла задания (index — порядковый номер файла в запросе, с 0)."""
+    try:
+        path = jobs.result_path(job_id, index)
+        fmt = jobs.get(job_id).options["output_format"]
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail="Результат не найден: файл ещё не обработан, без лица или задание удалено.")
+    return FileResponse(path, media_type=media_type(fmt), filename=path.name)
+
+
+@app.delete("/v1/jobs/{job_id}")
+async def delete_job(job_id: str):
+    """Отменяет задание (если не завершено) и удаляет его файлы."""
+    try:
+        return jobs.cancel(job_id).to_dict()
+    except JobNotFound:
+        raise HTTPException(status_code=404, detail=JOB_NOT_FOUND_DETAIL)
@@ -0,0 +1,237 @@
+"""
+Метрики в формате Prometheus (GET /metrics).
+
+Минимальная реализация счётчиков, gauge и гистограмм с метками — без prometheus_client:
+метрики обновляются только из event loop (по результатам пула), блокировки не нужны.
+Значения свои у каждого воркера uvicorn; при нескольких воркерах Prometheus
+должен опрашивать каждый (или запускайте один воркер с FACE_CROP_ENGINE=process).
+"""
+import math
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Границы гистограмм длительности (секунды): от долей миллисекунды до десятков секунд
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# Границы гистограммы размера входа (мегапиксели)
+MEGAPIXEL_BUCKETS = (0.1, 0.3, 1.0, 2.0, 4.0, 8.0, 12.0, 16.0, 24.0, 48.0, 100.0)
+# Границы гистограммы числа лиц на изображении (режим всех лиц)
+FACE_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        if not self.labelnames and not self._values:
+            return [f"{self.name} 0"]
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in sorted(self._values.items())
+        ]
+
+
+class Gauge(_Metric):
+    """Gauge; если задан callback, значение читается в момент опроса."""
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation)
+        self.callback = callback
+        self._value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self._value -= amount
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def value(self) -> float:
+        return float(self.callback()) if self.callback else self._value
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name} {_format_value(self.value())}"]
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # метки -> (счётчики по корзинам, сумма, количество)
+        self._series: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = ([0] * len(self.buckets), [0.0, 0.0])
+        counts, totals = series
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        totals[0] += value
+        totals[1] += 1
+
+    def count(self, **labels: str) -> int:
+        series = self._series.get(self._key(labels))
+        return int(series[1][1]) if series else 0
+
+    def _samples(self) -> List[str]:
+        lines = []
+        inf = 'le="+Inf"'
+        for key, (counts, (total, count)) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, inf)} {int(count)}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {int(count)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Этапы пайплайна FaceProcessor (метка stage): probe, decode, orientation, resize,
+# detect_fast, detect_long, mesh, align, render, encode
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "face_crop_stage_seconds", "Время этапа пайплайна FaceProcessor", ("stage",)))
+QUEUE_SECONDS = REGISTRY.register(Histogram(
+    "face_crop_queue_seconds", "Ожидание свободного исполнителя пула", ("method",)))
+PROCESS_SECONDS = REGISTRY.register(Histogram(
+    "face_crop_process_seconds", "Время выполнения задачи в исполнителе пула", ("method",)))
+INPUT_MEGAPIXELS = REGISTRY.register(Histogram(
+    "face_crop_input_megapixels", "Размер входного изображения (мегапиксели, по заголовку)",
+    buckets=MEGAPIXEL_BUCKETS))
+DECODED_MEGAPIXELS = REGISTRY.register(Histogram(
+    "face_crop_decoded_megapixels", "Размер декодирования (мегапиксели, с учётом уменьшенного декодирования JPEG)",
+    buckets=MEGAPIXEL_BUCKETS))
+FACES_DETECTED = REGISTRY.register(Histogram(
+    "face_crop_faces_detected", "Лица не ниже FACE_CROP_MIN_FACE_SCORE на изображении в режиме всех лиц (до лимита)",
+    buckets=FACE_COUNT_BUCKETS))
+IMAGES = REGISTRY.register(Counter(
+    "face_crop_images_total",
+    "Обработанные изображения по результату (ok, no-face, too-large, error) и источнику (pool, cache, coalesced)",
+    ("outcome", "source")))
+INPUT_FORMATS = REGISTRY.register(Counter(
+    "face_crop_input_format_total", "Входные изображения по формату (по заголовку)", ("format",)))
+DECODERS = REGISTRY.register(Counter(
+    "face_crop_decoder_total", "Каким декодером прочитано изображение: opencv или pil (fallback)", ("decoder",)))
+CASCADE_ESCALATIONS = REGISTRY.register(Counter(
+    "face_crop_cascade_escalations_total", "Запуски точной модели детекции (быстрая не нашла уверенного лица)"))
+FULL_DECODES = REGISTRY.register(Counter(
+    "face_crop_full_decodes_total", "Повторные декодирования в полном разрешении (уменьшенного не хватило)"))
+COALESCED = REGISTRY.register(Counter(
+    "face_crop_coalesced_total", "Изображения, присоединённые к уже идущей обработке того же входа с теми же параметрами"))
+OVERSIZED = REGISTRY.register(Counter(
+    "face_crop_oversized_images_total", "Изображения, отклонённые до декодирования: больше бюджета пикселей (413)"))
+ENGINE_BUSY = REGISTRY.register(Counter(
+    "face_crop_engine_busy_total", "Отказы из-за заполненной очереди пула (503)"))
+DEADLINES_EXCEEDED = REGISTRY.register(Counter(
+    "face_crop_deadline_exceeded_total",
+    "Задачи, отклонённые из-за дедлайна запроса: admission — не успели бы, queue — истёк в очереди", ("stage",)))
+CLIENT_DISCONNECTS = REGISTRY.register(Counter(
+    "face_crop_client_disconnects_total", "Запросы, отменённые из-за отключения клиента до конца обработки"))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    "face_crop_in_flight_requests", "HTTP-запросы к /v1/*, которые обрабатываются сейчас"))
+
+
+def observe_outcome(method: str, outcome: Dict) -> None:
+    """Записывает тайминги и статистику пайплайна из результата ProcessingEngine.run()."""
+    QUEUE_SECONDS.observe(outcome["queue_time"], method=method)
+    PROCESS_SECONDS.observe(outcome["process_time"], method=method)
+    stats = outcome.get("stats") or {}
+    for stage, seconds in stats.get("stages", {}).items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+    if stats.get("format") is not None or stats.get("megapixels") is not None:
+        INPUT_FORMATS.inc(format=stats.get("format") or "unknown")
+    if stats.get("megapixels"):
+        INPUT_MEGAPIXELS.observe(stats["megapixels"])
+    if stats.get("decoded_megapixels"):
+        DECODED_MEGAPIXELS.observe(stats["decoded_megapixels"])
+    if stats.get("faces") is not None:
+        FACES_DETECTED.observe(stats["faces"])
+    for decoder in stats.get("decoders", ()):
+        DECODERS.inc(decoder=decoder)
+    if stats.get("cascade_escalated"):
+        CASCADE_ESCALATIONS.inc()
+    if stats.get("full_decode"):
+        FULL_DECODES.inc()
+    if stats.get("outcome"):
+        IMAGES.inc(outcome=stats["outcome"], source="pool")
+
+
+def register_gauge(name: str, documentation: str, callback: Callable[[], float]) -> Gauge:
+    """Gauge, значение которого читается при опросе (глубина очереди, заполнение кэша)."""
+    return REGISTRY.register(Gauge(name, documentation, callback))
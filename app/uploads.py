@@ -0,0 +1,158 @@
+"""
+Приём загрузок: лимиты размера на сервере и чтение больших файлов без копии в памяти.
+
+- BodyLimitMiddleware ограничивает тело запроса ещё во время приёма: по Content-Length —
+  до чтения тела, иначе — по мере поступления байтов (chunked). Лимит на файл проверяется
+  там же — по размеру текущей части multipart (_PartCounter, по границам в потоке байтов).
+  Превышение — 413, остаток тела не читается и не спулится: на диск попадает не больше
+  лимита и одного фрагмента тела
+- read_upload ещё раз проверяет лимит на файл по уже спуленному размеру (точно, с именем
+  файла: в потоке размер части включает её заголовки) и отдаёт большие файлы как mmap
+  временного файла (multipart-парсер Starlette держит в памяти только первый 1 МБ файла):
+  пайплайн декодирует из отображённых страниц, RSS воркера не растёт на размер каждой загрузки
+"""
+import mmap
+from typing import Dict, Optional, Union
+
+from fastapi import HTTPException, UploadFile
+from fastapi.responses import JSONResponse
+
+# Запас на заголовки части multipart (Content-Disposition с именем файла, Content-Type)
+# сверх лимита на файл при проверке в потоке
+PART_HEADERS_ALLOWANCE = 16 * 1024
+
+# Что отдаёт read_upload: bytes для небольших файлов, mmap (только чтение) для больших.
+# Оба поддерживают buffer protocol — хэш, cv2.imdecode и PIL (через face_processor) читают без копии
+UploadData = Union[bytes, mmap.mmap]
+
+
+def _mb(limit: int) -> str:
+    return f"{limit / (1024 * 1024):.0f} МБ"
+
+
+def request_too_large(limit: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Запрос больше допустимого ({_mb(limit)})")
+
+
+def file_too_large(filename: str, limit: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Файл {filename!r} больше допустимого ({_mb(limit)})")
+
+
+def part_too_large(limit: int) -> HTTPException:
+    return HTTPException(status_code=413, detail=f"Файл больше допустимого ({_mb(limit)})")
+
+
+def multipart_boundary(content_type: str) -> Optional[bytes]:
+    """Граница из Content-Type multipart/form-data; None — не multipart."""
+    media, *params = content_type.split(";")
+    if media.strip().lower() != "multipart/form-data":
+        return None
+    for param in params:
+        name, _, value = param.strip().partition("=")
+        if name.lower() == "boundary" and value:
+            return value.strip('"').encode("latin-1")
+    return None
+
+
+class _PartCounter:
+    """Размер текущей части multipart по мере поступления тела; разделитель может прийти разрезанным."""
+
+    def __init__(self, boundary: bytes, limit: int):
+        self.delimiter = b"--" + boundary
+        self.limit = limit
+        self.part = 0  # байты текущей части, уже точно не входящие в разделитель
+        self._tail = b""  # конец прошлого фрагмента, который может оказаться началом разделителя
+
+    def feed(self, chunk: bytes) -> bool:
+        """Учитывает фрагмент тела; False — часть (файл) больше лимита."""
+        data = self._tail + chunk
+        pos = 0
+        while True:
+            found = data.find(self.delimiter, pos)
+            if found == -1:
+                break
+            if self.part + found - pos > self.limit:
+                return False
+            self.part = 0
+            pos = found + len(self.delimiter)
+        keep = min(len(data) - pos, len(self.delimiter) - 1)
+        self._tail = data[len(data) - keep:] if keep else b""
+        self.part += len(data) - pos - keep
+        return self.part <= self.limit
+
+
+class BodyLimitMiddleware:
+    """
+    ASGI-middleware: лимит тела POST-запроса по пути (limits: путь -> байты, 0 — без лимита)
+    и лимит на один файл multipart (part_limits: путь -> байты файла, 0 — без лимита).
+
+    Чистый ASGI, а не @app.middleware("http"): нужно обернуть receive, чтобы считать
+    байты до того, как multipart-парсер их спулит.
+    """
+
+    def __init__(self, app, limits: Dict[str, int], part_limits: Optional[Dict[str, int]] = None):
+        self.app = app
+        self.limits = {path: limit for path, limit in limits.items() if limit > 0}
+        self.part_limits = {path: limit for path, limit in (part_limits or {}).items() if limit > 0}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "POST":
+            return await self.app(scope, receive, send)
+        limit = self.limits.get(scope["path"])
+        part_limit = self.part_limits.get(scope["path"])
+        headers = dict(scope["headers"])
+        boundary = multipart_boundary(headers.get(b"content-type", b"").decode("latin-1")) if part_limit else None
+        if limit is None and boundary is None:
+            return await self.app(scope, receive, send)
+
+        content_length = headers.get(b"content-length")
+        if limit and content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            # Отказ до чтения тела: клиент не успевает отправить лишние мегабайты
+            response = JSONResponse(status_code=413, content={"detail": request_too_large(limit).detail})
+            return await response(scope, receive, send)
+
+        received = 0
+        parts = _PartCounter(boundary, part_limit + PART_HEADERS_ALLOWANCE) if boundary else None
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                body = message.get("body", b"")
+                received += len(body)
+                # HTTPException из разбора формы FastAPI отдаёт как есть (413), а не как 400
+                if limit and received > limit:
+                    raise request_too_large(limit)
+                if parts is not None and not parts.feed(body):
+                    raise part_too_large(part_limit)
+            return message
+
+        return await self.app(scope, limited_receive, send)
+
+
+def upload_size(file: UploadFile) -> int:
+    if file.size is not None:
+        return file.size
+    file.file.seek(0, 2)
+    size = file.file.tell()
+    file.file.seek(0)
+    return size
+
+
+def read_upload(file: UploadFile, filename: str, max_bytes: int, mmap_threshold: int) -> UploadData:
+    """
+    Содержимое загруженного файла (блокирующий вызов — из asyncio.to_thread).
+
+    Файл больше max_bytes (0 — без лимита) — 413. Это точная проверка уже спуленного файла;
+    во время приёма тот же лимит (с запасом на заголовки части) держит BodyLimitMiddleware. Файл больше mmap_threshold отдаётся как mmap
+    временного файла: отображение живёт, пока на него есть ссылки, даже после закрытия
+    и удаления самого файла (FastAPI закрывает загрузки после ответа).
+    """
+    size = upload_size(file)
+    if max_bytes and size > max_bytes:
+        raise file_too_large(filename, max_bytes)
+    if mmap_threshold and size > mmap_threshold:
+        # fileno() переносит SpooledTemporaryFile на диск, если он ещё в памяти
+        return mmap.mmap(file.file.fileno(), 0, access=mmap.ACCESS_READ)
+    file.file.seek(0)
+    return file.file.read()
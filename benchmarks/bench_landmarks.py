@@ -0,0 +1,83 @@
+"""
+Микро-бенчмарк обработки landmarks: до и после векторизации.
+
+"До" — прежняя реализация (список пар [x*w, y*h] в цикле Python, списки индексов глаз
+на каждый вызов), "после" — FaceProcessor._convert_landmarks_to_array / _calculate_face_metrics
+и константы LEFT_EYE_IDX / RIGHT_EYE_IDX. Считается стоимость на одно изображение: конвертация
+468 точек, центр и размер лица, центры глаз.
+
+Запуск:
+    python benchmarks/bench_landmarks.py [--repeat 2000]
+"""
+import argparse
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mediapipe.framework.formats import landmark_pb2
+
+from app.face_processor import LEFT_EYE_IDX, RIGHT_EYE_IDX, FaceProcessor
+
+IMG_SHAPE = (1920, 1440, 3)
+
+
+def make_landmarks(seed: int = 0) -> landmark_pb2.NormalizedLandmarkList:
+    rng = np.random.default_rng(seed)
+    face = landmark_pb2.NormalizedLandmarkList()
+    for x, y in rng.uniform(0.3, 0.7, size=(468, 2)):
+        face.landmark.add(x=float(x), y=float(y), z=0.0)
+    return face
+
+
+def before(face_landmarks) -> tuple:
+    """Прежняя реализация (как в коде до векторизации)."""
+    h, w = IMG_SHAPE[:2]
+    landmarks = []
+    for landmark in face_landmarks.landmark:
+        landmarks.append([landmark.x * w, landmark.y * h])
+    landmarks = np.array(landmarks, dtype=np.int32)
+
+    face_center = np.mean(landmarks, axis=0)
+    x_min, y_min = landmarks.min(axis=0)
+    x_max, y_max = landmarks.max(axis=0)
+    face_size = max(x_max - x_min, y_max - y_min) * 1.3
+
+    left_eye_points = [33, 7, 163, 144, 145, 153, 154, 155, 133, 173, 157, 158, 159, 160, 161, 246]
+    right_eye_points = [362, 382, 381, 380, 374, 373, 390, 249, 263, 466, 388, 387, 386, 385, 384, 398]
+    left_eye_available = [i for i in left_eye_points if i < len(landmarks)]
+    right_eye_available = [i for i in right_eye_points if i < len(landmarks)]
+    left_eye_center = np.mean(landmarks[left_eye_available], axis=0)
+    right_eye_center = np.mean(landmarks[right_eye_available], axis=0)
+    return face_center, face_size, left_eye_center, right_eye_center
+
+
+def after(processor: FaceProcessor, face_landmarks) -> tuple:
+    landmarks = processor._convert_landmarks_to_array(face_landmarks, IMG_SHAPE)
+    face_center, face_size = processor._calculate_face_metrics(landmarks, margin=1.3)
+    left_eye_center = landmarks[LEFT_EYE_IDX].mean(axis=0)
+    right_eye_center = landmarks[RIGHT_EYE_IDX].mean(axis=0)
+    return face_center, face_size, left_eye_center, right_eye_center
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=2000, help="Число повторов на замер")
+    args = parser.parse_args()
+
+    processor = FaceProcessor()
+    face = make_landmarks()
+
+    results = {}
+    for name, fn in (("до", lambda: before(face)), ("после", lambda: after(processor, face))):
+        best = min(timeit.repeat(fn, number=args.repeat, repeat=5)) / args.repeat
+        results[name] = best
+        print(f"{name:>6}: {best * 1e6:8.1f} мкс на изображение")
+    print(f"ускорение: {results['до'] / results['после']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""
+Бенчмарк пайплайна FaceProcessor по этапам и целиком, с порогами регрессии.
+
+Корпус генерируется локально из одной фотографии с лицом (--seed; по умолчанию
+grace_hopper.jpg из sample_data matplotlib, если он установлен) и сохраняется
+в benchmarks/corpus/ (не коммитится, пересоздаётся с --regenerate):
+- JPEG 0.3, 2, 12 и 48 МП
+- PNG, WebP, HEIC и AVIF 2 МП (HEIC/AVIF — если установлены pillow-heif / pillow-avif-plugin)
+- EXIF-поворот (Orientation=6, пиксели повёрнуты)
+- мелкое лицо в кадре 12 МП
+- изображение без лица
+
+Каждый файл обрабатывается process_image --repeat раз; в JSON пишется медиана общего
+времени и каждого этапа внутри сквозного прогона (FaceProcessor.last_stats: probe, decode,
+orientation, resize, detect_fast, detect_long, mesh, align, render, encode — stages_ms).
+Кроме того, каждый этап замеряется отдельно, на готовом входе предыдущего (isolated_ms:
+probe, decode, detect, mesh, render, encode) — без влияния соседних этапов на кэши и память.
+
+С --baseline прогон сравнивается с сохранённым: регрессия — медиана выросла больше чем
+на --threshold (доля) и больше чем на --min-delta мс (шум коротких этапов). При регрессиях
+код выхода 1, так что бенчмарк можно ставить в CI на одной и той же машине.
+Базовая линия зависит от машины и в репозиторий не коммитится: --check сравнивает
+с benchmarks/baseline.json (или --baseline) и завершается с кодом 2, если базовой линии нет
+или в ней нет ни одного случая этого прогона, — проверка не проходит молча.
+
+Запуск:
+    python benchmarks/bench_pipeline.py --output benchmarks/baseline.json   # базовая линия
+    python benchmarks/bench_pipeline.py --check --threshold 0.15 --output new.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import config
+from app.encoding import encode_image
+from app.face_processor import EXIF_ORIENTATION_TAG, FaceProcessor, plan_decode, probe_header
+
+CORPUS_DIR = Path(__file__).resolve().parent / "corpus"
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+RESULTS_VERSION = 2
+
+
+def _resize_to(img: Image.Image, megapixels: float) -> Image.Image:
+    scale = (megapixels * 1e6 / (img.width * img.height)) ** 0.5
+    return img.resize((round(img.width * scale), round(img.height * scale)), Image.LANCZOS)
+
+
+def _encode(img: Image.Image, fmt: str, **params) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **params)
+    return buf.getvalue()
+
+
+def _rotated(seed: Image.Image) -> bytes:
+    """Пиксели повёрнуты против часовой, Orientation=6 велит повернуть обратно (как снимки с телефона)."""
+    img = _resize_to(seed, 2).transpose(Image.ROTATE_90)
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION_TAG] = 6
+    return _encode(img, "JPEG", quality=90, exif=exif.tobytes())
+
+
+def _tiny_face(seed: Image.Image) -> bytes:
+    """Лицо шириной ~1/12 кадра 4000×3000 (групповое фото, снимок издалека)."""
+    canvas = Image.new("RGB", (4000, 3000), (128, 128, 120))
+    face = seed.resize((340, round(340 * seed.height / seed.width)), Image.LANCZOS)
+    canvas.paste(face, (1800, 1200))
+    return _encode(canvas, "JPEG", quality=90)
+
+
+def _no_face(_: Image.Image) -> bytes:
+    rng = np.random.default_rng(0)
+    noise = rng.integers(0, 256, size=(1200, 1600, 3), dtype=np.uint8)
+    return _encode(Image.fromarray(cv2.GaussianBlur(noise, (0, 0), 3)), "JPEG", quality=90)
+
+
+def corpus_cases() -> List[Tuple[str, str, Callable[[Image.Image], bytes]]]:
+    """(имя, расширение, генератор байтов из исходной фотографии)."""
+    cases = [
+        (f"jpeg_{mp}mp", "jpg", lambda seed, mp=mp: _encode(_resize_to(seed, mp), "JPEG", quality=90))
+        for mp in (0.3, 2, 12, 48)
+    ]
+    cases += [
+        ("png_2mp", "png", lambda seed: _encode(_resize_to(seed, 2), "PNG")),
+        ("webp_2mp", "webp", lambda seed: _encode(_resize_to(seed, 2), "WEBP", quality=90)),
+        ("jpeg_exif_rotated_2mp", "jpg", _rotated),
+        ("jpeg_tiny_face_12mp", "jpg", _tiny_face),
+        ("jpeg_no_face_2mp", "jpg", _no_face),
+    ]
+    if "HEIF" in Image.registered_extensions().values():
+        cases.append(("heic_2mp", "heic", lambda seed: _encode(_resize_to(seed, 2), "HEIF", quality=90)))
+    if "AVIF" in Image.registered_extensions().values():
+        cases.append(("avif_2mp", "avif", lambda seed: _encode(_resize_to(seed, 2), "AVIF", quality=80)))
+    return cases
+
+
+def default_seed() -> Optional[Path]:
+    try:
+        from matplotlib import cbook
+        return Path(cbook.get_sample_data("grace_hopper.jpg", asfileobj=False))
+    except Exception:
+        return None
+
+
+def build_corpus(seed_path: Path, regenerate: bool = False) -> Dict[str, Path]:
+    """Создаёт недостающие файлы корпуса и возвращает {имя: путь}."""
+    CORPUS_DIR.mkdir(exist_ok=True)
+    seed = None
+    corpus = {}
+    for name, ext, make in corpus_cases():
+        path = CORPUS_DIR / f"{name}.{ext}"
+        if regenerate or not path.exists():
+            if seed is None:
+                seed = Image.open(seed_path).convert("RGB")
+            path.write_bytes(make(seed))
+        corpus[name] = path
+    return corpus
+
+
+def bench_case(processor: FaceProcessor, image_bytes: bytes, name: str, repeat: int) -> Dict:
+    processor.process_image(image_bytes, name)  # прогрев: первый вызов на размере дороже
+    totals, stages, stats = [], {}, {}
+    for _ in range(repeat):
+        started = time.perf_counter()
+        processor.process_image(image_bytes, name)
+        totals.append(time.perf_counter() - started)
+        stats = processor.last_stats
+        for stage, seconds in stats["stages"].items():
+            stages.setdefault(stage, []).append(seconds)
+    return {
+        "bytes": len(image_bytes),
+        "megapixels": round(stats.get("megapixels") or 0.0, 2),
+        "outcome": stats.get("outcome"),
+        "total_ms": round(statistics.median(totals) * 1000, 3),
+        "stages_ms": {stage: round(statistics.median(values) * 1000, 3) for stage, values in stages.items()},
+    }
+
+
+def _median_ms(call: Callable[[], object], repeat: int) -> float:
+    call()  # прогрев
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        call()
+        times.append(time.perf_counter() - started)
+    return round(statistics.median(times) * 1000, 3)
+
+
+def bench_isolated(processor: FaceProcessor, image_bytes: bytes, name: str, repeat: int) -> Dict[str, float]:
+    """
+    Медиана каждого этапа по отдельности: вход этапа готовится заранее тем же кодом, что в _analyze,
+    и в замер не входит. Этапы, для которых нет входа (нет лица — нет mesh и render), пропускаются.
+    """
+    processor._begin_stats()
+    format_name, (width, height), orientation = probe_header(image_bytes)
+    reduction = plan_decode(format_name, width, height, processor.detection_max_dimension, processor.max_megapixels)
+    img = processor._decode_image(image_bytes, name, orientation, reduction)
+    scale = min(1.0, processor.detection_max_dimension / max(img.shape[:2]))
+    resized = cv2.resize(img, (int(img.shape[1] * scale), int(img.shape[0] * scale)),
+                         interpolation=cv2.INTER_AREA) if scale < 1.0 else img
+    img_rgb = cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+    detections = processor._detect_faces(img_rgb, name)
+
+    def fresh(call: Callable[[], object]) -> Callable[[], object]:
+        # last_stats накапливает этапы и декодеры — сбрасываем, чтобы не росли между повторами
+        return lambda: (processor._begin_stats(), call())
+
+    isolated = {
+        "probe": _median_ms(lambda: probe_header(image_bytes), repeat),
+        "decode": _median_ms(fresh(lambda: processor._decode_image(image_bytes, name, orientation, reduction)), repeat),
+        "detect": _median_ms(fresh(lambda: processor._detect_faces(img_rgb, name)), repeat),
+    }
+    best = processor._select_best_face_mediapipe(detections, resized.shape) if detections else None
+    if best is not None:
+        isolated["mesh"] = _median_ms(fresh(lambda: processor._mesh_landmarks(img_rgb, best)), repeat)
+    analysis = processor._analyze(image_bytes, name)
+    if analysis is not None:
+        full_img, geometries = analysis
+        crop = processor._render_geometry(full_img, geometries[0])
+        isolated["render"] = _median_ms(lambda: processor._render_geometry(full_img, geometries[0]), repeat)
+        isolated["encode"] = _median_ms(lambda: encode_image(crop, "png", None, processor.png_compression), repeat)
+    return isolated
+
+
+def compare(current: Dict, baseline: Dict, threshold: float, min_delta_ms: float) -> List[str]:
+    """Регрессии относительно baseline: строки вида 'case/stage: 12.0 -> 15.1 мс (+26%)'."""
+    regressions = []
+    for name, case in current["cases"].items():
+        base = baseline.get("cases", {}).get(name)
+        if base is None:
+            continue
+        pairs = [("total", case["total_ms"], base["total_ms"])]
+        pairs += [
+            (stage, ms, base["stages_ms"][stage])
+            for stage, ms in case["stages_ms"].items() if stage in base["stages_ms"]
+        ]
+        base_isolated = base.get("isolated_ms", {})
+        pairs += [
+            (f"isolated:{stage}", ms, base_isolated[stage])
+            for stage, ms in case.get("isolated_ms", {}).items() if stage in base_isolated
+        ]
+        for stage, ms, base_ms in pairs:
+            if ms - base_ms > min_delta_ms and ms > base_ms * (1 + threshold):
+                growth = (ms / base_ms - 1) * 100 if base_ms else float("inf")
+                regressions.append(f"{name}/{stage}: {base_ms:.1f} -> {ms:.1f} мс (+{growth:.0f}%)")
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seed", type=Path, help="Фотография с лицом для генерации корпуса")
+    parser.add_argument("--regenerate", action="store_true", help="Пересоздать корпус")
+    parser.add_argument("--repeat", type=int, default=5, help="Прогонов на файл (берётся медиана)")
+    parser.add_argument("--cases", help="Только эти случаи, через запятую")
+    parser.add_argument("--output", type=Path, help="Куда записать результаты (JSON)")
+    parser.add_argument("--baseline", type=Path, help="Сохранённые результаты для сравнения")
+    parser.add_argument("--check", action="store_true",
+                        help=f"Сравнить с базовой линией (--baseline, иначе {DEFAULT_BASELINE.name}); "
+                             "без неё — код выхода 2")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Допустимый рост медианы (доля), по умолчанию 0.2")
+    parser.add_argument("--min-delta", type=float, default=3.0, help="Рост меньше стольких мс не считается регрессией")
+    args = parser.parse_args(argv)
+
+    baseline_path = args.baseline or (DEFAULT_BASELINE if args.check else None)
+    if baseline_path is not None and not baseline_path.exists():
+        # До прогона: проверка без базовой линии не должна проходить молча (и тратить время)
+        print(f"❌ Базовой линии {baseline_path} нет. Создайте её на этой машине: "
+              f"python benchmarks/bench_pipeline.py --output {baseline_path}", file=sys.stderr)
+        return 2
+
+    seed = args.seed or default_seed()
+    corpus_missing = any(not (CORPUS_DIR / f"{name}.{ext}").exists() for name, ext, _ in corpus_cases())
+    if seed is None and (args.regenerate or corpus_missing):
+        parser.error("нужна фотография с лицом: --seed PATH (или установите matplotlib)")
+    corpus = build_corpus(seed, args.regenerate) if seed else {
+        name: CORPUS_DIR / f"{name}.{ext}" for name, ext, _ in corpus_cases()
+    }
+    if args.cases:
+        wanted = set(args.cases.split(","))
+        corpus = {name: path for name, path in corpus.items() if name in wanted}
+
+    processor = FaceProcessor(
+        output_size=config.OUTPUT_SIZE,
+        face_fill_ratio=config.FACE_FILL_RATIO,
+        cascade_threshold=config.CASCADE_THRESHOLD,
+        detection_max_dimension=config.DETECTION_MAX_DIMENSION,
+        png_compression=config.PNG_COMPRESSION,
+        max_megapixels=config.MAX_MEGAPIXELS,
+    )
+    results = {
+        "version": RESULTS_VERSION,
+        "created_at": time.time(),
+        "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                    "opencv": cv2.__version__, "cpu_count": os.cpu_count()},
+        "repeat": args.repeat,
+        "cases": {},
+    }
+    print(f"{'случай':<24}{'МП':>7}{'итог, мс':>11}  этапы (медиана, мс)")
+    for name, path in corpus.items():
+        image_bytes = path.read_bytes()
+        case = bench_case(processor, image_bytes, name, args.repeat)
+        case["isolated_ms"] = bench_isolated(processor, image_bytes, name, args.repeat)
+        results["cases"][name] = case
+        top = sorted(case["stages_ms"].items(), key=lambda item: -item[1])[:4]
+        print(f"{name:<24}{case['megapixels']:>7.1f}{case['total_ms']:>11.1f}  "
+              + ", ".join(f"{stage} {ms:.1f}" for stage, ms in top) + f"  [{case['outcome']}]")
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2, ensure_ascii=False))
+        print(f"Результаты: {args.output}")
+    if baseline_path is not None:
+        baseline = json.loads(baseline_path.read_text())
+        common = set(results["cases"]) & set(baseline.get("cases", {}))
+        if not common:
+            print(f"❌ В {baseline_path} нет ни одного случая этого прогона — сравнивать не с чем", file=sys.stderr)
+            return 2
+        missing = sorted(set(results["cases"]) - common)
+        if missing:
+            print(f"⚠️  Нет в базовой линии (не сравниваются): {', '.join(missing)}")
+        regressions = compare(results, baseline, args.threshold, args.min_delta)
+        if regressions:
+            print(f"❌ Регрессии относительно {baseline_path} (порог +{args.threshold:.0%}):")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"✅ Регрессий относительно {baseline_path} нет (порог +{args.threshold:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,330 @@
+"""
+Нагрузочный тест HTTP-сервиса: пропускная способность и хвосты задержек.
+
+Поднимает локальный uvicorn с заданной конфигурацией (--workers, --limit-concurrency,
+переменные окружения вроде FACE_CROP_ENGINE=process через --env) или бьёт в уже
+запущенный сервис (--url) и отправляет смесь запросов /v1/face-crop: один файл
+или 5 файлов (доля — --multi-ratio).
+
+Нагрузка:
+- замкнутая (по умолчанию): --concurrency клиентов, каждый шлёт следующий запрос сразу после ответа
+- открытая: --rate запросов в секунду (пуассоновский поток), независимо от ответов —
+  так видно, что происходит при перегрузке (очередь, 503)
+
+Изображения берутся из --images (по умолчанию benchmarks/corpus, см. bench_pipeline.py).
+К каждому файлу дописываются случайные байты после конца изображения — декодеры их
+игнорируют, а кэш результатов по содержимому не срабатывает (--cache-hits отключает это).
+
+Отчёт: запросы/с, изображения/с, p50/p95/p99 задержки (всех ответов и отдельно успешных),
+доли ошибок и 503, пиковый RSS каждого процесса сервиса (master, воркеры uvicorn,
+процессы пула; только Linux).
+
+Запуск:
+    python benchmarks/load_test.py --workers 2 --concurrency 8 --duration 30
+    python benchmarks/load_test.py --env FACE_CROP_ENGINE=process --env FACE_CROP_WORKERS=4 --workers 1
+    python benchmarks/load_test.py --url http://127.0.0.1:8000 --rate 20 --duration 60
+
+Нужен httpx (pip install httpx).
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    sys.exit("Нужен httpx: pip install httpx")
+
+CORPUS_DIR = Path(__file__).resolve().parent / "corpus"
+ROOT_DIR = Path(__file__).resolve().parent.parent
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".heic", ".heif", ".avif"}
+MULTI_FILES = 5
+
+
+def load_images(directory: Path) -> List[Tuple[str, bytes]]:
+    images = [
+        (path.name, path.read_bytes())
+        for path in sorted(directory.iterdir())
+        if path.suffix.lower() in IMAGE_EXTENSIONS
+    ]
+    if not images:
+        sys.exit(f"В {directory} нет изображений (создайте корпус: python benchmarks/bench_pipeline.py)")
+    return images
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """Перцентиль по ближайшему рангу."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(q / 100 * len(ordered) + 0.5) - 1))]
+
+
+# --- процессы сервиса и их RSS (Linux /proc) ---
+
+def _children(pid: int) -> List[int]:
+    children = []
+    for entry in Path("/proc").iterdir():
+        if not entry.name.isdigit():
+            continue
+        try:
+            stat = (entry / "stat").read_text()
+        except OSError:
+            continue
+        # Поле 4 — ppid; имя процесса в скобках может содержать пробелы
+        if int(stat.rsplit(")", 1)[1].split()[1]) == pid:
+            children.append(int(entry.name))
+    return children
+
+
+def process_tree(pid: int) -> List[int]:
+    tree, queue = [], [pid]
+    while queue:
+        current = queue.pop()
+        tree.append(current)
+        queue.extend(_children(current))
+    return tree
+
+
+def rss_mb(pid: int) -> Optional[float]:
+    try:
+        for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def process_label(pid: int) -> str:
+    try:
+        cmdline = Path(f"/proc/{pid}/cmdline").read_bytes().replace(b"\0", b" ").decode(errors="replace")
+    except OSError:
+        return str(pid)
+    if "multiprocessing" in cmdline:
+        return f"{pid} (дочерний процесс)"
+    return f"{pid} ({cmdline.strip()[:60]})"
+
+
+class RssSampler(threading.Thread):
+    """Раз в interval секунд обходит дерево процессов сервиса и запоминает пиковый RSS каждого."""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak: Dict[int, float] = {}
+        self.labels: Dict[int, str] = {}
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def sample(self) -> None:
+        for pid in process_tree(self.pid):
+            rss = rss_mb(pid)
+            if rss is None:
+                continue
+            if pid not in self.labels:
+                self.labels[pid] = process_label(pid)
+            self.peak[pid] = max(self.peak.get(pid, 0.0), rss)
+
+    def stop(self) -> Dict[str, float]:
+        self._stop_event.set()
+        self.sample()
+        return {self.labels[pid]: round(mb, 1) for pid, mb in sorted(self.peak.items())}
+
+
+def start_server(port: int, workers: int, limit_concurrency: Optional[int], env: Dict[str, str]) -> subprocess.Popen:
+    command = [
+        sys.executable, "-m", "uvicorn", "app.main:app",
+        "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers), "--log-level", "warning",
+    ]
+    if limit_concurrency:
+        command += ["--limit-concurrency", str(limit_concurrency)]
+    return subprocess.Popen(
+        command, cwd=ROOT_DIR, env={**os.environ, "FACE_CROP_LOG_LEVEL": "ERROR", **env},
+        stdout=subprocess.DEVNULL,
+    )
+
+
+async def wait_ready(client: httpx.AsyncClient, url: str, timeout: float = 180.0) -> None:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if (await client.get(f"{url}/health")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.5)
+    raise RuntimeError(f"Сервис {url} не ответил на /health за {timeout:.0f}с")
+
+
+# --- генерация нагрузки ---
+
+class Stats:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.ok_latencies: List[float] = []
+        self.statuses: Dict[str, int] = {}
+        self.images = 0
+        self.requests = 0
+
+    def record(self, status: str, latency: float, files: int) -> None:
+        self.requests += 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latencies.append(latency)
+        if status == "200":
+            self.images += files
+            self.ok_latencies.append(latency)
+
+
+async def send_request(client: httpx.AsyncClient, url: str, images: List[Tuple[str, bytes]],
+                       rng: random.Random, args: argparse.Namespace, stats: Optional[Stats]) -> None:
+    count = MULTI_FILES if rng.random() < args.multi_ratio else 1
+    files = []
+    for name, data in rng.sample(images, min(count, len(images))):
+        if not args.cache_hits:
+            data = data + rng.randbytes(8)
+        files.append(("files", (name, data, "application/octet-stream")))
+    started = time.perf_counter()
+    try:
+        response = await client.post(f"{url}/v1/face-crop", params={"format": args.format}, files=files)
+        status = str(response.status_code)
+    except httpx.TimeoutException:
+        status = "timeout"
+    except httpx.TransportError:
+        status = "connection-error"
+    if stats is not None:
+        stats.record(status, time.perf_counter() - started, len(files))
+
+
+async def closed_loop(client, url, images, args, deadline: float, stats: Optional[Stats]) -> None:
+    async def user(seed: int) -> None:
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            await send_request(client, url, images, rng, args, stats)
+
+    await asyncio.gather(*(user(i) for i in range(args.concurrency)))
+
+
+async def open_loop(client, url, images, args, deadline: float, stats: Optional[Stats]) -> None:
+    rng = random.Random(0)
+    tasks = set()
+    while time.monotonic() < deadline:
+        task = asyncio.create_task(send_request(client, url, images, random.Random(rng.random()), args, stats))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        await asyncio.sleep(rng.expovariate(args.rate))
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    images = load_images(args.images)
+    server = None
+    url = args.url
+    if url is None:
+        env = dict(item.split("=", 1) for item in args.env)
+        server = start_server(args.port, args.workers, args.limit_concurrency, env)
+        url = f"http://127.0.0.1:{args.port}"
+    sampler = None
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    try:
+        async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+            await wait_ready(client, url)
+            server_pid = server.pid if server else args.server_pid
+            if server_pid and Path("/proc").exists():
+                sampler = RssSampler(server_pid)
+                sampler.start()
+            drive = open_loop if args.rate else closed_loop
+            if args.warmup:
+                await drive(client, url, images, args, time.monotonic() + args.warmup, None)
+            stats = Stats()
+            started = time.monotonic()
+            await drive(client, url, images, args, started + args.duration, stats)
+            elapsed = time.monotonic() - started
+    finally:
+        peak_rss = sampler.stop() if sampler else {}
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+
+    failed = sum(n for status, n in stats.statuses.items() if not status.startswith(("2", "4")) and status != "503")
+    return {
+        "config": {
+            "url": args.url, "workers": args.workers, "limit_concurrency": args.limit_concurrency,
+            "env": args.env, "concurrency": None if args.rate else args.concurrency, "rate": args.rate,
+            "multi_ratio": args.multi_ratio, "format": args.format, "cache_hits": args.cache_hits,
+        },
+        "duration": round(elapsed, 2),
+        "requests": stats.requests,
+        "requests_per_second": round(stats.requests / elapsed, 2),
+        "images_per_second": round(stats.images / elapsed, 2),
+        "latency_ms": {
+            f"p{q}": round(percentile(stats.latencies, q) * 1000, 1) if stats.latencies else None
+            for q in (50, 95, 99)
+        },
+        "latency_ok_ms": {
+            f"p{q}": round(percentile(stats.ok_latencies, q) * 1000, 1) if stats.ok_latencies else None
+            for q in (50, 95, 99)
+        },
+        "statuses": stats.statuses,
+        "error_rate": round(failed / stats.requests, 4) if stats.requests else 0.0,
+        "rejected_rate": round(stats.statuses.get("503", 0) / stats.requests, 4) if stats.requests else 0.0,
+        "peak_rss_mb": peak_rss,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="Уже запущенный сервис; иначе поднимается локальный uvicorn")
+    parser.add_argument("--server-pid", type=int, help="PID сервиса из --url для замера RSS")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=2, help="uvicorn --workers")
+    parser.add_argument("--limit-concurrency", type=int, default=10, help="uvicorn --limit-concurrency (0 — без лимита)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Переменная окружения сервиса, например FACE_CROP_ENGINE=process")
+    parser.add_argument("--images", type=Path, default=CORPUS_DIR, help="Каталог с изображениями")
+    parser.add_argument("--concurrency", type=int, default=8, help="Клиентов в замкнутом режиме")
+    parser.add_argument("--rate", type=float, help="Запросов в секунду (открытый режим)")
+    parser.add_argument("--multi-ratio", type=float, default=0.2, help="Доля запросов с 5 файлами")
+    parser.add_argument("--format", default="webp", help="Формат результата")
+    parser.add_argument("--cache-hits", action="store_true", help="Не менять байты файлов (кэш будет срабатывать)")
+    parser.add_argument("--duration", type=float, default=30.0, help="Длительность замера, с")
+    parser.add_argument("--warmup", type=float, default=5.0, help="Прогрев перед замером, с")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Таймаут запроса, с")
+    parser.add_argument("--output", type=Path, help="Куда записать отчёт (JSON)")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    latency = report["latency_ms"]
+    print(
+        f"{report['requests']} запросов за {report['duration']:.0f}с: "
+        f"{report['requests_per_second']:.2f} запр./с, {report['images_per_second']:.2f} изобр./с\n"
+        f"задержка p50={latency['p50']} p95={latency['p95']} p99={latency['p99']} мс "
+        f"(только 200: p50={report['latency_ok_ms']['p50']} p95={report['latency_ok_ms']['p95']} "
+        f"p99={report['latency_ok_ms']['p99']})\n"
+        f"ответы: {report['statuses']}, ошибки {report['error_rate']:.1%}, 503 {report['rejected_rate']:.1%}"
+    )
+    for process, mb in report["peak_rss_mb"].items():
+        print(f"пиковый RSS {process}: {mb:.0f} МБ")
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
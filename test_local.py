@@ -59,7 +59,7 @@ def test_photos():
             
             if result:
                 output_path = output_dir / result['filename']
-                result['image'].save(output_path)
+                output_path.write_bytes(result['data'])
                 print(f"  ✓ Успешно сохранено: {output_path}")
                 success_count += 1
             else:
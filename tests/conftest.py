@@ -1,5 +1,6 @@
 """Pytest fixtures."""
 import io
+import struct
 from pathlib import Path
 
 import pytest
@@ -12,6 +13,7 @@ root = Path(__file__).resolve().parent.parent
 if str(root) not in sys.path:
     sys.path.insert(0, str(root))
 
+from app.face_processor import FaceProcessor
 from app.main import app
 
 
@@ -20,6 +22,12 @@ def client():
     return TestClient(app)
 
 
+@pytest.fixture(scope="session")
+def processor():
+    """Один FaceProcessor на все тесты (загрузка моделей MediaPipe небыстрая)."""
+    return FaceProcessor(output_size=512, face_fill_ratio=0.5)
+
+
 @pytest.fixture
 def minimal_png_bytes():
     """Минимальное PNG без лица (для тестов валидации и ответа 400)."""
@@ -36,3 +44,23 @@ def jpeg_bytes():
     buf = io.BytesIO()
     img.save(buf, format="JPEG")
     return buf.getvalue()
+
+
+@pytest.fixture(scope="session")
+def png_bomb_bytes():
+    """PNG в десятки килобайт с заголовком 12000×12000 (144 МП) — decompression bomb."""
+    img = Image.new("1", (12000, 12000))
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+@pytest.fixture(scope="session")
+def jpeg_bomb_bytes():
+    """JPEG в сотни байт с заголовком 65000×65000 (4225 МП) — больше бюджета даже при декодировании 1/8."""
+    buf = io.BytesIO()
+    Image.new("RGB", (16, 16)).save(buf, format="JPEG")
+    data = bytearray(buf.getvalue())
+    sof = data.index(b"\xff\xc0")
+    data[sof + 5:sof + 9] = struct.pack(">HH", 65000, 65000)  # высота, ширина в SOF0
+    return bytes(data)
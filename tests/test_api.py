@@ -2,9 +2,12 @@
 import base64
 import io
 
+import numpy as np
 import pytest
 from fastapi.testclient import TestClient
 
+from app import config
+
 
 def test_health(client: TestClient):
     """GET /health возвращает 200 и status ok."""
@@ -86,3 +89,213 @@ def test_output_filename_format(client: TestClient):
     # Здесь просто проверяем, что health и root работают (косвенно что app грузится).
     r = client.get("/health")
     assert r.status_code == 200
+
+
+def test_face_crop_unknown_format_400(client: TestClient, minimal_png_bytes: bytes):
+    """Неподдерживаемый format — 400 до обработки."""
+    r = client.post(
+        "/v1/face-crop?format=gif",
+        files=[("files", ("x.png", minimal_png_bytes, "image/png"))],
+    )
+    assert r.status_code == 400
+    assert "gif" in r.json()["detail"]
+
+
+def test_face_crop_stream_multipart(client: TestClient, minimal_png_bytes: bytes, jpeg_bytes: bytes):
+    """stream=1 — multipart/mixed, по части на файл, без лица — X-Status: no-face."""
+    files = [
+        ("files", ("a.png", minimal_png_bytes, "image/png")),
+        ("files", ("b.jpg", jpeg_bytes, "image/jpeg")),
+    ]
+    r = client.post("/v1/face-crop?stream=1", files=files)
+    assert r.status_code == 200
+    content_type = r.headers["content-type"]
+    assert content_type.startswith("multipart/mixed")
+    boundary = content_type.split("boundary=")[1].encode()
+
+    body = r.content
+    assert body.endswith(b"--" + boundary + b"--\r\n")
+    parts = [p for p in body.split(b"--" + boundary)[1:-1]]
+    assert len(parts) == 2
+    indexes = set()
+    for part in parts:
+        head, _, payload = part.strip(b"\r\n").partition(b"\r\n\r\n")
+        headers = dict(line.split(": ", 1) for line in head.decode().split("\r\n"))
+        assert headers["X-Status"] == "no-face"
+        assert int(headers["Content-Length"]) == len(payload)
+        indexes.add(int(headers["X-Index"]))
+    assert indexes == {0, 1}
+
+
+def test_face_crop_if_none_match_304(client: TestClient, minimal_png_bytes: bytes):
+    """Совпадающий If-None-Match — 304 без обработки (ETag определяется входом и параметрами)."""
+    from app.cache import content_hash
+    from app.main import _output_filename, _response_etag, engine
+
+    key = engine.cache_key(content_hash(minimal_png_bytes), output_format="png", quality=None)
+    etag = _response_etag([key], [_output_filename("x.png", 0, "png")])
+    r = client.post(
+        "/v1/face-crop",
+        files=[("files", ("x.png", minimal_png_bytes, "image/png"))],
+        headers={"If-None-Match": etag},
+    )
+    assert r.status_code == 304
+    assert r.headers["etag"] == etag
+
+
+def test_cache_stats(client: TestClient):
+    r = client.get("/v1/cache/stats")
+    assert r.status_code == 200
+    assert {"hits_memory", "hits_disk", "misses", "bytes"} <= set(r.json())
+
+
+def test_image_crop_unknown_id_404(client: TestClient):
+    """Повторный кроп неизвестного изображения — 404."""
+    assert client.get("/v1/images/0123456789abcdef/crop?size=256").status_code == 404
+    assert client.get("/v1/images/0123456789abcdef").status_code == 404
+
+
+def test_job_api_roundtrip(minimal_png_bytes: bytes):
+    """POST /v1/jobs — 202 и id; задание доходит до done, файлы без лица учтены в статусе."""
+    import time
+    from app.main import app
+
+    with TestClient(app) as client:  # startup запускает воркеров заданий
+        files = [("files", (f"{i}.png", minimal_png_bytes, "image/png")) for i in range(7)]
+        r = client.post("/v1/jobs", files=files)
+        assert r.status_code == 202
+        job_id = r.json()["job_id"]
+        assert r.headers["location"] == f"/v1/jobs/{job_id}"
+
+        for _ in range(100):
+            status = client.get(f"/v1/jobs/{job_id}").json()
+            if status["status"] == "done":
+                break
+            time.sleep(0.05)
+        assert status["status"] == "done"
+        assert status["total"] == 7 and status["no_face"] == 7
+        assert client.get(f"/v1/jobs/{job_id}/results/0").status_code == 404
+        assert client.get(f"/v1/jobs/{job_id}/results.zip").status_code == 200
+        assert client.delete(f"/v1/jobs/{job_id}").status_code == 200
+        assert client.get(f"/v1/jobs/{job_id}").status_code == 404
+
+
+def test_metrics_endpoint(client: TestClient, jpeg_bytes: bytes):
+    """/metrics в формате Prometheus: этапы пайплайна и результаты после обработки."""
+    client.post("/v1/face-crop", files=[("files", ("m.jpg", jpeg_bytes, "image/jpeg"))])
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain")
+    assert 'face_crop_stage_seconds_count{stage="decode"}' in r.text
+    assert "face_crop_images_total{" in r.text
+    assert "face_crop_engine_queue_depth 0" in r.text
+
+
+def test_request_id_and_server_timing(client: TestClient, jpeg_bytes: bytes):
+    """X-Request-ID клиента возвращается в ответе; Server-Timing содержит этапы и total."""
+    r = client.post(
+        "/v1/face-crop?stream=1",
+        files=[("files", ("t.jpg", jpeg_bytes, "image/jpeg"))],
+        headers={"X-Request-ID": "client-42"},
+    )
+    assert r.headers["x-request-id"] == "client-42"
+    assert "Server-Timing: queue;dur=" in r.text
+    assert "total;dur=" in r.text
+    assert client.get("/health").headers["x-request-id"]
+
+
+def test_deadline_header(client: TestClient, minimal_png_bytes: bytes):
+    """X-Deadline-Ms должен быть положительным; с запасом по времени запрос обрабатывается как обычно."""
+    files = [("files", ("d.png", minimal_png_bytes, "image/png"))]
+    assert client.post("/v1/face-crop", files=files, headers={"X-Deadline-Ms": "0"}).status_code == 400
+    r = client.post("/v1/face-crop", files=files, headers={"X-Deadline-Ms": "60000"})
+    assert r.status_code == 400  # лица нет, но обработка прошла
+    assert "лицо" in r.json()["detail"]
+
+
+def test_face_crop_file_too_large_413(client: TestClient, jpeg_bytes: bytes, monkeypatch):
+    """Лимит на файл проверяется на сервере, до обработки."""
+    monkeypatch.setattr(config, "MAX_FILE_BYTES", len(jpeg_bytes) - 1)
+    r = client.post("/v1/face-crop", files=[("files", ("big.jpg", jpeg_bytes, "image/jpeg"))])
+    assert r.status_code == 413
+    assert "big.jpg" in r.json()["detail"]
+
+
+def test_face_crop_pixel_budget_413(client: TestClient, png_bomb_bytes: bytes):
+    """Изображение больше бюджета пикселей отклоняется по заголовку (413), до пула и декодирования."""
+    r = client.post("/v1/face-crop", files=[("files", ("bomb.png", png_bomb_bytes, "image/png"))])
+    assert r.status_code == 413
+    assert "МП" in r.json()["detail"]
+
+
+def test_image_crop_pixel_budget_413(client: TestClient, jpeg_bomb_bytes: bytes):
+    """Повторный кроп изображения больше бюджета пикселей — 413 без декодирования."""
+    from app.main import geometry_store
+
+    geometry = {
+        "image_size": (65000, 65000), "orientation": 1, "bbox": (30000, 30000, 4000, 4000),
+        "landmarks": np.zeros((4, 2), dtype=np.float32), "face_center": (32500.0, 32500.0),
+        "face_size": 4000.0, "rotation_angle": 0.0,
+    }
+    geometry_store.put("bomb-image-id", jpeg_bomb_bytes, geometry)
+    r = client.get("/v1/images/bomb-image-id/crop?size=2048")
+    assert r.status_code == 413
+    assert "МП" in r.json()["detail"]
+
+
+@pytest.mark.parametrize("sizes", ["abc", "512,32", "", ",".join(str(n) for n in range(100, 1000, 100))])
+def test_face_crop_invalid_sizes_400(client: TestClient, jpeg_bytes: bytes, sizes: str):
+    """sizes — от 1 до 8 размеров в пикселях, каждый 64–2048."""
+    r = client.post(f"/v1/face-crop?sizes={sizes}", files=[("files", ("s.jpg", jpeg_bytes, "image/jpeg"))])
+    assert r.status_code == 400
+
+
+def test_all_faces_variants_and_filenames():
+    """all_faces: по результату на лицо и размер, в имени файла — номер лица."""
+    from app.main import _output_filename, _variants
+
+    faces = [
+        {"face": i, "score": 0.9, "bbox": (0, 0, 1, 1), "data": b"%d" % i,
+         "variants": [{"size": 256, "data": b"%d-256" % i}, {"size": 64, "data": b"%d-64" % i}]}
+        for i in range(2)
+    ]
+    result = {"data": faces[0]["data"], "faces": faces}
+    assert [(f["face"], d) for f, _, d in _variants(result, None)] == [(0, b"0"), (1, b"1")]
+    assert [(f["face"], s, d) for f, s, d in _variants(result, [256, 64])][1:3] == [(0, 64, b"0-64"), (1, 256, b"1-256")]
+    assert _variants({"data": b"x"}, None) == [(None, None, b"x")]
+    assert _output_filename("team.jpg", 0, "webp", 256, face=1) == "team_face1_256x256.webp"
+
+
+def test_all_faces_single_face_returns_list(client: TestClient, jpeg_bytes: bytes, monkeypatch):
+    """all_faces с одним найденным лицом — всё равно JSON со списком, а не картинка."""
+    from app.main import engine
+
+    face = {"face": 0, "score": 0.91, "bbox": (10.0, 20.0, 30.0, 40.0), "data": b"crop"}
+    outcome = {"result": {"data": b"crop", "media_type": "image/png", "faces": [face]},
+               "queue_time": 0.0, "process_time": 0.0, "stats": None}
+
+    async def process_many(inputs, **options):
+        assert options["max_faces"] == config.MAX_FACES
+        return [outcome]
+
+    monkeypatch.setattr(engine, "process_many", process_many)
+    r = client.post("/v1/face-crop?all_faces=true", files=[("files", ("team.jpg", jpeg_bytes, "image/jpeg"))])
+    assert r.status_code == 200
+    assert r.headers["content-type"] == "application/json"
+    (image,) = r.json()["images"]
+    assert (image["face"], image["score"], image["bbox"]) == (0, 0.91, [10.0, 20.0, 30.0, 40.0])
+    assert image["filename"] == "team_face0_512x512.png"
+    assert base64.b64decode(image["data"]) == b"crop"
+
+
+def test_face_crop_batch_over_budget_413(client: TestClient, jpeg_bytes: bytes, monkeypatch):
+    """Файлы запроса вместе больше бюджета пула — 413 без Retry-After, ни один не обрабатывается."""
+    from app.main import engine
+
+    monkeypatch.setattr(engine, "max_queue_cost", 1.0)
+    monkeypatch.setattr(engine, "estimate_cost", lambda *a: 0.8)
+    files = [("files", (f"{i}.jpg", jpeg_bytes + bytes([i]), "image/jpeg")) for i in range(2)]
+    r = client.post("/v1/face-crop", files=files)
+    assert r.status_code == 413
+    assert "retry-after" not in r.headers
+    assert engine.pending == 0
@@ -0,0 +1,55 @@
+"""Тесты офлайн-обработки каталога."""
+import io
+import json
+import tarfile
+
+from app.batch import iter_inputs, load_manifest, output_name, run
+
+PROCESSOR_KWARGS = {"output_size": 512, "face_fill_ratio": 0.5}
+
+
+def test_batch_writes_manifest_and_resumes(tmp_path, minimal_png_bytes: bytes, jpeg_bytes: bytes):
+    src = tmp_path / "in"
+    (src / "sub").mkdir(parents=True)
+    (src / "a.png").write_bytes(minimal_png_bytes)
+    (src / "sub" / "b.jpg").write_bytes(jpeg_bytes)
+    (src / "notes.txt").write_text("не изображение")
+    out = tmp_path / "out"
+    manifest = out / "manifest.jsonl"
+
+    summary = run(src, out, manifest, 0, "png", None, PROCESSOR_KWARGS)
+    assert (summary["processed"], summary["no_face"], summary["skipped"]) == (2, 2, 0)
+    assert summary["images_per_second"] > 0
+    records = load_manifest(manifest)
+    assert set(records) == {"a.png", "sub/b.jpg"}
+    assert all(r["status"] == "no-face" and r["process_time"] >= 0 for r in records.values())
+    assert all("decode" in r["stages"] and "detect_fast" in r["stages"] for r in records.values())
+
+    # Повторный запуск: уже обработанные файлы пропускаются, новый — обрабатывается
+    (src / "c.png").write_bytes(minimal_png_bytes)
+    summary = run(src, out, manifest, 0, "png", None, PROCESSOR_KWARGS)
+    assert (summary["processed"], summary["skipped"]) == (1, 2)
+    assert len(manifest.read_text().splitlines()) == 3
+
+
+def test_load_manifest_ignores_truncated_line(tmp_path):
+    manifest = tmp_path / "manifest.jsonl"
+    manifest.write_text(json.dumps({"path": "a.png", "status": "ok"}) + "\n" + '{"path": "b.p')
+    assert list(load_manifest(manifest)) == ["a.png"]
+
+
+def test_iter_inputs_reads_tarball(tmp_path, minimal_png_bytes: bytes):
+    archive = tmp_path / "photos.tar.gz"
+    with tarfile.open(archive, "w:gz") as tar:
+        for name in ("./x/one.png", "readme.md"):
+            info = tarfile.TarInfo(name)
+            info.size = len(minimal_png_bytes)
+            tar.addfile(info, io.BytesIO(minimal_png_bytes))
+    assert list(iter_inputs(archive)) == [("x/one.png", minimal_png_bytes)]
+
+
+def test_output_name_keeps_source_extension():
+    """Одноимённые файлы разных форматов дают разные результаты."""
+    assert output_name("sub/a.jpg", "webp") == "sub/a.jpg.webp"
+    assert output_name("sub/a.png", "webp") == "sub/a.png.webp"
+    assert output_name("b.PNG", "jpeg") == "b.PNG.jpg"
@@ -0,0 +1,112 @@
+"""Тесты кэша результатов."""
+import asyncio
+
+import numpy as np
+
+from app.cache import GeometryStore, ResultCache, cache_key, content_hash
+
+
+def _result(size: int, fill: bytes = b"x"):
+    return {"data": fill * size, "media_type": "image/png", "filename": "ignored.png"}
+
+
+def test_cache_key_depends_on_bytes_and_params():
+    abc, abd = content_hash(b"abc"), content_hash(b"abd")
+    base = cache_key(abc, {"output_size": 512, "output_format": "png"})
+    assert base == cache_key(abc, {"output_format": "png", "output_size": 512})
+    assert base != cache_key(abd, {"output_size": 512, "output_format": "png"})
+    assert base != cache_key(abc, {"output_size": 256, "output_format": "png"})
+    assert base != cache_key(abc, {"output_size": 512, "output_format": "webp"})
+
+
+def test_lru_respects_byte_budget():
+    cache = ResultCache(max_bytes=250)
+
+    async def scenario():
+        await cache.put("a", _result(100))
+        await cache.put("b", _result(100))
+        assert (await cache.lookup("a"))[0]  # a становится самым свежим
+        await cache.put("c", _result(100))  # вытесняет b
+        return [(await cache.lookup(key))[0] for key in "abc"]
+
+    assert asyncio.run(scenario()) == [True, False, True]
+    stats = cache.stats()
+    assert stats["bytes"] == 200
+    assert stats["evictions"] == 1
+    assert stats["hits_memory"] == 3 and stats["misses"] == 1
+
+
+def test_negative_result_is_cached():
+    cache = ResultCache(max_bytes=1024)
+    asyncio.run(cache.put("k", None))
+    assert asyncio.run(cache.lookup("k")) == (True, None)
+
+
+def test_stored_result_drops_request_specific_fields():
+    cache = ResultCache(max_bytes=1024)
+    asyncio.run(cache.put("k", _result(10)))
+    found, result = asyncio.run(cache.lookup("k"))
+    assert found and result == {"data": b"x" * 10, "media_type": "image/png"}
+
+
+def test_multiple_sizes_result_kept_in_memory_only(tmp_path):
+    """Результат с несколькими размерами хранится целиком (в памяти), бюджет — по всем размерам."""
+    cache = ResultCache(max_bytes=1024, disk_dir=str(tmp_path))
+    variants = [{"size": 512, "data": b"x" * 100}, {"size": 256, "data": b"y" * 30}]
+    asyncio.run(cache.put("k", {**_result(0), "data": variants[0]["data"], "variants": variants}))
+    found, result = asyncio.run(cache.lookup("k"))
+    assert found and result["variants"] == variants and result["data"] == b"x" * 100
+    assert cache.stats()["bytes"] == 130
+    assert cache.stats()["disk_bytes"] == 0
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    cache = ResultCache(max_bytes=0, disk_dir=str(tmp_path))
+    asyncio.run(cache.put("aa11", _result(10, b"y")))
+    asyncio.run(cache.put("bb22", None))
+
+    restarted = ResultCache(max_bytes=1024, disk_dir=str(tmp_path))
+    assert restarted.stats()["disk_bytes"] == 10
+    assert asyncio.run(restarted.lookup("aa11")) == (True, {"data": b"y" * 10, "media_type": "image/png"})
+    assert asyncio.run(restarted.lookup("bb22")) == (True, None)
+    assert restarted.stats()["hits_disk"] == 2
+    # После чтения с диска запись поднимается в память
+    assert asyncio.run(restarted.lookup("aa11"))[0] and restarted.stats()["hits_memory"] == 1
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path):
+    """Вытеснение по индексу в памяти: чтение делает запись свежей, каталог не обходится."""
+    cache = ResultCache(max_bytes=0, disk_dir=str(tmp_path), disk_max_bytes=250)
+
+    async def scenario():
+        await cache.put("a1", _result(100))
+        await cache.put("b2", _result(100))
+        assert (await cache.lookup("a1"))[0]  # b2 использовался давнее всех
+        await cache.put("c3", _result(100))
+        return [(await cache.lookup(key))[0] for key in ("a1", "b2", "c3")]
+
+    assert asyncio.run(scenario()) == [True, False, True]
+    assert cache.stats()["disk_bytes"] <= 250
+    assert not (tmp_path / "b2" / "b2.png").exists()
+
+
+def test_disk_tier_shared_directory(tmp_path):
+    """Файл, записанный другим воркером после запуска, находится при промахе индекса."""
+    cache = ResultCache(max_bytes=0, disk_dir=str(tmp_path))
+    other = ResultCache(max_bytes=0, disk_dir=str(tmp_path))
+    asyncio.run(other.put("cc33", _result(10)))
+    assert asyncio.run(cache.lookup("cc33")) == (True, {"data": b"x" * 10, "media_type": "image/png"})
+    assert cache.stats()["disk_bytes"] == 10
+
+
+def test_geometry_store_lru():
+    geometry = {"landmarks": np.zeros((468, 2), dtype=np.float32), "face_size": 100.0}
+    entry_size = 1000 + geometry["landmarks"].nbytes
+    store = GeometryStore(max_bytes=2 * entry_size)
+    store.put("a", b"a" * 1000, geometry)
+    store.put("b", b"b" * 1000, geometry)
+    assert store.get("a")[0] == b"a" * 1000
+    store.put("c", b"c" * 1000, geometry)  # вытесняет b
+    assert "b" not in store and store.get("b") is None
+    assert "a" in store and "c" in store
+    assert store.stats()["evictions"] == 1
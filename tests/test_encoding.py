@@ -0,0 +1,44 @@
+"""Тесты кодирования результата."""
+import cv2
+import numpy as np
+import pytest
+
+from app.encoding import EncodingError, available_formats, encode_image, encode_png, negotiate_format
+
+
+def test_encode_png_roundtrip():
+    """PNG кодируется в память без потерь при любом уровне сжатия."""
+    img = np.random.default_rng(0).integers(0, 255, size=(32, 32, 3), dtype=np.uint8)
+    for level in (0, 3, 9):
+        data = encode_png(img, level)
+        assert data[:8] == b"\x89PNG\r\n\x1a\n"
+        assert np.array_equal(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR), img)
+
+
+@pytest.mark.parametrize("fmt, magic", [("jpeg", b"\xff\xd8"), ("webp", b"RIFF"), ("png", b"\x89PNG")])
+def test_encode_image_formats(fmt, magic):
+    img = np.full((16, 16, 3), 128, dtype=np.uint8)
+    data = encode_image(img, fmt, quality=80)
+    assert data.startswith(magic)
+
+
+def test_encode_image_avif():
+    if "avif" not in available_formats():
+        pytest.skip("pillow-avif-plugin не установлен")
+    data = encode_image(np.full((16, 16, 3), 128, dtype=np.uint8), "avif")
+    assert data[4:12] == b"ftypavif"
+
+
+def test_negotiate_format_explicit_wins():
+    assert negotiate_format("jpg", "image/webp") == "jpeg"
+    assert negotiate_format("image/webp", None) == "webp"
+    with pytest.raises(EncodingError):
+        negotiate_format("gif", None)
+
+
+def test_negotiate_format_accept():
+    assert negotiate_format(None, None) == "png"
+    assert negotiate_format(None, "*/*") == "png"
+    assert negotiate_format(None, "image/jpeg;q=0.9, image/webp;q=0.5") == "jpeg"
+    assert negotiate_format(None, "image/png, image/webp, */*;q=0.8") == "webp"
+    assert negotiate_format(None, "image/webp;q=0, image/jpeg") == "jpeg"
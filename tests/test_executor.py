@@ -0,0 +1,299 @@
+"""Тесты пула выполнения FaceProcessor."""
+import asyncio
+import time
+
+import pytest
+
+from app.cache import ResultCache
+from app.executor import BatchTooLarge, DeadlineExceeded, EngineBusy, ProcessingEngine, _run_task
+from app.face_processor import FaceProcessor
+
+
+def test_engine_reports_queue_and_process_time(minimal_png_bytes: bytes):
+    """Результат пула содержит результат метода и раздельные тайминги."""
+    engine = ProcessingEngine(workers=1, max_queue=0)
+    try:
+        outcome = asyncio.run(engine.process_image(minimal_png_bytes, "x.png"))
+    finally:
+        engine.shutdown()
+    assert outcome["result"] is None  # лица нет
+    assert outcome["queue_time"] >= 0
+    assert outcome["process_time"] >= 0
+    assert engine.pending == 0
+
+
+def test_engine_rejects_when_full(minimal_png_bytes: bytes):
+    """Сверх workers + max_queue задачи не принимаются."""
+    engine = ProcessingEngine(workers=1, max_queue=1)
+
+    async def scenario():
+        # Разные байты: одинаковые одновременные изображения объединяются в одну задачу
+        tasks = [
+            asyncio.create_task(engine.process_image(minimal_png_bytes + bytes([i]), f"{i}.png")) for i in range(3)
+        ]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    try:
+        results = asyncio.run(scenario())
+    finally:
+        engine.shutdown()
+    assert sum(isinstance(r, EngineBusy) for r in results) == 1
+    assert engine.pending == 0
+
+
+def test_engine_rejects_over_cost_budget(minimal_png_bytes: bytes):
+    """Пока пул занят, задачи сверх бюджета мегапикселей отклоняются с Retry-After; в пустой пул — принимаются."""
+    engine = ProcessingEngine(workers=1, max_queue=4, max_queue_cost=1.0)
+
+    async def scenario():
+        tasks = [
+            asyncio.create_task(engine.process_image(minimal_png_bytes + bytes([i]), f"{i}.png", cost=0.8))
+            for i in range(2)
+        ]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    try:
+        first, second = asyncio.run(scenario())
+    finally:
+        engine.shutdown()
+    assert first["result"] is None
+    assert isinstance(second, EngineBusy)
+    assert second.retry_after >= 1
+    assert engine.pending == 0 and engine.pending_cost == 0
+
+
+def test_engine_deadline(minimal_png_bytes: bytes):
+    """Задача, которая не успеет к дедлайну, не ставится в пул; истёкшая в очереди — не выполняется."""
+    engine = ProcessingEngine(workers=1, max_queue=0)
+    try:
+        with pytest.raises(DeadlineExceeded):
+            asyncio.run(engine.process_image(minimal_png_bytes, "x.png", deadline=time.time() - 1))
+    finally:
+        engine.shutdown()
+    assert engine.pending == 0
+    outcome = _run_task("process_image", (minimal_png_bytes, "x.png"), {}, time.time(), {}, None, time.time() - 1)
+    assert outcome["expired"] and outcome["process_time"] == 0.0
+
+
+def test_engine_process_many_keeps_order(minimal_png_bytes: bytes, jpeg_bytes: bytes):
+    """Несколько файлов обрабатываются параллельно, порядок результатов сохраняется."""
+    engine = ProcessingEngine(workers=2, max_queue=0)
+    try:
+        outcomes = asyncio.run(engine.process_many([(minimal_png_bytes, "a.png"), (jpeg_bytes, "b.jpg")]))
+        with pytest.raises(BatchTooLarge):  # больше ёмкости пула — не поместится никогда
+            asyncio.run(engine.process_many([(jpeg_bytes, "x.jpg")] * 3))
+    finally:
+        engine.shutdown()
+    assert len(outcomes) == 2
+    assert all(o["result"] is None for o in outcomes)
+
+
+def test_engine_unknown_mode():
+    with pytest.raises(ValueError):
+        ProcessingEngine(mode="gpu")
+
+
+def test_engine_process_mode(minimal_png_bytes: bytes):
+    """В режиме process FaceProcessor создаётся в отдельном процессе."""
+    engine = ProcessingEngine(workers=1, max_queue=0, mode="process")
+    try:
+        outcome = asyncio.run(engine.process_image(minimal_png_bytes, "x.png"))
+    finally:
+        engine.shutdown()
+    assert outcome["result"] is None
+
+
+def test_engine_background_waits_for_idle_worker(minimal_png_bytes: bytes):
+    """Фоновая задача не встаёт в очередь пула, пока все исполнители заняты."""
+    engine = ProcessingEngine(workers=1, max_queue=4)
+
+    async def scenario():
+        interactive = asyncio.create_task(engine.process_image(minimal_png_bytes, "a.png"))
+        await asyncio.sleep(0)
+        background = asyncio.create_task(engine.process_image(minimal_png_bytes + b"\0", "b.png", background=True))
+        for _ in range(3):
+            await asyncio.sleep(0)
+        waiting = (engine.pending, engine._background_waiting)
+        await asyncio.gather(interactive, background)
+        return waiting
+
+    try:
+        waiting = asyncio.run(scenario())
+    finally:
+        engine.shutdown()
+    assert waiting == (1, 1)
+    assert engine.pending == 0
+
+
+def test_engine_coalesces_identical_in_flight(minimal_png_bytes: bytes, jpeg_bytes: bytes):
+    """Одновременные одинаковые изображения обрабатываются один раз; отмена одного ждущего не мешает другому."""
+    engine = ProcessingEngine(workers=2, max_queue=4)
+
+    async def scenario():
+        first = asyncio.create_task(engine.process_image(minimal_png_bytes, "a.png"))
+        second = asyncio.create_task(engine.process_image(minimal_png_bytes, "b.png"))
+        other = asyncio.create_task(engine.process_image(minimal_png_bytes, "c.png", output_format="jpeg"))
+        for _ in range(3):
+            await asyncio.sleep(0)
+        pending = engine.pending
+        first.cancel()
+        return pending, await second, await other, first.cancelled()
+
+    try:
+        pending, second, other, cancelled = asyncio.run(scenario())
+    finally:
+        engine.shutdown()
+    assert pending == 2  # другие параметры — отдельная задача
+    assert cancelled and second["coalesced"] and second["result"] is None
+    assert "coalesced" not in other
+    assert engine.pending == 0 and not engine._in_flight
+
+
+def test_engine_caches_only_final_outcomes(tmp_path, monkeypatch, minimal_png_bytes: bytes, jpeg_bytes: bytes):
+    """«Лица нет» кэшируется, а ошибка обработки — нет (ни в памяти, ни на диске)."""
+    cache = ResultCache(max_bytes=1024, disk_dir=str(tmp_path))
+    engine = ProcessingEngine(workers=1, max_queue=0, cache=cache)
+
+    def broken(self, image_bytes, *args):
+        if image_bytes == jpeg_bytes:
+            raise RuntimeError("сбой декодера")
+        return None
+
+    monkeypatch.setattr(FaceProcessor, "_analyze", broken)
+
+    async def scenario():
+        return [await engine.process_image(data, name) for data, name in
+                ((minimal_png_bytes, "x.png"), (minimal_png_bytes, "x.png"),
+                 (jpeg_bytes, "y.jpg"), (jpeg_bytes, "y.jpg"))]
+
+    try:
+        no_face, no_face_again, error, error_again = asyncio.run(scenario())
+    finally:
+        engine.shutdown()
+    assert (no_face["cache"], no_face_again["cache"]) == ("miss", "hit")
+    assert error["stats"]["outcome"] == "error"
+    assert error_again["cache"] == "miss" and error_again["process_time"] > 0
+    assert len(list(tmp_path.glob("*/*"))) == 1
+
+
+def test_engine_shutdown_stops_render_pool():
+    """Общий пул потоков рендеринга останавливается вместе с пулом; следующий вызов создаёт новый."""
+    from app import face_processor
+
+    engine = ProcessingEngine(workers=1, max_queue=0)
+    pool = face_processor.render_pool()
+    assert face_processor.render_pool() is pool
+    engine.shutdown()
+    assert pool._shutdown
+    assert face_processor.render_pool() is not pool
+
+
+def test_coalescing_respects_priority_and_deadline():
+    """Интерактивный запрос не присоединяется к фоновому, а запрос без дедлайна — к вычислению с дедлайном."""
+    engine = ProcessingEngine(workers=1, max_queue=0)
+    started = []
+
+    async def scenario():
+        gate = asyncio.Event()
+
+        def compute(name):
+            async def run():
+                started.append(name)
+                await gate.wait()
+                return {"result": None}
+            return run
+
+        deadline = time.time() + 60
+        tasks = [
+            asyncio.create_task(engine._coalesced("k", compute("background"), background=True)),
+            asyncio.create_task(engine._coalesced("k", compute("with-deadline"), deadline=deadline)),
+            asyncio.create_task(engine._coalesced("k", compute("tighter"), deadline=deadline - 30)),
+            asyncio.create_task(engine._coalesced("k", compute("no-deadline"))),
+        ]
+        for _ in range(3):
+            await asyncio.sleep(0)
+        gate.set()
+        return await asyncio.gather(*tasks)
+
+    try:
+        outcomes = asyncio.run(scenario())
+    finally:
+        engine.shutdown()
+    assert started == ["background", "with-deadline", "no-deadline"]
+    assert ["coalesced" in o for o in outcomes] == [False, False, True, False]
+    assert not engine._in_flight
+
+
+def test_coalescing_skips_cancelled_computation():
+    """Запрос, пришедший сразу после отмены вычисления последним ждущим, запускает новое, а не получает отмену."""
+    engine = ProcessingEngine(workers=1, max_queue=0)
+    started = []
+
+    async def scenario():
+        gate = asyncio.Event()
+
+        async def compute():
+            started.append(len(started))
+            await gate.wait()
+            return {"result": None}
+
+        first = asyncio.create_task(engine._coalesced("k", compute))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)  # первый ждущий ушёл и отменил вычисление, оно ещё не завершилось
+        second = asyncio.create_task(engine._coalesced("k", compute))
+        await asyncio.sleep(0)
+        gate.set()
+        return await second, first.cancelled()
+
+    try:
+        outcome, cancelled = asyncio.run(scenario())
+    finally:
+        engine.shutdown()
+    assert cancelled and started == [0, 1]
+    assert outcome == {"result": None}
+    assert not engine._in_flight
+
+
+def test_engine_batch_admitted_as_one_unit(monkeypatch, minimal_png_bytes: bytes):
+    """Пакет дороже бюджета отклоняется до постановки любой задачи; помещающийся — выполняется целиком."""
+    files = [(minimal_png_bytes + bytes([i]), f"{i}.png") for i in range(2)]
+    engine = ProcessingEngine(workers=1, max_queue=4, max_queue_cost=1.0)
+    monkeypatch.setattr(engine, "estimate_cost", lambda *a: 0.8)
+    submitted = []
+    monkeypatch.setattr(engine._executor, "submit", lambda *a: submitted.append(a) or pytest.fail("задача в пуле"))
+    try:
+        with pytest.raises(BatchTooLarge):
+            asyncio.run(engine.process_many(files))
+    finally:
+        engine.shutdown()
+    assert not submitted and engine.pending == 0 and engine.pending_cost == 0
+
+    engine = ProcessingEngine(workers=1, max_queue=4, max_queue_cost=2.0)
+    monkeypatch.setattr(engine, "estimate_cost", lambda *a: 0.8)
+
+    async def scenario():
+        tasks = engine.submit_many(files)
+        reserved = engine.pending, engine.pending_cost
+        # Параллельный пакет не проходит проверку, пока первый держит резерв
+        with pytest.raises(EngineBusy):
+            engine.submit_many(files)
+        return reserved, await asyncio.gather(*tasks)
+
+    try:
+        reserved, results = asyncio.run(scenario())
+    finally:
+        engine.shutdown()
+    assert reserved == (2, 1.6)
+    assert [idx for idx, _ in results] == [0, 1] and all(o["result"] is None for _, o in results)
+    assert engine.pending == 0 and engine.pending_cost == 0
+
+
+def test_engine_single_task_over_budget_when_idle():
+    """Одна задача дороже бюджета принимается только в пустой пул."""
+    engine = ProcessingEngine(workers=1, max_queue=4, max_queue_cost=1.0)
+    engine.admit([5.0])
+    engine.pending, engine.pending_cost = 1, 0.1
+    with pytest.raises(EngineBusy):
+        engine.admit([5.0])
+    engine.shutdown()
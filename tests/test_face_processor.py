@@ -0,0 +1,251 @@
+"""Тесты внутренних шагов FaceProcessor."""
+import io
+from types import SimpleNamespace
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image, ImageOps
+
+from app.face_processor import (
+    DEFAULT_MAX_MEGAPIXELS, ImageTooLarge, choose_reduction, fit_budget, plan_decode, probe_header,
+)
+
+
+def _detection(xmin, ymin, width, height, score):
+    bbox = SimpleNamespace(xmin=xmin, ymin=ymin, width=width, height=height)
+    return SimpleNamespace(location_data=SimpleNamespace(relative_bounding_box=bbox), score=[score])
+
+
+def test_merge_detections_drops_duplicates(processor):
+    """Одно лицо от двух моделей остаётся одним (с большим confidence), другое лицо сохраняется."""
+    a = _detection(0.30, 0.30, 0.20, 0.20, 0.6)
+    a_dup = _detection(0.31, 0.31, 0.20, 0.20, 0.9)
+    b = _detection(0.70, 0.10, 0.10, 0.10, 0.5)
+    merged = processor._merge_detections([a, b, a_dup])
+    assert merged == [a_dup, b]
+
+
+def test_select_faces_threshold_cap_and_order(processor):
+    """Режим всех лиц: порог confidence, лимит по самым уверенным, порядок слева направо."""
+    right = _detection(0.70, 0.20, 0.10, 0.10, 0.9)
+    left = _detection(0.10, 0.20, 0.10, 0.10, 0.8)
+    middle = _detection(0.40, 0.20, 0.10, 0.10, 0.6)
+    weak = _detection(0.55, 0.20, 0.10, 0.10, 0.3)
+    detections = [right, weak, middle, left]
+    assert processor._select_faces(detections, 10) == [left, middle, right]
+    assert processor.last_stats["faces"] == 3
+    assert processor._select_faces(detections, 2) == [left, right]
+
+
+def test_bbox_iou(processor):
+    a = _detection(0.0, 0.0, 0.5, 0.5, 1.0).location_data.relative_bounding_box
+    b = _detection(0.5, 0.5, 0.5, 0.5, 1.0).location_data.relative_bounding_box
+    assert processor._bbox_iou(a, a) == 1.0
+    assert processor._bbox_iou(a, b) == 0.0
+
+
+def test_detect_faces_no_face(processor):
+    """На пустом изображении каскад доходит до точной модели и ничего не находит."""
+    img = np.full((64, 64, 3), 200, dtype=np.uint8)
+    assert processor._detect_faces(img, "blank.png") == []
+
+
+@pytest.mark.parametrize("orientation", range(1, 9))
+def test_apply_orientation_matches_exif_transpose(processor, orientation):
+    """Поворот по EXIF на массиве совпадает с ImageOps.exif_transpose, файл декодируется один раз."""
+    rng = np.random.default_rng(orientation)
+    pixels = rng.integers(0, 255, size=(6, 10, 3), dtype=np.uint8)
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format="PNG", exif=exif)
+    data = buf.getvalue()
+
+    expected = np.array(ImageOps.exif_transpose(Image.open(io.BytesIO(data))).convert("RGB"))
+    decoded = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    assert probe_header(data) == ("PNG", (10, 6), orientation)
+    result = processor._apply_orientation(decoded, orientation)
+    assert np.array_equal(cv2.cvtColor(result, cv2.COLOR_BGR2RGB), expected)
+
+
+def test_choose_reduction():
+    """JPEG уменьшается при декодировании, но не ниже max_dimension; другие форматы — нет."""
+    assert choose_reduction("JPEG", 4000, 3000, 1920) == 2
+    assert choose_reduction("JPEG", 8000, 6000, 1920) == 4
+    assert choose_reduction("JPEG", 1920, 1080, 1920) == 1
+    assert choose_reduction("PNG", 8000, 6000, 1920) == 1
+    assert choose_reduction(None, 0, 0, 1920) == 1
+
+
+def test_plan_decode_pixel_budget():
+    """Сверх бюджета JPEG декодируется сильнее уменьшенным, остальные форматы отклоняются."""
+    assert plan_decode("JPEG", 30000, 30000, 1920, 50) == 8
+    assert plan_decode("JPEG", 8000, 6000, 1920, 50) == 4
+    assert plan_decode("PNG", 8000, 6000, 1920, 50) == 1
+    assert plan_decode("PNG", 30000, 30000, 1920, 0) == 1
+    with pytest.raises(ImageTooLarge):
+        plan_decode("PNG", 30000, 30000, 1920, 50)
+    with pytest.raises(ImageTooLarge):
+        plan_decode("JPEG", 80000, 80000, 1920, 50)
+
+
+def test_fit_budget_keeps_minimum_reduction():
+    """Бюджет поверх нужного кропу уменьшения: не меньше заданного, сильнее — только JPEG."""
+    assert fit_budget("JPEG", 12000, 10000, 1, 50) == 2
+    assert fit_budget("JPEG", 12000, 10000, 4, 50) == 4
+    assert fit_budget("JPEG", 12000, 10000, 1, 0) == 1
+    with pytest.raises(ImageTooLarge):
+        fit_budget("PNG", 12000, 10000, 1, 50)
+
+
+def test_render_geometry_pixel_budget(processor, jpeg_bomb_bytes: bytes):
+    """Повторный кроп проверяет бюджет пикселей по заголовку, как и первая обработка."""
+    geometry = {
+        "image_size": (65000, 65000), "orientation": 1, "face_center": (32500.0, 32500.0),
+        "face_size": 4000.0, "rotation_angle": 0.0,
+    }
+    assert processor.render_geometry(jpeg_bomb_bytes, geometry, output_size=2048) is None
+    assert processor.last_stats["outcome"] == "too-large"
+    assert "decode" not in processor.last_stats["stages"]
+
+
+def test_decompression_bomb_not_decoded(processor, png_bomb_bytes: bytes):
+    """Маленький PNG с огромным заголовком отклоняется по заголовку без декодирования — и с параметрами по умолчанию."""
+    assert processor.max_megapixels == DEFAULT_MAX_MEGAPIXELS
+    assert processor.process_image(png_bomb_bytes, "bomb.png") is None
+    assert processor.last_stats["outcome"] == "too-large"
+    assert "decode" not in processor.last_stats["stages"]
+
+
+def test_decode_image_reduced_jpeg(processor):
+    """Уменьшенное декодирование JPEG даёт изображение в 1/reduction размера с учётом EXIF-поворота."""
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    buf = io.BytesIO()
+    Image.new("RGB", (800, 400), color="green").save(buf, format="JPEG", exif=exif)
+    data = buf.getvalue()
+    format_name, size, orientation = probe_header(data)
+    assert (format_name, size, orientation) == ("JPEG", (800, 400), 6)
+    img = processor._decode_image(data, "x.jpg", orientation, reduction=4)
+    assert img.shape == (200, 100, 3)
+
+
+def test_render_crop_single_warp(processor):
+    """Рендер сразу даёт output_size×output_size; углы после поворота заливаются белым."""
+    img = np.zeros((1000, 1000, 3), dtype=np.uint8)
+    out = processor._render_crop(img, 500, 500, 500, rotation_angle=0.0)
+    assert out.shape == (512, 512, 3)
+    assert out.max() == 0  # кадр без белых полей
+
+    rotated = processor._render_crop(img, 500, 500, 500, rotation_angle=30.0)
+    assert rotated.shape == (512, 512, 3)
+    assert (rotated[0, 0] == 255).all()
+    assert (rotated[256, 256] == 0).all()
+
+
+def test_render_geometry_reframes_without_models(processor, monkeypatch):
+    """Повторный кроп по геометрии полного разрешения: JPEG декодируется уменьшенным, модели не вызываются."""
+    img = np.full((2000, 2000, 3), 255, dtype=np.uint8)
+    cv2.rectangle(img, (900, 900), (1100, 1100), (0, 0, 0), -1)  # «лицо» в центре
+    ok, buf = cv2.imencode(".jpg", img)
+    geometry = {
+        "image_size": (2000, 2000), "orientation": 1, "bbox": (900, 900, 200, 200),
+        "landmarks": np.zeros((4, 2), dtype=np.float32), "face_center": (1000.0, 1000.0),
+        "face_size": 1200.0, "rotation_angle": 0.0,
+    }
+    monkeypatch.setattr(processor, "_detect_faces", lambda *a: pytest.fail("детекция не должна запускаться"))
+
+    result = processor.render_geometry(buf.tobytes(), geometry, output_size=256, crop_shift_up=0.0)
+    out = cv2.imdecode(np.frombuffer(result["data"], np.uint8), cv2.IMREAD_COLOR)
+    assert out.shape == (256, 256, 3)
+    assert result["media_type"] == "image/png"
+    # Лицо 1200px -> 128px (face_fill_ratio 0.5), квадрат 200px -> ~21px в центре
+    assert out[128, 128].max() < 30
+    assert out[128, 100].min() > 225
+
+
+def test_process_image_multiple_sizes_one_pass(processor, monkeypatch):
+    """Несколько размеров за один вызов: анализ один раз, кадрирование у всех размеров одинаковое."""
+    img = np.full((1000, 1000, 3), 255, dtype=np.uint8)
+    cv2.rectangle(img, (450, 450), (550, 550), (0, 0, 0), -1)
+    geometry = {
+        "image_size": (1000, 1000), "orientation": 1, "face_center": (500.0, 500.0),
+        "face_size": 400.0, "rotation_angle": 0.0,
+    }
+    calls = []
+    monkeypatch.setattr(processor, "_analyze", lambda *a: calls.append(a) or (img, [geometry]))
+
+    result = processor.process_image(b"", "a.jpg", sizes=[256, 512, 64])
+    assert len(calls) == 1
+    assert [v["size"] for v in result["variants"]] == [256, 512, 64]
+    assert result["data"] is result["variants"][0]["data"]
+    decoded = [cv2.imdecode(np.frombuffer(v["data"], np.uint8), cv2.IMREAD_COLOR) for v in result["variants"]]
+    assert [d.shape[0] for d in decoded] == [256, 512, 64]
+    # Тёмный квадрат в одном и том же месте кадра (относительно размера)
+    for d in decoded:
+        n = d.shape[0]
+        assert d[n // 2 + n // 10, n // 2].max() < 60
+        assert d[n // 20, n // 20].min() > 200
+
+
+def test_full_decode_for_largest_size(processor, monkeypatch):
+    """Полное разрешение декодируется, если уменьшенного не хватает для наибольшего из sizes."""
+    buf = io.BytesIO()
+    Image.new("RGB", (4400, 3300), color="gray").save(buf, format="JPEG")
+    data = buf.getvalue()
+    # Лицо ~674px в полном разрешении: при декодировании 1/2 — ~337px
+    detection = _detection(0.45, 0.4, 0.1, 0.17, 0.9)
+    monkeypatch.setattr(processor, "_detect_faces", lambda *a, **k: [detection])
+    monkeypatch.setattr(processor, "_mesh_landmarks", lambda *a: None)
+
+    assert processor.process_image(data, "group.jpg", sizes=[512]) is not None
+    assert not processor.last_stats["full_decode"]
+    assert processor.last_stats["decoded_megapixels"] < processor.last_stats["megapixels"]
+
+    result = processor.process_image(data, "group.jpg", sizes=[1024, 512])
+    assert processor.last_stats["full_decode"]
+    assert [v["size"] for v in result["variants"]] == [1024, 512]
+
+
+def test_process_image_all_faces(processor, monkeypatch):
+    """Все лица за один анализ: по кропу на лицо с номером, confidence и bbox; 'data' — первого лица."""
+    img = np.full((600, 1200, 3), 255, dtype=np.uint8)
+    geometries = [
+        {"image_size": (1200, 600), "orientation": 1, "face_center": (x, 300.0), "face_size": 200.0,
+         "rotation_angle": 0.0, "score": score, "bbox": (x - 100, 200.0, 200.0, 200.0)}
+        for x, score in ((300.0, 0.7), (900.0, 0.9))
+    ]
+    calls = []
+    monkeypatch.setattr(processor, "_analyze", lambda *a: calls.append(a) or (img, geometries))
+
+    result = processor.process_image(b"", "team.jpg", max_faces=5, sizes=[128, 64])
+    assert calls == [(b"", "team.jpg", 5, 128)]
+    assert "geometry" not in result
+    assert [(f["face"], f["score"], f["bbox"][0]) for f in result["faces"]] == [(0, 0.7, 200.0), (1, 0.9, 800.0)]
+    assert [[v["size"] for v in f["variants"]] for f in result["faces"]] == [[128, 64], [128, 64]]
+    assert result["data"] is result["faces"][0]["data"] is result["faces"][0]["variants"][0]["data"]
+
+
+def test_face_roi_expands_and_clamps(processor):
+    """Область для Face Mesh — расширенный квадрат вокруг bbox, не выходящий за кадр."""
+    bbox = _detection(0.4, 0.4, 0.2, 0.1, 1.0).location_data.relative_bounding_box
+    assert processor._face_roi(bbox, 1000, 1000, expand=2.0) == (300, 250, 700, 650)
+    edge = _detection(0.0, 0.0, 0.3, 0.3, 1.0).location_data.relative_bounding_box
+    assert processor._face_roi(edge, 100, 100, expand=2.0) == (0, 0, 45, 45)
+
+
+def test_convert_landmarks_to_array_float32(processor):
+    """Landmarks переводятся в float32 пиксели с учётом offset области."""
+    from mediapipe.framework.formats import landmark_pb2
+
+    face = landmark_pb2.NormalizedLandmarkList()
+    face.landmark.add(x=0.5, y=0.25)
+    face.landmark.add(x=1.0, y=1.0)
+    landmarks = processor._convert_landmarks_to_array(face, (100, 200, 3), offset=(10, 20))
+    assert landmarks.dtype == np.float32
+    assert np.allclose(landmarks, [[110, 45], [210, 120]])
+
+    center, size = processor._calculate_face_metrics(landmarks, margin=1.0)
+    assert np.allclose(center, [160, 82.5])
+    assert size == pytest.approx(100)
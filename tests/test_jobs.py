@@ -0,0 +1,67 @@
+"""Тесты асинхронных заданий."""
+import asyncio
+import zipfile
+
+import pytest
+
+from app.jobs import ITEM_NO_FACE, ITEM_OK, JOB_DONE, JobManager, JobNotFound
+
+
+class FakeEngine:
+    """Вместо пула: «лицо» есть во всех файлах, кроме начинающихся с b"none"."""
+
+    def __init__(self):
+        self.calls = []
+
+    async def process_image(self, image_bytes, filename, background=False, **options):
+        self.calls.append((filename, background, options))
+        await asyncio.sleep(0)
+        result = None if image_bytes.startswith(b"none") else {"data": b"IMG" + image_bytes, "media_type": "image/png"}
+        return {"result": result, "queue_time": 0.0, "process_time": 0.0}
+
+
+async def _run_job(manager: JobManager, payloads):
+    manager.start()
+    try:
+        job = manager.create({"output_format": "png", "quality": None})
+        for idx, data in enumerate(payloads):
+            manager.add_input(job, f"photo{idx}.jpg").write_bytes(data)
+        manager.submit(job)
+        for _ in range(200):
+            if job.status == JOB_DONE:
+                break
+            await asyncio.sleep(0.01)
+        archive = await manager.archive(job.id)
+        return job, archive
+    finally:
+        await manager.stop()
+
+
+def test_job_processes_all_items_in_background(tmp_path):
+    engine = FakeEngine()
+    manager = JobManager(engine, str(tmp_path), workers=2)
+    job, archive = asyncio.run(_run_job(manager, [b"a", b"none", b"c"]))
+
+    assert job.status == JOB_DONE
+    status = job.to_dict(with_items=True)
+    assert (status["total"], status["completed"], status["succeeded"], status["no_face"]) == (3, 3, 2, 1)
+    assert status["progress"] == 1.0
+    assert [item["status"] for item in status["items"]] == [ITEM_OK, ITEM_NO_FACE, ITEM_OK]
+    # Все вызовы — фоновые, с параметрами задания
+    assert all(background for _, background, _ in engine.calls)
+    assert all(options == {"output_format": "png", "quality": None} for _, _, options in engine.calls)
+    # Входные файлы удалены, результаты на диске и в архиве
+    assert not any(job.input_dir.iterdir())
+    assert manager.result_path(job.id, 2).read_bytes() == b"IMGc"
+    with zipfile.ZipFile(archive) as zf:
+        assert sorted(zf.namelist()) == [status["items"][0]["output"], status["items"][2]["output"]]
+
+
+def test_job_cancel_removes_files(tmp_path):
+    manager = JobManager(FakeEngine(), str(tmp_path))
+    job = manager.create({"output_format": "png"})
+    manager.add_input(job, "x.jpg").write_bytes(b"x")
+    manager.cancel(job.id)
+    assert not job.root.exists()
+    with pytest.raises(JobNotFound):
+        manager.get(job.id)
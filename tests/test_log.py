@@ -0,0 +1,26 @@
+"""Тесты структурированного логирования."""
+import json
+import logging
+
+from app import log
+
+
+def test_json_formatter_includes_request_id_and_extra():
+    record = logging.makeLogRecord({"name": "app.test", "levelname": "INFO", "msg": "файлов: %d", "args": (3,)})
+    token = log.REQUEST_ID.set("req-1")
+    try:
+        log._RequestIdFilter().filter(record)
+    finally:
+        log.REQUEST_ID.reset(token)
+    record.duration_ms = 12.5
+    entry = json.loads(log.JsonFormatter().format(record))
+    assert entry["msg"] == "файлов: 3"
+    assert entry["request_id"] == "req-1"
+    assert entry["duration_ms"] == 12.5
+
+
+def test_new_request_id_accepts_only_safe_values():
+    assert log.new_request_id("abc-123") == "abc-123"
+    generated = log.new_request_id("bad id\r\nX-Injected: 1")
+    assert generated != "bad id\r\nX-Injected: 1" and len(generated) == 16
+    assert log.new_request_id(None) != log.new_request_id(None)
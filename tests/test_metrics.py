@@ -0,0 +1,30 @@
+"""Тесты метрик Prometheus."""
+from app.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_histogram_renders_cumulative_buckets():
+    h = Histogram("t_seconds", "test", ("stage",), buckets=(0.1, 1.0))
+    h.observe(0.05, stage="decode")
+    h.observe(0.5, stage="decode")
+    h.observe(5.0, stage="decode")
+    lines = h.render()
+    assert "# TYPE t_seconds histogram" in lines
+    assert 't_seconds_bucket{stage="decode",le="0.1"} 1' in lines
+    assert 't_seconds_bucket{stage="decode",le="1"} 2' in lines
+    assert 't_seconds_bucket{stage="decode",le="+Inf"} 3' in lines
+    assert 't_seconds_sum{stage="decode"} 5.55' in lines
+    assert 't_seconds_count{stage="decode"} 3' in lines
+    assert h.count(stage="decode") == 3
+
+
+def test_counter_gauge_and_registry():
+    registry = Registry()
+    c = registry.register(Counter("t_total", "test", ("format",)))
+    c.inc(format="JPEG")
+    c.inc(2, format='we"ird')
+    registry.register(Gauge("t_depth", "test", lambda: 7))
+    text = registry.render()
+    assert 't_total{format="JPEG"} 1' in text
+    assert 't_total{format="we\\"ird"} 2' in text
+    assert "t_depth 7" in text
+    assert text.endswith("\n")
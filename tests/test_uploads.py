@@ -0,0 +1,96 @@
+"""Тесты лимитов загрузок и чтения больших файлов через mmap."""
+import mmap
+from tempfile import SpooledTemporaryFile
+
+import pytest
+from fastapi import FastAPI, HTTPException, Request, UploadFile
+from fastapi.testclient import TestClient
+
+from app.face_processor import estimate_cost
+from app.uploads import BodyLimitMiddleware, _PartCounter, multipart_boundary, read_upload
+
+
+def _limited_client(limit: int) -> TestClient:
+    app = FastAPI()
+    app.add_middleware(BodyLimitMiddleware, limits={"/upload": limit})
+
+    @app.post("/upload")
+    async def upload(request: Request):
+        return {"bytes": len(await request.body())}
+
+    return TestClient(app)
+
+
+def test_body_limit_by_content_length_and_stream():
+    """Сверх лимита — 413 и по Content-Length, и для chunked-тела, которое считается по мере приёма."""
+    client = _limited_client(100)
+    assert client.post("/upload", content=b"x" * 100).json() == {"bytes": 100}
+    assert client.post("/upload", content=b"x" * 101).status_code == 413
+
+    def chunks():
+        for _ in range(10):
+            yield b"x" * 30
+
+    r = client.post("/upload", content=chunks())
+    assert r.status_code == 413
+    assert "больше допустимого" in r.json()["detail"]
+
+
+def test_part_counter_split_delimiter():
+    """Размер части считается и когда разделитель приходит разрезанным между фрагментами."""
+    body = b"--xyz\r\nh\r\n\r\n" + b"a" * 50 + b"\r\n--xyz\r\nh\r\n\r\n" + b"b" * 50 + b"\r\n--xyz--\r\n"
+    for size in (1, 3, 7, len(body)):
+        counter = _PartCounter(b"xyz", 60)
+        assert all(counter.feed(body[i:i + size]) for i in range(0, len(body), size))
+        counter = _PartCounter(b"xyz", 40)
+        assert not all(counter.feed(body[i:i + size]) for i in range(0, len(body), size))
+    assert multipart_boundary('multipart/form-data; boundary="a b"') == b"a b"
+    assert multipart_boundary("application/json") is None
+
+
+def test_file_limit_enforced_while_streaming():
+    """Файл сверх лимита — 413 по мере приёма, задолго до лимита запроса."""
+    app = FastAPI()
+    app.add_middleware(BodyLimitMiddleware, limits={"/upload": 10 * 1024 * 1024}, part_limits={"/upload": 1000})
+
+    @app.post("/upload")
+    async def upload(request: Request):
+        form = await request.form()
+        return {"sizes": [len(await f.read()) for _, f in form.multi_items()]}
+
+    client = TestClient(app)
+    small = [("files", ("a.png", b"x" * 1000, "image/png")), ("files", ("b.png", b"y" * 900, "image/png"))]
+    assert client.post("/upload", files=small).json() == {"sizes": [1000, 900]}
+
+    body = (b"--b\r\nContent-Disposition: form-data; name=\"files\"; filename=\"big.png\"\r\n\r\n"
+            + b"z" * 5 * 1024 * 1024 + b"\r\n--b--\r\n")
+
+    def chunks():
+        for i in range(0, len(body), 4096):
+            yield body[i:i + 4096]
+
+    # Тело (5 МБ) в пределах лимита запроса — отказ по лимиту файла, а не запроса
+    r = client.post("/upload", content=chunks(), headers={"Content-Type": "multipart/form-data; boundary=b"})
+    assert r.status_code == 413
+    assert r.json()["detail"] == "Файл больше допустимого (0 МБ)"
+
+
+def _upload(data: bytes) -> UploadFile:
+    spooled = SpooledTemporaryFile(max_size=1024)
+    spooled.write(data)
+    spooled.seek(0)
+    return UploadFile(file=spooled, size=len(data), filename="a.png")
+
+
+def test_read_upload_mmap_and_limit(minimal_png_bytes: bytes):
+    """Маленький файл — bytes, большой — mmap с тем же содержимым, сверх лимита — 413."""
+    assert read_upload(_upload(minimal_png_bytes), "a.png", 0, 1024 * 1024) == minimal_png_bytes
+
+    mapped = read_upload(_upload(minimal_png_bytes), "a.png", 0, 10)
+    assert isinstance(mapped, mmap.mmap)
+    assert mapped[:] == minimal_png_bytes
+    assert estimate_cost(mapped) == estimate_cost(minimal_png_bytes)
+
+    with pytest.raises(HTTPException) as exc:
+        read_upload(_upload(minimal_png_bytes), "a.png", 10, 0)
+    assert exc.value.status_code == 413